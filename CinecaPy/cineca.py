@@ -9,10 +9,32 @@ Created on Mon Feb  19 15:00:00 2024
 """
 
 # -----------------------------------------------------------------------------
+import ast
+import asyncio
+import atexit
+import builtins
+import compileall
+import hashlib
+import io
+import heapq
+import importlib.util
 import os
+import json
+import marshal
+import multiprocessing
+import multiprocessing.pool
+import pickle
+import py_compile
 import time as Time
+import shlex
 import shutil
+import signal
+import struct
+import subprocess
 import sys
+import tarfile
+import threading
+import types
 import numpy as np
 import psutil
 
@@ -65,7 +87,14 @@ def create_sbatch_file( path, filename="run_slurm.bat",
                         printf=False,
                         other_lines='',
                         job='',
-                        run=False ) :
+                        run=False,
+                        return_job=False,
+                        stage_in=None,
+                        stage_out=None,
+                        stage_workers=8,
+                        keep_logs=0,
+                        log_mode="files",
+                        signal_time=None ) :
     """
     Create an sbatch file with the specified parameters.
 
@@ -85,10 +114,34 @@ def create_sbatch_file( path, filename="run_slurm.bat",
         - mail_user (str, optional): The email address to receive notifications. Defaults to "lzampa@ogs.it".
         - print (bool, optional): Whether to print the contents of the sbatch file. Defaults to False.
         - job (str, optional): The job to be executed. Defaults to ''.
-        - run (bool, optional): Whether to submit the job to the queue. Defaults to False.
+        - run (bool, optional): Whether to submit the job to the queue 
+          (or to run it with 'run_local' outside Cineca). Defaults to False.
+        - return_job (bool, optional): Whether to also return the handle of the submitted job. Defaults to False.
+        - stage_in (list or dict, optional): Files or directories copied to the node-local storage 
+          ( $TMPDIR, exported to the job as $CP_STAGE_DIR ) before the job runs, once per node, 
+          skipping those unchanged since the last copy (see 'stage'). A dict maps the sources 
+          to their names in the staging directory. Read them through 'staged( path )'. Defaults to None.
+        - stage_out (list or dict, optional): Files or directories of the task output directory 
+          ( relative paths ) copied back when each task ends, even if it fails. Each array task 
+          writes its outputs in its own node-local directory, exported as $CP_STAGE_OUT, and only 
+          stages out those. A list copies them to 'path', a dict maps them to their destination 
+          directories. Defaults to None.
+        - stage_workers (int, optional): The number of parallel copies. Defaults to 8.
+        - keep_logs (int, optional): The number of previous runs whose logs are kept. With 0, the previous 
+          log directory is renamed aside and deleted in the background. Otherwise each run writes its logs 
+          in a new 'run_<time>' subdirectory ( linked as 'latest' ), and only the 'keep_logs' most recent 
+          previous runs are kept. Defaults to 0.
+        - log_mode (str, optional): "files" for one output and one error file per task ( 'out'/'err' ), 
+          "run" to append the outputs of all the tasks to a single indexed log of the run, "node" 
+          for one indexed log per node (see 'read_task_log'). Defaults to "files".
+        - signal_time (int, optional): The seconds before the time limit at which SLURM sends SIGUSR1 
+          to the batch script ( '--signal=B:USR1@signal_time' ), which forwards it to its background 
+          processes. The end time of the job and 'signal_time' are exported as CP_END_TIME and CP_GRACE, 
+          for the tasks to stop in time (see 'Deadline'). Defaults to None.
 
     Returns:
         str: The path of the sbatch file.
+        SlurmJob: The job handle ( the 'LocalTask' list outside Cineca, None if not run ), only if 'return_job' is True.
     """
 
     # Check if the directory specified by 'path' exists
@@ -96,67 +149,5084 @@ def create_sbatch_file( path, filename="run_slurm.bat",
         # If not, create the directory
         os.makedirs( path, exist_ok=True )
     
+    if log_mode not in ( "files", "run", "node" ) :
+        raise ValueError( f"Unknown log_mode '{log_mode}', use 'files', 'run' or 'node'." )
+
     # Create local directories for the output and error files
-    logs_dir_out = os.path.dirname(out).split( os.sep )[-1]
-    logs_dir_err = os.path.dirname(err).split( os.sep )[-1]
+    # ( the previous ones are moved aside, not deleted in place )
+    logs_dirs = {}
+    for log_dir in dict.fromkeys( [ os.path.dirname( out ), os.path.dirname( err ) ] ) :
+        logs_dirs[ log_dir ] = _prepare_log_dir( path, log_dir, keep_logs )
+    out = os.path.join( logs_dirs[ os.path.dirname( out ) ], os.path.basename( out ) )
+    err = os.path.join( logs_dirs[ os.path.dirname( err ) ], os.path.basename( err ) )
+
+    # With the aggregated logs, SLURM only writes the messages preceding the task output, 
+    # appended by all the tasks to the same file ( see '--open-mode=append' below )
+    if log_mode != "files" :
+        log_dir = os.path.dirname( out )
+        out = os.path.join( log_dir, "slurm.%A.out" )
+        err = out
+
+    # Build the content of the file ( written only if it changed )
+    f = io.StringIO()
+    # Write the shebang line for a bash script
+    f.write("#!/bin/bash\n\n")
+    # Write the SLURM directives for the job resources
+    f.write(f"#SBATCH --nodes={nodes}\n")
+    f.write(f"#SBATCH --ntasks={ntasks}\n") 
+    f.write(f"#SBATCH --cpus-per-task={ncpus}\n")
+    f.write(f"#SBATCH --time {time}\n")
+    f.write(f"#SBATCH --mem={mem}\n")
+    if signal_time is not None :
+        f.write(f"#SBATCH --signal=B:USR1@{int( signal_time )}\n")
+    f.write(f"#SBATCH --out {out}\n")
+    f.write(f"#SBATCH --err {err}\n")
+    if log_mode != "files" :
+        f.write("#SBATCH --open-mode=append\n")
+    f.write(f"#SBATCH --account={account}\n")
+    f.write(f"#SBATCH --partition {partition} # partition to be used Galileo and debug queue\n")
+    f.write(f"#SBATCH --mail-type={mail_type}\n")
+    f.write(f"#SBATCH --mail-user={mail_user}\n")
+    f.write("\n")
+    # Write the job to be executed
+    f.write("# main code\n")
+    # The commands run when the job ends, in this order
+    exit_commands = []
+    # Write the deadline of the tasks, and the forwarding of the signal sent before the time limit
+    if signal_time is not None :
+        f.write("_cp_end=$(squeue -h -j $SLURM_JOB_ID -o %e 2> /dev/null)\n")
+        f.write("[ -n \"$_cp_end\" ] && export CP_END_TIME=$(date -d \"$_cp_end\" +%s 2> /dev/null)\n")
+        f.write(f"export CP_GRACE={int( signal_time )}\n")
+        f.write("trap 'kill -USR1 $(jobs -p) 2> /dev/null' USR1\n")
+    # Write the data movement to and from the node-local storage
+    if stage_in is not None or stage_out is not None :
+        lines, commands = _stage_lines( path, stage_in, stage_out, stage_workers )
+        for line in lines :
+            f.write(f"{line}\n")
+        exit_commands.extend( commands )
+    # Write the capture of the task output in the aggregated log
+    if log_mode != "files" :
+        lines, commands = _task_log_lines( log_dir, per_node=( log_mode == "node" ) )
+        for line in lines :
+            f.write(f"{line}\n")
+        exit_commands.extend( commands )
+    if exit_commands != [] :
+        f.write(f"trap {shlex.quote( ' ; '.join( exit_commands ) )} EXIT\n")
+    if ( type( other_lines ) == str ) and ( other_lines != '' ) :
+        f.write(f"{other_lines}")
+    if ( type( other_lines ) in ( list, tuple ) ) and ( not other_lines is False):
+        for line in other_lines :
+            f.write(f"{line}\n")
+    f.write(job)
+    f.write("\n")
+    _write_if_changed( path +s+ filename, f.getvalue() )
+
+    # If the 'printf' flag is True, print the contents of the file
+    if printf == True :
+        print( "\n# ---------------------------------------------------------" )
+        print( path +s+ filename )
+        print( "CONTENT :\n" )
+        print_file( path +s+ filename )
+
+    # Close the file
+    f.close()
+
+    # If the 'run' flag is True, submit the job to the queue
+    handle = None
+    if run == True :
+        if is_cineca_system() :
+            handle = submit( path +s+ filename )
+        else :
+            # Outside SLURM, run the job with the local executor
+            handle = run_local( path +s+ filename )
+
+    if return_job == True :
+        return path +s+ filename, handle
+
+    return path +s+ filename
+
+# -----------------------------------------------------------------------------
+def _copy_chunk( item ) :
+    """
+    Copy a byte range of a file and verify it, returning the md5 of the bytes read.
+    """
+
+    src, dst, offset, length = item
+    digest = hashlib.md5()
+    check = hashlib.md5()
+    fin = os.open( src, os.O_RDONLY )
+    fout = os.open( dst, os.O_RDWR )
+    try :
+        pos = offset
+        while pos < offset + length :
+            block = os.pread( fin, min( 8 << 20, offset + length - pos ), pos )
+            if block == b"" :
+                raise IOError( f"{src} changed while it was being copied" )
+            os.pwrite( fout, block, pos )
+            digest.update( block )
+            pos = pos + len( block )
+        os.fsync( fout )
+        # Read back the copy
+        pos = offset
+        while pos < offset + length :
+            block = os.pread( fout, min( 8 << 20, offset + length - pos ), pos )
+            check.update( block )
+            pos = pos + len( block )
+    finally :
+        os.close( fin )
+        os.close( fout )
+    if check.hexdigest() != digest.hexdigest() :
+        raise IOError( f"Checksum mismatch copying {src} to {dst} ( bytes {offset}-{offset + length} )" )
+
+    return digest.hexdigest()
+
+# -----------------------------------------------------------------------------
+def stage( sources, dest, workers=8, chunk_size=64 << 20, printf=True ) :
+    """
+    Copy files and directories to a destination directory, in parallel chunks.
+
+    Each chunk is verified with an md5 checksum. The files whose source has 
+    the same size and modification time as at their last copy ( recorded in 
+    'dest/.cp_stage.json' ) are skipped. Concurrent calls with the same 
+    destination ( e.g. the array tasks on the same node ) are serialized 
+    with a file lock, so that the files are copied only once.
+
+    Args:
+        - sources (list or dict): The paths to copy, or a dict mapping them to their names in 'dest'.
+        - dest (str): The destination directory.
+        - workers (int, optional): The number of chunks copied at the same time. Defaults to 8.
+        - chunk_size (int, optional): The size in bytes of the chunks. Defaults to 64 MB.
+        - printf (bool, optional): Whether to print a summary. Defaults to True.
+
+    Returns:
+        dict: The number of files copied and skipped, the bytes copied and the time spent.
+    """
+
+    import fcntl
+
+    t0 = Time.time()
+    if not isinstance( sources, dict ) :
+        sources = { src: os.path.basename( os.path.normpath( src ) ) for src in sources }
+    os.makedirs( dest, exist_ok=True )
+
+    lock = open( dest +s+ ".cp_stage.lock", "a" )
+    fcntl.lockf( lock, fcntl.LOCK_EX )
+    try :
+        manifest = {}
+        if os.path.exists( dest +s+ ".cp_stage.json" ) :
+            with open( dest +s+ ".cp_stage.json", "r" ) as fj :
+                manifest = json.load( fj )
+
+        # The files to copy ( the directories are expanded )
+        files = []
+        for src, name in sources.items() :
+            if os.path.isdir( src ) :
+                for root, _, fnames in os.walk( src ) :
+                    for fname in fnames :
+                        full = os.path.join( root, fname )
+                        files.append( ( full, os.path.join( name, os.path.relpath( full, src ) ) ) )
+            else :
+                files.append( ( src, name ) )
+
+        chunks = []
+        copied = []
+        skipped = 0
+        nbytes = 0
+        for src, rel in files :
+            st = os.stat( src )
+            dst = dest +s+ rel
+            entry = manifest.get( rel )
+            if entry is not None and entry[ "size" ] == st.st_size and entry[ "mtime" ] == st.st_mtime_ns \
+               and os.path.exists( dst ) and os.path.getsize( dst ) == st.st_size :
+                skipped = skipped + 1
+                continue
+            os.makedirs( os.path.dirname( dst ), exist_ok=True )
+            with open( dst, "wb" ) as fb :
+                fb.truncate( st.st_size )
+            n = len( chunks )
+            chunks.extend( ( src, dst, off, min( chunk_size, st.st_size - off ) ) 
+                           for off in range( 0, st.st_size, chunk_size ) )
+            copied.append( ( src, rel, st, n, len( chunks ) ) )
+            nbytes = nbytes + st.st_size
+
+        # Copy all the chunks of all the files in parallel
+        with multiprocessing.pool.ThreadPool( max( 1, workers ) ) as tp :
+            digests = tp.map( _copy_chunk, chunks )
+
+        for src, rel, st, n0, n1 in copied :
+            os.utime( dest +s+ rel, ns=( st.st_atime_ns, st.st_mtime_ns ) )
+            manifest[ rel ] = { "size": st.st_size, "mtime": st.st_mtime_ns, "md5": digests[ n0:n1 ] }
+
+        with open( dest +s+ ".cp_stage.json.tmp", "w" ) as fj :
+            json.dump( manifest, fj )
+        os.replace( dest +s+ ".cp_stage.json.tmp", dest +s+ ".cp_stage.json" )
+    finally :
+        fcntl.lockf( lock, fcntl.LOCK_UN )
+        lock.close()
+
+    summary = { "copied": len( copied ), "skipped": skipped, "bytes": nbytes, "seconds": Time.time() - t0 }
+    if printf == True :
+        rate = nbytes / 1024 ** 2 / max( summary[ "seconds" ], 1e-9 )
+        print( f"stage -> {dest} : {len( copied )} files copied ( {nbytes / 1024 ** 2:.1f} MB, {rate:.1f} MB/s ), "
+               f"{skipped} unchanged" )
+
+    return summary
+
+# -----------------------------------------------------------------------------
+def staged( path ) :
+    """
+    Return the node-local copy of a file staged with 'stage_in' ( see 'create_sbatch_file' ),
+    or the path itself if it was not staged.
+
+    Args:
+        - path (str): The original path (or its name in the staging directory).
+
+    Returns:
+        str: The path to read.
+    """
+
+    stage_dir = os.environ.get( "CP_STAGE_DIR" )
+    if stage_dir is not None :
+        local = stage_dir +s+ os.path.basename( os.path.normpath( path ) )
+        if os.path.exists( local ) :
+            return local
+
+    return path
+
+# -----------------------------------------------------------------------------
+def _stage_lines( path, stage_in=None, stage_out=None, workers=8 ) :
+    """
+    Return the lines of the sbatch files staging data to and from the node-local storage (see 'stage').
+
+    Args:
+        - path (str): The job directory ( the default destination of 'stage_out' ).
+        - stage_in (list or dict, optional): The inputs. Defaults to None.
+        - stage_out (list or dict, optional): The outputs. Defaults to None.
+        - workers (int, optional): The number of parallel copies. Defaults to 8.
+
+    Returns:
+        - list: The lines.
+        - list: The commands to run when the job ends.
+    """
+
+    imports = "; ".join( [ "import sys" ] + _runtime_import_lines() )
+    python = shlex.quote( sys.executable )
+    lines = [ "# The node-local staging directory, shared by the array tasks on the same node",
+              "export CP_STAGE_DIR=${TMPDIR:-/tmp}/cp_stage_${SLURM_ARRAY_JOB_ID:-$SLURM_JOB_ID}" ]
+    exit_commands = []
+
+    if stage_out is not None :
+        # Each task writes its outputs in its own directory, so that it stages out only its own files
+        lines.append( "# The outputs of this task, staged out when it ends" )
+        lines.append( "export CP_STAGE_OUT=${CP_STAGE_DIR}_${SLURM_ARRAY_TASK_ID:-0}" )
+        lines.append( "mkdir -p \"$CP_STAGE_OUT\"" )
+
+    if stage_in is not None :
+        if not isinstance( stage_in, dict ) :
+            stage_in = { os.path.abspath( src ): os.path.basename( os.path.normpath( src ) ) for src in stage_in }
+        else :
+            stage_in = { os.path.abspath( src ): name for src, name in stage_in.items() }
+        code = f"{imports}; _cp.stage( {stage_in!r}, sys.argv[1], workers={workers} )"
+        lines.append( "# Stage in the inputs" )
+        lines.append( f"{python} -c {shlex.quote( code )} \"$CP_STAGE_DIR\" || exit 1" )
+
+    if stage_out is not None :
+        if not isinstance( stage_out, dict ) :
+            stage_out = { src: os.path.abspath( path ) for src in stage_out }
+        # One copy per destination directory
+        by_dest = {}
+        for src, dst in stage_out.items() :
+            by_dest.setdefault( os.path.abspath( dst ), [] ).append( src )
+        code = f"{imports}; import os; " + \
+               "; ".join( f"_cp.stage( {{ os.path.join( sys.argv[1], s ): s for s in {srcs!r} "
+                          f"if os.path.exists( os.path.join( sys.argv[1], s ) ) }}, {dst!r}, workers={workers} )"
+                          for dst, srcs in by_dest.items() )
+        # The outputs are staged out when the job ends ( also if it fails )
+        exit_commands.append( python + " -c " + shlex.quote( code ) + ' "$CP_STAGE_OUT"' )
+
+    return lines, exit_commands
+
+# -----------------------------------------------------------------------------
+def _purge_in_background( target ) :
+    """
+    Delete a directory tree in a detached process, so that the caller does not wait for it.
+    """
+
+    subprocess.Popen( [ "rm", "-rf", target ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                      start_new_session=True )
+
+# -----------------------------------------------------------------------------
+def _prepare_log_dir( path, log_dir, keep_logs=0 ) :
+    """
+    Prepare the log directory of a new run, without deleting the previous logs in place.
+
+    With 'keep_logs' equal to 0, the previous directory is renamed aside ( an O(1) operation )
+    and deleted in the background. Otherwise a new 'run_<time>' subdirectory is created,
+    linked as 'latest', and the runs beyond the 'keep_logs' most recent previous ones
+    are deleted in the background. The sbatch files refer to the logs through 'latest', 
+    so that their content does not change from a generation to the next (see 'incremental').
+
+    Args:
+        - path (str): The job directory.
+        - log_dir (str): The log directory, relative to 'path' ( e.g. "logs" ).
+        - keep_logs (int, optional): The number of previous runs whose logs are kept. Defaults to 0.
+
+    Returns:
+        str: The log directory of the new run, relative to 'path'.
+    """
+
+    if log_dir in ( "", "." ) :
+        return log_dir
+    full = os.path.join( path, log_dir )
+
+    if keep_logs == 0 :
+        if os.path.isdir( full ) and not os.path.islink( full ) :
+            old = full + f".old.{os.getpid()}.{Time.time_ns()}"
+            os.rename( full, old )
+            _purge_in_background( old )
+        os.makedirs( full, exist_ok=True )
+        return log_dir
+
+    os.makedirs( full, exist_ok=True )
+    runs = sorted( d for d in os.listdir( full ) if d.startswith( "run_" ) )
+    run = "run_" + Time.strftime( "%y%m%d_%H%M%S" )
+    while run in runs :
+        run = run + "_"
+    os.makedirs( full +s+ run )
+    for old in runs[ :max( 0, len( runs ) - keep_logs ) ] :
+        moved = full +s+ f".old.{old}.{Time.time_ns()}"
+        os.rename( full +s+ old, moved )
+        _purge_in_background( moved )
+
+    # The link to the most recent run
+    if os.path.islink( full +s+ "latest" ) :
+        os.remove( full +s+ "latest" )
+    if not os.path.exists( full +s+ "latest" ) :
+        os.symlink( run, full +s+ "latest" )
+
+    return os.path.join( log_dir, "latest" )
+
+# -----------------------------------------------------------------------------
+def _task_log_lines( log_dir, per_node=False ) :
+    """
+    Return the lines of the sbatch files capturing the output of a task and appending it,
+    when the task ends, to an aggregated log indexed by array task ID (see 'read_task_log').
+
+    The output is written to the node-local storage while the task runs, then appended
+    under a file lock, with one index line "array_id stream offset length exit_code" per stream.
+
+    Args:
+        - log_dir (str): The log directory, relative to the job directory.
+        - per_node (bool, optional): Whether each node writes its own log. Defaults to False.
+
+    Returns:
+        - list: The lines.
+        - list: The commands to run when the job ends.
+    """
+
+    name = "tasks.$(hostname -s)" if per_node else "tasks"
+    lines = [ "# Capture the output of the task, appended to the aggregated log when it ends",
+              f"_cp_log={log_dir}/{name}",
+              "_cp_tmp=${TMPDIR:-/tmp}/cp_log_${SLURM_JOB_ID:-$$}",
+              "exec 3>&1 4>&2 1>$_cp_tmp.out 2>$_cp_tmp.err",
+              "_cp_log_flush() {",
+              "    _cp_rc=$?",
+              "    exec 1>&3 2>&4",
+              "    (",
+              "        flock 9",
+              "        for _cp_st in out err ; do",
+              "            _cp_off=$(stat -c %s $_cp_log.log 2>/dev/null || echo 0)",
+              "            cat $_cp_tmp.$_cp_st >> $_cp_log.log",
+              "            echo \"${SLURM_ARRAY_TASK_ID:-0} $_cp_st $_cp_off $(stat -c %s $_cp_tmp.$_cp_st) $_cp_rc\" >> $_cp_log.idx",
+              "        done",
+              "    ) 9>> $_cp_log.lock",
+              "    rm -f $_cp_tmp.out $_cp_tmp.err",
+              "}" ]
+
+    return lines, [ "_cp_log_flush" ]
+
+# -----------------------------------------------------------------------------
+def task_log_index( log_dir ) :
+    """
+    Read the indices of the aggregated logs of a run (see 'create_sbatch_file', 'log_mode').
+
+    Args:
+        - log_dir (str): The log directory ( with 'keep_logs', the run subdirectory or 'latest' ).
+
+    Returns:
+        dict: For each array task ID, the list of ( log file, stream, offset, length, exit code )
+              of its outputs, in the order they were written ( resubmitted tasks have several ).
+    """
+
+    index = {}
+    for fname in sorted( os.listdir( log_dir ) ) :
+        if not ( fname.startswith( "tasks" ) and fname.endswith( ".idx" ) ) :
+            continue
+        log_file = log_dir +s+ fname[ :-len( ".idx" ) ] + ".log"
+        with open( log_dir +s+ fname, "r" ) as fi :
+            for line in fi :
+                fields = line.split()
+                if len( fields ) != 5 :
+                    continue
+                index.setdefault( int( fields[0] ), [] ).append(
+                    ( log_file, fields[1], int( fields[2] ), int( fields[3] ), int( fields[4] ) ) )
+
+    return index
+
+# -----------------------------------------------------------------------------
+def read_task_log( log_dir, array_id, stream="out", last=True ) :
+    """
+    Read the output of a single task from the aggregated logs, seeking directly to it.
+
+    Args:
+        - log_dir (str): The log directory ( with 'keep_logs', the run subdirectory or 'latest' ).
+        - array_id (int): The array task ID.
+        - stream (str, optional): "out" or "err". Defaults to "out".
+        - last (bool, optional): Whether to return only the last output of the task
+          ( e.g. of a resubmission ), instead of all of them. Defaults to True.
+
+    Returns:
+        str: The output ( an empty string if the task has not written anything yet ).
+    """
+
+    entries = [ e for e in task_log_index( log_dir ).get( int( array_id ), [] ) if e[1] == stream ]
+    if last and entries != [] :
+        entries = entries[ -1: ]
+
+    text = ""
+    for log_file, _, offset, length, _ in entries :
+        with open( log_file, "rb" ) as fl :
+            fl.seek( offset )
+            text = text + fl.read( length ).decode( errors="replace" )
+
+    return text
+
+# The name of the manifest of the generated job directories
+JOB_MANIFEST = ".cp_manifest.json"
+
+# The digest of this module, part of the inputs of every generated job
+_module_digest = None
+
+# -----------------------------------------------------------------------------
+def _load_job_manifest( path ) :
+    """
+    Read the manifest of a job directory ( an empty one if it does not exist ).
+    """
+
+    try :
+        with open( path +s+ JOB_MANIFEST, "r" ) as fj :
+            return json.load( fj )
+    except ( OSError, ValueError ) :
+        return { "inputs": None, "artifacts": {} }
+
+# -----------------------------------------------------------------------------
+def _save_job_manifest( path, manifest ) :
+    """
+    Write the manifest of a job directory atomically.
+    """
+
+    with open( path +s+ JOB_MANIFEST + ".tmp", "w" ) as fj :
+        json.dump( manifest, fj, indent=1 )
+    os.replace( path +s+ JOB_MANIFEST + ".tmp", path +s+ JOB_MANIFEST )
+
+# -----------------------------------------------------------------------------
+def _write_if_changed( file_name, content ) :
+    """
+    Write a generated file only if its content changed, recording its digest,
+    size and modification time in the manifest of its directory.
+
+    An unchanged file is recognized from the manifest ( digest, size and modification time )
+    without reading it, so that regenerating a job directory writes nothing.
+
+    Args:
+        - file_name (str): The path of the file.
+        - content (str or bytes): The content of the file.
+
+    Returns:
+        bool: Whether the file was written.
+    """
+
+    if isinstance( content, str ) :
+        content = content.encode()
+    digest = hashlib.sha1( content ).hexdigest()
+    path, name = os.path.split( file_name )
+    manifest = _load_job_manifest( path )
+    entry = manifest[ "artifacts" ].get( name )
+
+    if entry is not None and entry[ "sha1" ] == digest :
+        try :
+            st = os.stat( file_name )
+            if st.st_size == entry[ "size" ] and st.st_mtime_ns == entry[ "mtime" ] :
+                return False
+        except OSError :
+            pass
+
+    with open( file_name, "wb" ) as fw :
+        fw.write( content )
+    st = os.stat( file_name )
+    manifest[ "artifacts" ][ name ] = { "sha1": digest, "size": st.st_size, "mtime": st.st_mtime_ns }
+    _save_job_manifest( path, manifest )
+
+    return True
+
+# -----------------------------------------------------------------------------
+def _copy_if_changed( source, path ) :
+    """
+    Copy a file to a directory, unless the copy there has the same size and
+    modification time ( 'shutil.copy2' preserves it ), without reading either file.
+
+    Args:
+        - source (str): The path of the file.
+        - path (str): The destination directory.
+
+    Returns:
+        bool: Whether the file was copied.
+    """
+
+    dest = os.path.join( path, os.path.basename( source ) )
+    if os.path.abspath( dest ) == os.path.abspath( source ) :
+        return False
+    st = os.stat( source )
+    try :
+        dt = os.stat( dest )
+        if dt.st_size == st.st_size and dt.st_mtime_ns == st.st_mtime_ns :
+            return False
+    except OSError :
+        pass
+    shutil.copy2( source, dest )
+
+    return True
+
+# -----------------------------------------------------------------------------
+def _code_names( code ) :
+    """
+    Return the global and attribute names read by a code object and the code objects nested in it.
+    """
+
+    names = set( code.co_names )
+    for const in code.co_consts :
+        if isinstance( const, types.CodeType ) :
+            names = names | _code_names( const )
+
+    return names
+
+# -----------------------------------------------------------------------------
+def _digest_update( h, value, strict=False, _seen=None ) :
+    """
+    Add a value ( numbers, strings, containers, numpy arrays, functions ) to a hash.
+
+    Functions are identified by their code ( including the names it reads and the nested
+    code objects ), their defaults, their closure and the globals they read.
+
+    Args:
+        - h (hashlib object): The hash.
+        - value (any): The value.
+        - strict (bool, optional): Whether to raise a TypeError for the values that cannot be hashed
+          reliably, instead of hashing their 'repr'. Defaults to False.
+    """
+
+    _seen = set() if _seen is None else _seen
+
+    if value is None or isinstance( value, ( bool, int, float, complex, str, bytes ) ) :
+        h.update( f"{type( value ).__name__}:{value!r};".encode() )
+    elif isinstance( value, np.ndarray ) :
+        h.update( f"ndarray{value.dtype.str}{value.shape}".encode() )
+        if value.dtype.hasobject :
+            _digest_update( h, value.ravel().tolist(), strict, _seen )
+        else :
+            h.update( np.ascontiguousarray( value ).tobytes() )
+    elif isinstance( value, np.generic ) :
+        h.update( f"{value.dtype.str}".encode() + value.tobytes() )
+    elif isinstance( value, types.ModuleType ) :
+        h.update( f"module:{value.__name__}:{getattr( value, '__version__', '' )};".encode() )
+    elif isinstance( value, type ) or isinstance( value, types.BuiltinFunctionType ) :
+        # Classes and builtins are identified by their name
+        h.update( f"{type( value ).__name__}:{getattr( value, '__module__', '' )}."
+                  f"{getattr( value, '__qualname__', '' )};".encode() )
+    elif id( value ) in _seen :
+        # A recursive reference
+        h.update( b"seen;" )
+    elif isinstance( value, dict ) :
+        _seen.add( id( value ) )
+        h.update( f"dict{len( value )}".encode() )
+        for key in sorted( value, key=repr ) :
+            _digest_update( h, key, strict, _seen )
+            _digest_update( h, value[ key ], strict, _seen )
+    elif isinstance( value, ( list, tuple ) ) :
+        _seen.add( id( value ) )
+        h.update( f"{type( value ).__name__}{len( value )}".encode() )
+        for item in value :
+            _digest_update( h, item, strict, _seen )
+    elif isinstance( value, ( set, frozenset ) ) :
+        # The digests of the elements are sorted, their order being arbitrary
+        digests = []
+        for item in value :
+            hi = hashlib.sha1()
+            _digest_update( hi, item, strict, _seen )
+            digests.append( hi.hexdigest() )
+        h.update( f"{type( value ).__name__}{len( value )}".encode() + "".join( sorted( digests ) ).encode() )
+    elif isinstance( value, types.CodeType ) :
+        h.update( value.co_code )
+        _digest_update( h, [ value.co_names, value.co_varnames, value.co_freevars, value.co_consts ], 
+                        strict, _seen )
+    elif isinstance( value, types.FunctionType ) :
+        _seen.add( id( value ) )
+        code = value.__code__
+        _digest_update( h, code, strict, _seen )
+        _digest_update( h, [ value.__defaults__, value.__kwdefaults__ ], strict, _seen )
+        # The values captured by the closure
+        cells = []
+        for cell in value.__closure__ or () :
+            try :
+                cells.append( cell.cell_contents )
+            except ValueError :
+                cells.append( None )
+        _digest_update( h, cells, strict, _seen )
+        # The globals it reads
+        glob = value.__globals__
+        _digest_update( h, { name: glob[ name ] for name in _code_names( code ) if name in glob }, 
+                        strict, _seen )
+    elif isinstance( value, types.MethodType ) :
+        _digest_update( h, [ value.__func__, value.__self__ ], strict, _seen )
+    elif strict :
+        raise TypeError( f"A value of type '{type( value ).__name__}' cannot be hashed reliably." )
+    else :
+        h.update( repr( value ).encode() )
+
+# -----------------------------------------------------------------------------
+def _inputs_digest( kind, source, params ) :
+    """
+    Return the digest of the inputs of a job generation: the code, the arguments
+    of the call, the python environment and this module.
+
+    Args:
+        - kind (str): The generating function ( "parfor", "script2slurm" ).
+        - source (str): The python code.
+        - params (dict): The arguments of the call.
+
+    Returns:
+        str: The digest.
+    """
+
+    global _module_digest
+
+    if _module_digest is None :
+        with open( os.path.abspath( __file__ ), "rb" ) as fm :
+            _module_digest = hashlib.sha1( fm.read() ).hexdigest()
+
+    h = hashlib.sha1()
+    _digest_update( h, [ kind, source, _module_digest, sys.prefix, sys.version, is_cineca_system() ] )
+    _digest_update( h, { k: v for k, v in params.items() if k not in ( "run", "printf", "return_job" ) } )
+
+    return h.hexdigest()
+
+# -----------------------------------------------------------------------------
+def _unchanged_job( path, inputs ) :
+    """
+    Return the result of the last generation of a job directory if its inputs are the same
+    and its generated files are intact ( same size and modification time ), otherwise None.
+    """
+
+    manifest = _load_job_manifest( path )
+    if manifest.get( "inputs" ) != inputs or "result" not in manifest :
+        return None
+    for name, entry in manifest[ "artifacts" ].items() :
+        try :
+            st = os.stat( path +s+ name )
+        except OSError :
+            return None
+        if st.st_size != entry[ "size" ] or st.st_mtime_ns != entry[ "mtime" ] :
+            return None
+
+    return tuple( manifest[ "result" ] )
+
+# -----------------------------------------------------------------------------
+def _record_job( path, inputs, result ) :
+    """
+    Record the inputs and the result of a job generation in the manifest of its directory.
+    """
+
+    manifest = _load_job_manifest( path )
+    if manifest.get( "inputs" ) != inputs or manifest.get( "result" ) != list( result ) :
+        manifest[ "inputs" ] = inputs
+        manifest[ "result" ] = list( result )
+        _save_job_manifest( path, manifest )
+
+# -----------------------------------------------------------------------------
+def generate_many( jobs, function="parfor", workers=16, incremental=True, printf=True ) :
+    """
+    Generate many job directories in parallel with a thread pool, e.g. the directories of a sweep.
+
+    With 'incremental' ( the default ), the directories whose inputs did not change
+    are left untouched and, in the others, only the files that changed are written
+    (see the 'incremental' argument of 'parfor').
+
+    Args:
+        - jobs (list): The keyword arguments of each call ( each including 'path' ).
+        - function (str or callable, optional): "parfor", "script2slurm" or a function
+          with the same interface. Defaults to "parfor".
+        - workers (int, optional): The number of threads. Defaults to 16.
+        - incremental (bool, optional): Whether to skip the unchanged job directories. Defaults to True.
+        - printf (bool, optional): Whether to print a summary. Defaults to True.
+
+    Returns:
+        list: The results of the calls, in the order of 'jobs'.
+    """
+
+    if isinstance( function, str ) :
+        function = { "parfor": parfor, "script2slurm": script2slurm }[ function ]
+
+    def generate( kwargs ) :
+        kwargs = dict( kwargs )
+        kwargs.setdefault( "incremental", incremental )
+        manifest = kwargs[ "path" ] +s+ JOB_MANIFEST
+        before = os.stat( manifest ).st_mtime_ns if os.path.exists( manifest ) else None
+        result = function( **kwargs )
+        after = os.stat( manifest ).st_mtime_ns if os.path.exists( manifest ) else None
+        return result, ( before is not None and before == after )
+
+    t0 = Time.time()
+    with multiprocessing.pool.ThreadPool( max( 1, min( workers, len( jobs ) ) ) ) as tp :
+        outcomes = tp.map( generate, jobs )
+
+    if printf == True :
+        unchanged = sum( 1 for _, same in outcomes if same )
+        print( f"generate_many : {len( jobs ) - unchanged} job directories written, "
+               f"{unchanged} unchanged ( {Time.time() - t0:.1f} s )" )
+
+    return [ result for result, _ in outcomes ]
+
+# -----------------------------------------------------------------------------
+def parse_sbatch( file_name ) :
+    """
+    Read the '#SBATCH' directives of an sbatch file.
+
+    Both the '--option=value' and the '--option value' forms are accepted,
+    and trailing comments are ignored.
+
+    Args:
+        - file_name (str): The path of the sbatch file.
+
+    Returns:
+        dict: The options (without the leading dashes) and their values.
+    """
+
+    options = {}
+    with open( file_name, "r" ) as f :
+        for line in f :
+            if not line.startswith( "#SBATCH" ) :
+                continue
+            directive = line[ len( "#SBATCH" ): ].split( "#" )[0].strip()
+            if not directive.startswith( "-" ) :
+                continue
+            if "=" in directive.split()[0] :
+                key, value = directive.split( "=", 1 )
+            else :
+                key, _, value = directive.partition( " " )
+            options[ key.lstrip( "-" ) ] = value.strip()
+
+    return options
+
+# -----------------------------------------------------------------------------
+def _slurm_mem( mem ) :
+    """
+    Convert a SLURM memory specification ( e.g. "50000", "4G", "512M" ) to MB.
+
+    Args:
+        - mem (str or int): The memory specification (MB if no unit is given).
+
+    Returns:
+        float: The memory in MB.
+    """
+
+    mem = str( mem ).strip().upper()
+    units = { "K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 ** 2 }
+    if mem and mem[-1] in units :
+        return float( mem[ :-1 ] ) * units[ mem[-1] ]
+
+    return float( mem )
+
+# -----------------------------------------------------------------------------
+def _slurm_time( time ) :
+    """
+    Convert a SLURM time limit ( "MM", "MM:SS", "HH:MM:SS", "D-HH", "D-HH:MM", "D-HH:MM:SS" ) 
+    to seconds.
+
+    Args:
+        - time (str): The time limit.
+
+    Returns:
+        float: The time limit in seconds ( None for "UNLIMITED" ).
+    """
+
+    time = str( time ).strip()
+    if time.upper() in ( "UNLIMITED", "INFINITE", "" ) :
+        return None
+
+    days = 0
+    if "-" in time :
+        days, time = time.split( "-", 1 )
+        fields = [ int( v ) for v in time.split( ":" ) ]
+        # With days, the first field is always hours
+        fields = fields + [ 0 ] * ( 3 - len( fields ) )
+    else :
+        fields = [ int( v ) for v in time.split( ":" ) ]
+        # Without days, a single field is minutes, two fields are minutes and seconds
+        fields = { 1: [ 0, fields[0], 0 ], 2: [ 0 ] + fields }.get( len( fields ), fields )
+    hours, minutes, seconds = fields[ :3 ]
+
+    return float( ( ( int( days ) * 24 + hours ) * 60 + minutes ) * 60 + seconds )
+
+# -----------------------------------------------------------------------------
+def _array_ids( array ) :
+    """
+    Expand the task IDs of an sbatch '--array' specification, e.g. "1-10", "1,3,5-7",
+    "0-20:4" or "1-100%10" (the throttle is returned separately).
+
+    Args:
+        - array (str): The array specification.
+
+    Returns:
+        - list: The task IDs.
+        - int: The maximum number of simultaneously running tasks ( None if not specified ).
+    """
+
+    array = str( array )
+    throttle = None
+    if "%" in array :
+        array, throttle = array.split( "%" )
+        throttle = int( throttle )
+
+    ids = []
+    for part in array.split( "," ) :
+        step = 1
+        if ":" in part :
+            part, step = part.split( ":" )
+            step = int( step )
+        if "-" in part :
+            a, b = part.split( "-" )
+            ids.extend( range( int( a ), int( b ) + 1, step ) )
+        elif part.strip() :
+            ids.append( int( part ) )
+
+    return ids, throttle
+
+# -----------------------------------------------------------------------------
+class LocalTask :
+    """
+    Handle of a task run by a 'LocalExecutor', with the same information 
+    SLURM gives about a job (or job-array element).
+
+    Attributes:
+        - job_id (int): The job ID ( the array job ID for job arrays ).
+        - array_id (int): The array task ID ( None for plain jobs ).
+        - state (str): "PENDING", "RUNNING", "COMPLETED", "FAILED", "TIMEOUT", "OUT_OF_MEMORY" or "CANCELLED".
+        - returncode (int): The exit code of the task ( None until it ends ).
+        - submit_time, start_time, end_time (float): The timestamps of the task.
+    """
+
+    def __init__( self, job_id, array_id, file_name, options, cwd ) :
+
+        self.job_id = job_id
+        self.array_id = array_id
+        self.file_name = file_name
+        self.options = options
+        self.cwd = cwd
+        self.state = "PENDING"
+        self.returncode = None
+        self.submit_time = Time.time()
+        self.start_time = None
+        self.end_time = None
+        self.process = None
+        self.cores = []
+        self.ncpus = int( options.get( "ntasks", 1 ) ) * int( options.get( "cpus-per-task", 1 ) )
+        self.mem = _slurm_mem( options[ "mem" ] ) if "mem" in options else None
+        self.time_limit = _slurm_time( options[ "time" ] ) if "time" in options else None
+        # The signal sent before the time limit ( '--signal=[B:]SIG@seconds' )
+        self.signal = None
+        if "signal" in options :
+            spec, _, before = options[ "signal" ].partition( "@" )
+            batch, _, name = spec.rpartition( ":" )
+            self.signal = ( getattr( signal, "SIG" + name.upper().replace( "SIG", "" ) ), 
+                            float( before or 60 ), "B" in batch )
+        self._done = threading.Event()
+
+    def __repr__( self ) :
+
+        name = f"{self.job_id}" if self.array_id is None else f"{self.job_id}_{self.array_id}"
+        return f"LocalTask({name}, {self.state}, returncode={self.returncode})"
+
+    @property
+    def elapsed( self ) :
+        """
+        The run time of the task in seconds ( up to now, if it is still running ).
+        """
+
+        if self.start_time is None :
+            return 0.0
+        return ( self.end_time or Time.time() ) - self.start_time
+
+    @property
+    def wait_time( self ) :
+        """
+        The time in seconds the task waited for free resources.
+        """
+
+        return ( self.start_time or Time.time() ) - self.submit_time
+
+    def done( self ) :
+
+        return self._done.is_set()
+
+    def wait( self, timeout=None ) :
+        """
+        Wait for the task to end.
+
+        Args:
+            - timeout (float, optional): The maximum waiting time in seconds. Defaults to None.
+
+        Returns:
+            int: The exit code of the task ( None if the timeout expired ).
+        """
+
+        self._done.wait( timeout )
+        return self.returncode
+
+# -----------------------------------------------------------------------------
+class LocalExecutor :
+    """
+    Run sbatch files (and job arrays) on the local machine, emulating SLURM.
+
+    Each task gets the SLURM environment variables ( SLURM_JOB_ID, 
+    SLURM_ARRAY_TASK_ID, SLURM_CPUS_PER_TASK, ... ), its '--out'/'--err' files
+    and a set of free cores it is pinned to. The tasks are started as soon 
+    as enough cores and memory are free (event driven, without polling), 
+    in submission order, and are killed if they exceed their '--mem' 
+    (resident memory of the whole process tree) or '--time' limits.
+
+    Args:
+        - cpus (int, optional): The number of cores available. Defaults to None (all the usable cores).
+        - mem (float, optional): The memory available in MB. Defaults to None (the total memory).
+        - poll (float, optional): The interval in seconds of the memory and time checks. Defaults to 0.5.
+    """
+
+    def __init__( self, cpus=None, mem=None, poll=0.5 ) :
+
+        if hasattr( os, "sched_getaffinity" ) :
+            cores = sorted( os.sched_getaffinity( 0 ) )
+        else :
+            cores = list( range( os.cpu_count() ) )
+        self.free_cores = cores[ :cpus ] if cpus is not None else cores
+        self.cpus = len( self.free_cores )
+        self.mem = mem if mem is not None else psutil.virtual_memory().total / 1024 ** 2
+        self.free_mem = self.mem
+        self.poll = poll
+        self.pending = []
+        self.running = []
+        self.tasks = []
+        self.throttles = {}
+        self.next_job_id = 1
+        self.lock = threading.Condition()
+        self.closed = False
+        threading.Thread( target=self._schedule, daemon=True ).start()
+        threading.Thread( target=self._monitor, daemon=True ).start()
+
+    def submit( self, file_name, array=None, env=None, cwd=None, after=[] ) :
+        """
+        Submit an sbatch file, like 'sbatch [--array=array] [--dependency=...] file_name'.
+
+        Args:
+            - file_name (str): The path of the sbatch file.
+            - array (str, optional): The array specification ( e.g. "1-10" ). Defaults to None, 
+              i.e. the '--array' directive of the file, if any.
+            - env (dict, optional): Additional environment variables. Defaults to None.
+            - cwd (str, optional): The working directory of the tasks. Defaults to None, 
+              i.e. the directory of the sbatch file.
+            - after (list, optional): The dependencies, as ( tasks, per_element ) pairs, where 'tasks' are
+              the handles of an upstream job. With 'per_element' False the tasks wait for all the upstream 
+              tasks ( 'afterok' ), otherwise each task waits for the upstream task with the same array ID 
+              ( 'aftercorr' ). If an upstream task does not complete, the tasks depending on it are cancelled.
+              Defaults to [].
+
+        Returns:
+            list: The 'LocalTask' handles ( a single one for plain jobs ).
+        """
+
+        file_name = os.path.abspath( file_name )
+        options = parse_sbatch( file_name )
+        if array is None :
+            array = options.get( "array" )
+        cwd = cwd or options.get( "chdir" ) or os.path.dirname( file_name )
+
+        with self.lock :
+            job_id = self.next_job_id
+            self.next_job_id = self.next_job_id + 1
+            if array is None :
+                ids, throttle = [ None ], None
+            else :
+                ids, throttle = _array_ids( array )
+            tasks = [ LocalTask( job_id, i, file_name, options, cwd ) for i in ids ]
+            for task in tasks :
+                task.env = dict( env or {} )
+                task.array_ids = ids
+                task.deps = []
+                for upstream, per_element in after :
+                    task.deps.extend( [ t for t in upstream if not per_element or t.array_id == task.array_id ] )
+                # Requests larger than the machine come from files sized for the cluster nodes
+                # ( e.g. the default 'mem=50000' ): the CPUs are reduced to the whole machine,
+                # the memory is neither reserved nor enforced
+                task.ncpus = min( task.ncpus, self.cpus )
+                if task.mem is not None and task.mem > self.mem :
+                    task.mem = None
+            self.throttles[ job_id ] = throttle
+            self.pending.extend( tasks )
+            self.tasks.extend( tasks )
+            self.lock.notify_all()
+
+        return tasks
+
+    def _fits( self, task ) :
+
+        # "held" tasks wait for their dependencies or throttle, without blocking the later tasks
+        if any( not dep.done() for dep in task.deps ) :
+            return "held"
+        throttle = self.throttles.get( task.job_id )
+        if throttle is not None and \
+           sum( 1 for t in self.running if t.job_id == task.job_id ) >= throttle :
+            return "held"
+        if task.ncpus > len( self.free_cores ) :
+            return "resources"
+        if task.mem is not None and task.mem > self.free_mem :
+            return "resources"
+        return "ok"
+
+    def _start( self, task ) :
+
+        task.cores = self.free_cores[ :task.ncpus ]
+        self.free_cores = self.free_cores[ task.ncpus: ]
+        if task.mem is not None :
+            self.free_mem = self.free_mem - task.mem
+
+        # The environment SLURM gives to the tasks
+        env = dict( os.environ )
+        env.update( { "SLURM_JOB_ID": str( task.job_id ),
+                      "SLURM_JOBID": str( task.job_id ),
+                      "SLURM_CPUS_PER_TASK": task.options.get( "cpus-per-task", "1" ),
+                      "SLURM_NTASKS": task.options.get( "ntasks", "1" ),
+                      "SLURM_JOB_NUM_NODES": "1",
+                      "SLURM_SUBMIT_DIR": task.cwd,
+                      "SLURM_JOB_NAME": os.path.basename( task.file_name ),
+                      "SLURM_LOCAL_EXECUTOR": "1" } )
+        if task.array_id is not None :
+            env.update( { "SLURM_ARRAY_JOB_ID": str( task.job_id ),
+                          "SLURM_ARRAY_TASK_ID": str( task.array_id ),
+                          "SLURM_ARRAY_TASK_COUNT": str( len( task.array_ids ) ),
+                          "SLURM_ARRAY_TASK_MIN": str( min( task.array_ids ) ),
+                          "SLURM_ARRAY_TASK_MAX": str( max( task.array_ids ) ) } )
+        env.update( task.env )
+
+        # The output files, with the SLURM filename patterns
+        def output( pattern, default ) :
+            pattern = task.options.get( pattern, default )
+            for key, value in ( ( "%A", task.job_id ), ( "%a", task.array_id ), 
+                                ( "%j", task.job_id ), ( "%x", env[ "SLURM_JOB_NAME" ] ) ) :
+                pattern = pattern.replace( key, str( value ) )
+            pattern = os.path.join( task.cwd, pattern )
+            os.makedirs( os.path.dirname( pattern ), exist_ok=True )
+            return open( pattern, "a" )
+
+        default = "slurm-%A_%a.out" if task.array_id is not None else "slurm-%j.out"
+        stdout = output( "out", default ) if "out" in task.options else output( "output", default )
+        stderr = output( "err", default ) if "err" in task.options else \
+                 ( output( "error", default ) if "error" in task.options else stdout )
+
+        # Pin the task to its cores
+        cores = task.cores
+        def preexec() :
+            if hasattr( os, "sched_setaffinity" ) :
+                os.sched_setaffinity( 0, cores )
+
+        task.start_time = Time.time()
+        task.state = "RUNNING"
+        task.process = subprocess.Popen( [ "bash", task.file_name ], cwd=task.cwd, env=env,
+                                         stdout=stdout, stderr=stderr, 
+                                         preexec_fn=preexec, start_new_session=True )
+        stdout.close()
+        if stderr is not stdout :
+            stderr.close()
+        self.running.append( task )
+        threading.Thread( target=self._wait, args=( task, ), daemon=True ).start()
+
+    def _wait( self, task ) :
+
+        # Wait for the process, then release its resources
+        returncode = task.process.wait()
+        with self.lock :
+            task.end_time = Time.time()
+            task.returncode = returncode
+            if task.state == "RUNNING" :
+                task.state = "COMPLETED" if returncode == 0 else "FAILED"
+            self.running.remove( task )
+            self.free_cores = sorted( self.free_cores + task.cores )
+            if task.mem is not None :
+                self.free_mem = self.free_mem + task.mem
+            task._done.set()
+            self.lock.notify_all()
+
+    def _schedule( self ) :
+
+        # Start the pending tasks, in order, as soon as they fit
+        with self.lock :
+            while not self.closed :
+                started = True
+                while started :
+                    started = False
+                    for task in list( self.pending ) :
+                        # A task whose dependencies failed can never run ( 'DependencyNeverSatisfied' )
+                        if any( dep.done() and dep.state != "COMPLETED" for dep in task.deps ) :
+                            self.pending.remove( task )
+                            task.state = "CANCELLED"
+                            task._done.set()
+                            started = True
+                            break
+                        fits = self._fits( task )
+                        if fits == "ok" :
+                            self.pending.remove( task )
+                            self._start( task )
+                            started = True
+                            break
+                        # Later tasks do not overtake the first one that does not fit
+                        if fits == "resources" :
+                            break
+                self.lock.wait()
+
+    def _kill( self, task, state ) :
+
+        task.state = state
+        try :
+            os.killpg( task.process.pid, signal.SIGKILL )
+        except ( ProcessLookupError, PermissionError ) :
+            pass
+
+    def _monitor( self ) :
+
+        # Enforce the memory and time limits of the running tasks
+        while not self.closed :
+            Time.sleep( self.poll )
+            with self.lock :
+                running = list( self.running )
+            for task in running :
+                if task.state != "RUNNING" :
+                    continue
+                if task.time_limit is not None and task.elapsed > task.time_limit :
+                    self._kill( task, "TIMEOUT" )
+                    continue
+                if task.signal is not None and task.time_limit is not None and \
+                   task.elapsed > task.time_limit - task.signal[1] :
+                    signum, _, batch = task.signal
+                    task.signal = None
+                    try :
+                        if batch :
+                            os.kill( task.process.pid, signum )
+                        else :
+                            os.killpg( task.process.pid, signum )
+                    except ( ProcessLookupError, PermissionError ) :
+                        pass
+                if task.mem is not None :
+                    try :
+                        proc = psutil.Process( task.process.pid )
+                        rss = sum( p.memory_info().rss for p in [ proc ] + proc.children( recursive=True ) )
+                    except psutil.Error :
+                        continue
+                    if rss > task.mem * 1024 ** 2 :
+                        self._kill( task, "OUT_OF_MEMORY" )
+
+    def cancel( self, tasks=None ) :
+        """
+        Cancel pending and running tasks, like 'scancel'.
+
+        Args:
+            - tasks (list, optional): The tasks to be cancelled. Defaults to None (all the tasks).
+        """
+
+        with self.lock :
+            for task in list( tasks if tasks is not None else self.tasks ) :
+                if task in self.pending :
+                    self.pending.remove( task )
+                    task.state = "CANCELLED"
+                    task._done.set()
+                elif task in self.running :
+                    self._kill( task, "CANCELLED" )
+            self.lock.notify_all()
+
+    def wait( self, tasks=None ) :
+        """
+        Wait for the tasks to end.
+
+        Args:
+            - tasks (list, optional): The tasks to wait for. Defaults to None (all the tasks).
+
+        Returns:
+            list: The tasks.
+        """
+
+        tasks = list( tasks if tasks is not None else self.tasks )
+        for task in tasks :
+            task.wait()
+
+        return tasks
+
+    def shutdown( self, cancel=False ) :
+        """
+        Stop the executor, after waiting for (or cancelling) its tasks.
+
+        Args:
+            - cancel (bool, optional): Whether to cancel the tasks instead of waiting for them. Defaults to False.
+        """
+
+        if cancel :
+            self.cancel()
+        self.wait()
+        with self.lock :
+            self.closed = True
+            self.lock.notify_all()
+
+# The executor shared by 'run_local'
+_local_executor = None
+
+# -----------------------------------------------------------------------------
+def run_local( file_name, array=None, env=None, cpus=None, mem=None, after=[] ) :
+    """
+    Run an sbatch file (or job array) on the local machine, with a 'LocalExecutor'
+    shared by all the calls, so that concurrent jobs share the same cores and memory.
+
+    Args:
+        - file_name (str): The path of the sbatch file.
+        - array (str, optional): The array specification ( e.g. "1-10" ). Defaults to None.
+        - env (dict, optional): Additional environment variables. Defaults to None.
+        - cpus (int, optional): The cores of the shared executor ( used only when it is created ). 
+          Defaults to None (all the usable cores).
+        - mem (float, optional): The memory in MB of the shared executor ( used only when it is created ). 
+          Defaults to None (the total memory).
+        - after (list, optional): The dependencies ( see 'LocalExecutor.submit' ). Defaults to [].
+
+    Returns:
+        list: The 'LocalTask' handles.
+    """
+
+    global _local_executor
+
+    if _local_executor is None :
+        _local_executor = LocalExecutor( cpus=cpus, mem=mem )
+
+    return _local_executor.submit( file_name, array=array, env=env, after=after )
+
+# The SLURM commands used to submit and monitor the jobs
+# ( they can be replaced, e.g. by stand-ins for testing or by wrappers running them through ssh )
+SLURM_COMMANDS = { "sbatch": "sbatch", 
+                   "squeue": "squeue", 
+                   "sacct": "sacct", 
+                   "scancel": "scancel" }
+
+# The SLURM states of the jobs that have ended
+# ( "ENDED" is used when a job left the queue and no accounting information is available )
+SLURM_FINAL_STATES = { "COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", 
+                       "NODE_FAIL", "PREEMPTED", "BOOT_FAIL", "DEADLINE", "ENDED" }
+
+# -----------------------------------------------------------------------------
+def _parse_job_id( job_id ) :
+    """
+    Split a job ID printed by squeue/sacct ( e.g. "123", "123_4", "123_[5-10%2]" ) 
+    into the job ID and the array task IDs.
+
+    Args:
+        - job_id (str): The job ID.
+
+    Returns:
+        - int: The job ID.
+        - list: The array task IDs ( [None] for plain jobs ).
+    """
+
+    job_id = job_id.split( "." )[0]
+    if "_" not in job_id :
+        return int( job_id ), [ None ]
+    job_id, array = job_id.split( "_", 1 )
+    ids, _ = _array_ids( array.strip( "[]" ) )
+
+    return int( job_id ), ids
+
+# -----------------------------------------------------------------------------
+class SlurmJob :
+    """
+    Handle of a job (or job array) submitted with 'submit'.
+
+    The states of the job (and of its array tasks) are updated by a 'SlurmMonitor',
+    which checks all the jobs it tracks with a single squeue/sacct call per interval.
+
+    Attributes:
+        - job_id (int): The job ID.
+        - array_ids (list): The array task IDs ( None for plain jobs ).
+        - file_name (str): The path of the sbatch file.
+        - states (dict): The state of each array task ( a single None key for plain jobs ).
+    """
+
+    def __init__( self, job_id, file_name=None, array_ids=None, monitor=None ) :
+
+        self.job_id = int( job_id )
+        self.file_name = file_name
+        self.array_ids = array_ids
+        self.states = { i: "PENDING" for i in ( array_ids if array_ids is not None else [ None ] ) }
+        self.monitor = monitor
+        self.callbacks = []
+
+    def __repr__( self ) :
+
+        return f"SlurmJob({self.job_id}, {self.state})"
+
+    @property
+    def state( self ) :
+        """
+        The state of the whole job: "PENDING" or "RUNNING" while some tasks have not ended,
+        then "COMPLETED" if all the tasks completed, or the state of the first task that did not.
+        """
+
+        states = list( self.states.values() )
+        if any( st not in SLURM_FINAL_STATES for st in states ) :
+            return "RUNNING" if "RUNNING" in states else "PENDING"
+        for st in states :
+            if st != "COMPLETED" :
+                return st
+
+        return "COMPLETED"
+
+    def done( self ) :
+
+        return self.state in SLURM_FINAL_STATES
+
+    def add_callback( self, func ) :
+        """
+        Call 'func( job, array_id, old_state, new_state )' at each state change of the job's tasks.
+
+        Args:
+            - func (callable): The callback.
+        """
+
+        self.callbacks.append( func )
+
+    def _set_state( self, array_id, state ) :
+
+        old = self.states.get( array_id )
+        if old == state or old in SLURM_FINAL_STATES :
+            return
+        self.states[ array_id ] = state
+        for func in self.callbacks :
+            func( self, array_id, old, state )
+
+    async def wait( self ) :
+        """
+        Wait for the job to end ( 'await job.wait()' ).
+
+        Returns:
+            str: The final state of the job.
+        """
+
+        monitor = self.monitor or default_monitor()
+        monitor.add( self )
+        while not self.done() :
+            await monitor.tick()
+
+        return self.state
+
+    def cancel( self ) :
+        """
+        Cancel the job with scancel.
+        """
+
+        subprocess.run( SLURM_COMMANDS[ "scancel" ].split() + [ str( self.job_id ) ], 
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+
+# -----------------------------------------------------------------------------
+async def _run_command( *args ) :
+    """
+    Run a command asynchronously and return its standard output ( None if it fails ).
+    """
+
+    try :
+        proc = await asyncio.create_subprocess_exec( *args, stdout=asyncio.subprocess.PIPE, 
+                                                     stderr=asyncio.subprocess.DEVNULL )
+    except OSError :
+        return None
+    out, _ = await proc.communicate()
+    if proc.returncode != 0 :
+        return None
+
+    return out.decode()
+
+# -----------------------------------------------------------------------------
+class SlurmMonitor :
+    """
+    Track the states of many SLURM jobs, with one batched squeue call per interval
+    ( plus one sacct call for the tasks that left the queue ), shared by all 
+    the coroutines waiting on the jobs.
+
+    Args:
+        - interval (float, optional): The seconds between two checks. Defaults to 10.
+    """
+
+    def __init__( self, interval=10.0 ) :
+
+        self.interval = interval
+        self.jobs = {}
+        self._round = None
+        self._seen = set()
+
+    def add( self, job ) :
+        """
+        Track a job.
+
+        Args:
+            - job (SlurmJob): The job.
+        """
+
+        self.jobs[ job.job_id ] = job
+
+    async def poll( self ) :
+        """
+        Update the states of all the tracked jobs that have not ended.
+        """
+
+        active = [ job for job in self.jobs.values() if not job.done() ]
+        if active == [] :
+            return
+        ids = ",".join( str( job.job_id ) for job in active )
+
+        # The jobs in the queue
+        queued = set()
+        out = await _run_command( *SLURM_COMMANDS[ "squeue" ].split(), "-h", "-o", "%i %T", "-j", ids )
+        for line in ( out or "" ).splitlines() :
+            if len( line.split() ) < 2 :
+                continue
+            job_id, array_ids = _parse_job_id( line.split()[0] )
+            if job_id not in self.jobs :
+                continue
+            for i in array_ids :
+                self.jobs[ job_id ]._set_state( i, line.split()[1] )
+                queued.add( ( job_id, i ) )
+        self._seen.update( queued )
+
+        # The tasks that are not in the queue (anymore) are looked up in the accounting
+        gone = [ job for job in active 
+                 if any( ( job.job_id, i ) not in queued for i, st in job.states.items() 
+                         if st not in SLURM_FINAL_STATES ) ]
+        if gone == [] :
+            return
+        out = await _run_command( *SLURM_COMMANDS[ "sacct" ].split(), "-n", "-P", "-X", 
+                                  "-o", "JobID,State", "-j", ",".join( str( job.job_id ) for job in gone ) )
+        for line in ( out or "" ).splitlines() :
+            if "|" not in line :
+                continue
+            job_id, state = line.split( "|" )[ :2 ]
+            job_id, array_ids = _parse_job_id( job_id )
+            if job_id not in self.jobs :
+                continue
+            for i in array_ids :
+                if ( job_id, i ) not in queued :
+                    # e.g. "CANCELLED by 1234"
+                    self.jobs[ job_id ]._set_state( i, state.split()[0] )
+
+        # Without accounting, the tasks that were seen in the queue and left it have ended
+        if out is None :
+            for job in gone :
+                for i in list( job.states ) :
+                    if ( job.job_id, i ) in self._seen and ( job.job_id, i ) not in queued :
+                        job._set_state( i, "ENDED" )
+
+    async def _poll_round( self ) :
+
+        await self.poll()
+        await asyncio.sleep( self.interval )
+
+    async def tick( self ) :
+        """
+        Wait for the next check of the jobs ( all the waiting coroutines share the same check ).
+        """
+
+        loop = asyncio.get_running_loop()
+        if self._round is None or self._round.done() or self._round.get_loop() is not loop :
+            self._round = loop.create_task( self._poll_round() )
+        await asyncio.shield( self._round )
+
+    async def as_completed( self, jobs ) :
+        """
+        Yield the jobs as they end ( 'async for job in monitor.as_completed( jobs )' ).
+
+        Args:
+            - jobs (list): The jobs.
+        """
+
+        pending = list( jobs )
+        for job in pending :
+            self.add( job )
+        while pending != [] :
+            for job in [ job for job in pending if job.done() ] :
+                pending.remove( job )
+                yield job
+            if pending != [] :
+                await self.tick()
+
+# The monitor shared by the jobs submitted without an explicit one
+_slurm_monitor = None
+
+# -----------------------------------------------------------------------------
+def default_monitor() :
+    """
+    Return the 'SlurmMonitor' shared by the jobs submitted without an explicit monitor.
+    """
+
+    global _slurm_monitor
+
+    if _slurm_monitor is None :
+        _slurm_monitor = SlurmMonitor()
+
+    return _slurm_monitor
+
+# -----------------------------------------------------------------------------
+def as_completed( jobs, monitor=None ) :
+    """
+    Yield the jobs as they end ( 'async for job in as_completed( jobs )' ).
+
+    Args:
+        - jobs (list): The jobs.
+        - monitor (SlurmMonitor, optional): The monitor. Defaults to None (the shared one).
+    """
+
+    return ( monitor or default_monitor() ).as_completed( jobs )
+
+# -----------------------------------------------------------------------------
+def wait_jobs( jobs, monitor=None ) :
+    """
+    Block until all the jobs end ( for code that does not run an asyncio event loop ).
+
+    Args:
+        - jobs (list): The jobs.
+        - monitor (SlurmMonitor, optional): The monitor. Defaults to None (the shared one).
+
+    Returns:
+        list: The final states of the jobs.
+    """
+
+    jobs = list( jobs )
+    for job in jobs :
+        if monitor is not None :
+            job.monitor = monitor
+
+    async def main() :
+        return await asyncio.gather( *[ job.wait() for job in jobs ] )
+
+    return list( asyncio.run( main() ) )
+
+# -----------------------------------------------------------------------------
+def submit( file_name, array=None, options=[], monitor=None ) :
+    """
+    Submit an sbatch file with 'sbatch --parsable' and return the job handle.
+
+    Args:
+        - file_name (str): The path of the sbatch file.
+        - array (str, optional): The array specification ( e.g. "1-10" ). Defaults to None, 
+          i.e. the '--array' directive of the file, if any.
+        - options (list, optional): Other sbatch options ( e.g. ["--dependency=afterok:123"] ). Defaults to [].
+        - monitor (SlurmMonitor, optional): The monitor of the job. Defaults to None (the shared one).
+
+    Returns:
+        SlurmJob: The job handle.
+    """
+
+    cmd = SLURM_COMMANDS[ "sbatch" ].split() + [ "--parsable" ] + list( options )
+    if array is not None :
+        cmd.append( f"--array={array}" )
+    cmd.append( file_name )
+
+    # The submission is run in the directory of the file, as 'cd path && sbatch file'
+    proc = subprocess.run( cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
+                           cwd=os.path.dirname( os.path.abspath( file_name ) ), text=True )
+    if proc.returncode != 0 :
+        raise RuntimeError( f"sbatch failed: {proc.stderr.strip()}" )
+
+    # The output is "jobid" or "jobid;cluster"
+    job_id = proc.stdout.strip().splitlines()[-1].split( ";" )[0]
+    if array is None :
+        array = parse_sbatch( file_name ).get( "array" )
+    array_ids = _array_ids( array )[0] if array is not None else None
+    job = SlurmJob( job_id, file_name, array_ids, monitor )
+    ( monitor or default_monitor() ).add( job )
+
+    return job
+
+# -----------------------------------------------------------------------------
+class Pipeline :
+    """
+    A graph of SLURM jobs ( e.g. preprocess -> parfor sweep -> gather -> postprocess ) 
+    submitted all at once, with the order enforced by SLURM dependencies, so that 
+    each stage starts as soon as its inputs are ready and independent branches overlap.
+
+    Example:
+        pipe = Pipeline()
+        pipe.stage( "prep", script2slurm( prep_code, "jobs/prep" ) )
+        pipe.stage( "sweep", parfor( loop, "jobs/sweep", chunks=20 ), after=[ "prep" ] )
+        pipe.stage( "post", parfor( post, "jobs/post", chunks=20 ), after=[ "sweep" ], per_element=True )
+        jobs = pipe.submit()
+        pipe.wait()
+
+    Outside Cineca the graph is run by the local executor ( see 'run_local' ).
+
+    Args:
+        - monitor (SlurmMonitor, optional): The monitor of the jobs. Defaults to None (the shared one).
+    """
+
+    def __init__( self, monitor=None ) :
+
+        self.monitor = monitor
+        self.stages = {}
+        self.jobs = {}
+
+    def stage( self, name, sbatch, after=[], per_element=False, array=None, options=[] ) :
+        """
+        Add a stage to the pipeline.
+
+        Args:
+            - name (str): The name of the stage.
+            - sbatch (str or tuple): The sbatch file of the stage, or the tuple returned by 'parfor',
+              'script2slurm' ( with run=False ), whose first element is the sbatch file.
+            - after (list, optional): The names of the stages that must complete successfully first. Defaults to [].
+            - per_element (bool, optional): Whether each array task waits only for the upstream array tasks 
+              with the same ID ( '--dependency=aftercorr' ), instead of the whole upstream jobs ( 'afterok' ). 
+              The upstream stages must be job arrays with the same task IDs. Defaults to False.
+            - array (str, optional): The array specification. Defaults to None, i.e. the chunks of 
+              the parfor job ( read from 'parfor.json' ) or the '--array' directive of the file.
+            - options (list, optional): Other sbatch options. Defaults to [].
+
+        Returns:
+            Pipeline: The pipeline itself, to chain the calls.
+        """
+
+        if name in self.stages :
+            raise ValueError( f"The stage '{name}' already exists" )
+        if type( sbatch ) in ( list, tuple ) :
+            sbatch = sbatch[0]
+        sbatch = os.path.abspath( sbatch )
+
+        # The parfor jobs are arrays with one task per chunk
+        spec_file = os.path.dirname( sbatch ) +s+ "parfor.json"
+        if array is None and os.path.exists( spec_file ) :
+            with open( spec_file, "r" ) as fj :
+                spec = json.load( fj )
+            if spec[ "filename" ] == os.path.basename( sbatch ) :
+                array = f"1-{spec[ 'chunks' ]}"
+        if array is None :
+            array = parse_sbatch( sbatch ).get( "array" )
+
+        self.stages[ name ] = { "sbatch": sbatch, 
+                                "after": list( after ), 
+                                "per_element": per_element, 
+                                "array": array, 
+                                "options": list( options ) }
+
+        return self
+
+    def order( self ) :
+        """
+        Return the names of the stages in a valid submission order ( upstream stages first ).
+        """
+
+        for name, st in self.stages.items() :
+            for up in st[ "after" ] :
+                if up not in self.stages :
+                    raise ValueError( f"The stage '{name}' depends on the unknown stage '{up}'" )
+                if st[ "per_element" ] and \
+                   ( st[ "array" ] is None or self.stages[ up ][ "array" ] is None or 
+                     _array_ids( st[ "array" ] )[0] != _array_ids( self.stages[ up ][ "array" ] )[0] ) :
+                    raise ValueError( f"The per-element stage '{name}' and its upstream stage '{up}' "
+                                      "must be job arrays with the same task IDs" )
+
+        # Topological sort, keeping the order the stages were added in
+        order = []
+        todo = list( self.stages )
+        while todo != [] :
+            ready = [ name for name in todo if all( up in order for up in self.stages[ name ][ "after" ] ) ]
+            if ready == [] :
+                raise ValueError( f"The stages {todo} have circular dependencies" )
+            order.append( ready[0] )
+            todo.remove( ready[0] )
+
+        return order
+
+    def submit( self, printf=False ) :
+        """
+        Submit all the stages at once.
+
+        Args:
+            - printf (bool, optional): Whether to print the submitted jobs. Defaults to False.
+
+        Returns:
+            dict: The job handle of each stage ( 'SlurmJob', or 'LocalTask' lists outside Cineca ).
+        """
+
+        cineca = is_cineca_system()
+        for name in self.order() :
+            st = self.stages[ name ]
+            if cineca :
+                options = list( st[ "options" ] )
+                if st[ "after" ] != [] :
+                    kind = "aftercorr" if st[ "per_element" ] else "afterok"
+                    ids = ":".join( str( self.jobs[ up ].job_id ) for up in st[ "after" ] )
+                    # The jobs whose dependencies can never be satisfied are removed from the queue
+                    options = options + [ f"--dependency={kind}:{ids}", "--kill-on-invalid-dep=yes" ]
+                self.jobs[ name ] = submit( st[ "sbatch" ], array=st[ "array" ], 
+                                            options=options, monitor=self.monitor )
+                job_id = self.jobs[ name ].job_id
+            else :
+                after = [ ( self.jobs[ up ], st[ "per_element" ] ) for up in st[ "after" ] ]
+                self.jobs[ name ] = run_local( st[ "sbatch" ], array=st[ "array" ], after=after )
+                job_id = self.jobs[ name ][0].job_id
+            if printf == True :
+                print( f"{name}: job {job_id} ( after {', '.join( st[ 'after' ] ) or '-'} )" )
+
+        return self.jobs
+
+    def wait( self ) :
+        """
+        Block until all the stages end.
+
+        Returns:
+            dict: The final state of each stage.
+        """
+
+        if not is_cineca_system() :
+            states = {}
+            for name, tasks in self.jobs.items() :
+                for task in tasks :
+                    task.wait()
+                failed = [ task.state for task in tasks if task.state != "COMPLETED" ]
+                states[ name ] = failed[0] if failed != [] else "COMPLETED"
+            return states
+
+        return dict( zip( self.jobs, wait_jobs( self.jobs.values(), self.monitor ) ) )
+
+# The variables of the shell itself, which are never part of a captured environment
+_SHELL_VARIABLES = { "_", "PWD", "OLDPWD", "SHLVL", "PS1", "PS2", "PROMPT_COMMAND", "BASHOPTS", "SHELLOPTS" }
+
+# The captured environments, one per conda prefix
+_environments = {}
+
+# -----------------------------------------------------------------------------
+def _shell_environment( command, timeout=300 ) :
+    """
+    Run a bash command and return the environment at its end ( None if it fails ).
+    """
+
+    try :
+        proc = subprocess.run( [ "bash", "-c", command + " ; env -0" ], stdout=subprocess.PIPE, 
+                               stderr=subprocess.DEVNULL, timeout=timeout )
+    except ( OSError, subprocess.TimeoutExpired ) :
+        return None
+    if proc.returncode != 0 :
+        return None
+    env = {}
+    for item in proc.stdout.decode( errors="replace" ).split( "\0" ) :
+        if "=" in item :
+            key, value = item.split( "=", 1 )
+            env[ key ] = value
+
+    return env
+
+# -----------------------------------------------------------------------------
+def capture_environment( prefix=None, printf=False ) :
+    """
+    Capture once the environment of 'source $HOME/.bashrc && conda activate prefix' 
+    ( PATH, LD_LIBRARY_PATH, CONDA_* and the variables of the activation scripts ), 
+    so that the job scripts can export it instead of activating the environment in every task.
+
+    The activation is timed against the start of the python interpreter with the captured 
+    environment, to report the startup time saved by each task.
+
+    If the activation fails ( e.g. no conda ), the relevant variables of the current 
+    process are used, with 'prefix/bin' first in the PATH.
+
+    Args:
+        - prefix (str, optional): The environment prefix. Defaults to None (sys.prefix).
+        - printf (bool, optional): Whether to print the measured startup times. Defaults to False.
+
+    Returns:
+        dict: With keys "env" (the variables to export), "python" (the interpreter), 
+              "activate" and "fast" (the startup times in seconds).
+    """
+
+    prefix = prefix or sys.prefix
+    if prefix in _environments :
+        return _environments[ prefix ]
+
+    t0 = Time.time()
+    activated = _shell_environment( f"source $HOME/.bashrc > /dev/null 2>&1 ; "
+                                    f"conda activate {prefix} > /dev/null 2>&1 ; python -c pass" )
+    activate = Time.time() - t0
+    baseline = _shell_environment( "true" ) or {}
+
+    if activated is not None and activated.get( "CONDA_PREFIX" ) == prefix :
+        # The variables set (or changed) by the activation
+        env = { key: value for key, value in activated.items() 
+                if baseline.get( key ) != value and key not in _SHELL_VARIABLES }
+    else :
+        # Without conda, the variables of the current process
+        env = { key: value for key, value in os.environ.items() 
+                if key in ( "PATH", "LD_LIBRARY_PATH", "PYTHONPATH" ) or key.startswith( "CONDA_" ) }
+        env[ "PATH" ] = prefix +s+ "bin" + os.pathsep + env.get( "PATH", "" )
+
+    python = prefix +s+ "bin" +s+ "python"
+    if not os.path.exists( python ) :
+        python = sys.executable
+
+    # The startup of a task using the captured environment
+    t0 = Time.time()
+    subprocess.run( [ python, "-c", "pass" ], env=dict( baseline or os.environ, **env ), 
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+    fast = Time.time() - t0
+
+    if printf == True :
+        print( f"Task startup: {activate:.2f} s with .bashrc + conda activate, "
+               f"{fast:.2f} s with the captured environment ( {activate - fast:.2f} s saved per task )" )
+
+    _environments[ prefix ] = { "env": env, "python": python, "activate": activate, "fast": fast }
+
+    return _environments[ prefix ]
+
+# -----------------------------------------------------------------------------
+def _environment_lines( fast_env=False, printf=False ) :
+    """
+    Return the lines setting up the python environment in the job scripts, 
+    and the python command to be used after them.
+
+    Args:
+        - fast_env (bool, optional): Whether to export the captured environment (see 'capture_environment')
+          instead of sourcing .bashrc and activating the conda environment. Defaults to False.
+        - printf (bool, optional): Whether to print the measured startup times. Defaults to False.
+
+    Returns:
+        - list: The lines.
+        - str: The python command.
+    """
+
+    if fast_env == False :
+        return [ 'source $HOME/.bashrc', f'conda activate {sys.prefix}' ], "python"
+
+    captured = capture_environment( printf=printf )
+    lines = [ f"# Environment of 'conda activate {sys.prefix}', captured at generation time" ]
+    for key, value in sorted( captured[ "env" ].items() ) :
+        if key.isidentifier() :
+            lines.append( f"export {key}={shlex.quote( value )}" )
+
+    return lines, captured[ "python" ]
+
+# -----------------------------------------------------------------------------
+def build_bundle( path, modules=[], name="bundle.tar" ) :
+    """
+    Build a bundle of python packages and modules, with precompiled '.pyc' files, 
+    to be staged on the node-local storage of the compute nodes (see '_bundle_lines').
+
+    Importing from the bundle avoids the thousands of 'stat'/'open' calls 
+    each interpreter makes on the shared filesystem when many tasks start at once.
+    The package 'CinecaPy' (imported by the task scripts) is always included.
+
+    The bundle is an uncompressed tar ( extension modules, e.g. of numpy, cannot be imported 
+    from a zip archive ), whose '.pyc' files do not check their sources. Its entries are sorted
+    and their times and owners cleared, so that the same content gives the same hash. 
+    The names, sizes and modification times of the sources are recorded in 'name.json': 
+    if they did not change, the existing bundle is reused without being rebuilt.
+
+    Args:
+        - path (str): The directory where the bundle is saved.
+        - modules (list, optional): The names of the modules (or packages) to be included. Defaults to [].
+        - name (str, optional): The name of the bundle file. Defaults to "bundle.tar".
+
+    Returns:
+        - str: The path of the bundle.
+        - str: The hash of its content, naming the node-local copy.
+    """
+
+    # The sources of the top-level packages/modules
+    tops = []
+    sources = []
+    for module in [ "CinecaPy" ] + list( modules ) :
+        top = module.split( "." )[0]
+        if top in tops :
+            continue
+        tops.append( top )
+        spec = importlib.util.find_spec( top )
+        if spec is None or spec.origin in ( None, "built-in", "frozen" ) and not spec.submodule_search_locations :
+            # Built-in modules are not on disk
+            continue
+        if spec.submodule_search_locations :
+            source = list( spec.submodule_search_locations )[0]
+            sources.append( ( source, top ) )
+            # The shared libraries vendored by the wheels ( e.g. 'numpy.libs' ), found through relative RPATHs
+            if os.path.isdir( source + ".libs" ) :
+                sources.append( ( source + ".libs", top + ".libs" ) )
+        else :
+            sources.append( ( spec.origin, os.path.basename( spec.origin ) ) )
+
+    # The signature of the sources, to reuse the bundle if they did not change
+    signature = hashlib.sha1( f"{sys.version}{sorted( sources )}".encode() )
+    for source, _ in sorted( sources ) :
+        if os.path.isdir( source ) :
+            walk = os.walk( source )
+        else :
+            walk = [ ( os.path.dirname( source ), [], [ os.path.basename( source ) ] ) ]
+        for root, dirs, files in walk :
+            dirs[:] = sorted( d for d in dirs if d != "__pycache__" )
+            for fname in sorted( files ) :
+                st = os.stat( os.path.join( root, fname ) )
+                signature.update( f"{os.path.join( root, fname )} {st.st_size} {st.st_mtime_ns}\n".encode() )
+    signature = signature.hexdigest()
+    info_file = path +s+ name + ".json"
+    if os.path.isfile( path +s+ name ) and os.path.isfile( info_file ) :
+        with open( info_file, "r" ) as fj :
+            info = json.load( fj )
+        if info.get( "signature" ) == signature :
+            return path +s+ name, info[ "digest" ]
+
+    build = path +s+ name + ".build"
+    if os.path.exists( build ) :
+        shutil.rmtree( build )
+    os.makedirs( build, exist_ok=True )
+
+    # Copy the top-level packages/modules
+    for source, target in sources :
+        if os.path.isdir( source ) :
+            shutil.copytree( source, build +s+ target, ignore=shutil.ignore_patterns( "__pycache__" ) )
+        else :
+            shutil.copy2( source, build +s+ target )
+
+    # Precompile the modules, without checking the sources at import time
+    # ( recording their paths relative to the bundle, not to the build directory )
+    compileall.compile_dir( build, ddir="", quiet=1, workers=0,
+                            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH )
+
+    # The entries carry no times nor owners, so that the same content gives the same hash
+    def normalize( info ) :
+        info.mtime = 0
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        return info
+
+    # Pack the bundle (with sorted names, so that the same content gives the same hash)
+    with tarfile.open( path +s+ name, "w" ) as tar :
+        for root, dirs, files in os.walk( build ) :
+            dirs.sort()
+            for fname in sorted( files ) :
+                full = os.path.join( root, fname )
+                tar.add( full, arcname=os.path.relpath( full, build ), recursive=False, filter=normalize )
+    shutil.rmtree( build )
+
+    digest = hashlib.sha1()
+    with open( path +s+ name, "rb" ) as fb :
+        for block in iter( lambda : fb.read( 1 << 20 ), b"" ) :
+            digest.update( block )
+    digest = digest.hexdigest()[ :12 ]
+    with open( info_file, "w" ) as fj :
+        json.dump( { "signature": signature, "digest": digest }, fj, indent=1 )
+
+    return path +s+ name, digest
+
+# -----------------------------------------------------------------------------
+def _bundle_lines( bundle, digest ) :
+    """
+    Return the lines of the job scripts staging a bundle (see 'build_bundle') to the 
+    node-local storage ( $TMPDIR, or /tmp ) and putting it first on the python path.
+
+    The bundle is extracted once per node: the first task takes a file lock, 
+    the other tasks on the same node wait for it and reuse the extracted copy.
+
+    Args:
+        - bundle (str): The path of the bundle.
+        - digest (str): The hash of the bundle.
+
+    Returns:
+        list: The lines.
+    """
+
+    return [ "# Stage the bundle of python modules on the node-local storage, once per node",
+             f"_cp_local=${{TMPDIR:-/tmp}}/cp_bundle_{digest}",
+             'mkdir -p "$_cp_local"',
+             '( flock 9 ; [ -f "$_cp_local/.ready" ] || '
+             f'{{ tar -xf {shlex.quote( bundle )} -C "$_cp_local" && touch "$_cp_local/.ready" ; }} ) 9> "$_cp_local/.lock"',
+             'export PYTHONPATH="$_cp_local${PYTHONPATH:+:$PYTHONPATH}"' ]
+
+# -----------------------------------------------------------------------------
+def _read_source( code ) :
+    """
+    Return the python source contained in 'code'.
+
+    Args:
+        - code (str): The path to a python file or the python code itself.
+
+    Returns:
+        str: The python source code.
+    """
+
+    # If 'code' is the path of an existing file, read its content
+    if os.path.isfile( code ) :
+        with open( code, "r" ) as fl :
+            return fl.read()
+
+    return code
+
+# -----------------------------------------------------------------------------
+def _for_loops( tree ) :
+    """
+    Return all the for-loop nodes of an AST, sorted by their position in the source.
+
+    Args:
+        - tree (ast.AST): The parsed python source.
+
+    Returns:
+        list: The ast.For nodes, in the order they appear in the source code.
+    """
+
+    loops = [ node for node in ast.walk( tree ) if isinstance( node, ast.For ) ]
+
+    return sorted( loops, key=lambda node : ( node.lineno, node.col_offset ) )
+
+# -----------------------------------------------------------------------------
+def _walk_scope( node ) :
+    """
+    Like 'ast.walk', but without descending into nested scopes 
+    (function and class bodies, lambdas, comprehensions), 
+    whose local names are not visible from the enclosing code.
+
+    Args:
+        - node (ast.AST): The root node.
+
+    Yields:
+        ast.AST: The nodes belonging to the scope of the root node.
+    """
+
+    nested = ( ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda,
+               ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp )
+    todo = [ node ]
+    while todo :
+        sub = todo.pop()
+        yield sub
+        if isinstance( sub, nested ) and sub is not node :
+            # Only the parts evaluated in the enclosing scope are visited
+            if isinstance( sub, ( ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef ) ) :
+                todo.extend( sub.decorator_list )
+                todo.extend( getattr( sub, "bases", [] ) )
+            elif isinstance( sub, ( ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp ) ) :
+                todo.append( sub.generators[0].iter )
+            continue
+        todo.extend( ast.iter_child_nodes( sub ) )
+
+# -----------------------------------------------------------------------------
+def _bound_names( node ) :
+    """
+    Return the names bound (assigned, imported, defined) anywhere inside an AST node.
+    The body of a function or class definition is not inspected: a definition binds only its name
+    ( the names a function declares 'global' are bound when it is called, see '_global_names' ).
+
+    Args:
+        - node (ast.AST): The statement or expression to be inspected.
+
+    Returns:
+        set: The names bound by the node.
+    """
+
+    if isinstance( node, ( ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef ) ) :
+        return { node.name }
+
+    names = set()
+    for sub in _walk_scope( node ) :
+        # Plain assignments, for-loop targets, with-as targets, del statements
+        if isinstance( sub, ast.Name ) and isinstance( sub.ctx, ( ast.Store, ast.Del ) ) :
+            names.add( sub.id )
+        # Function and class definitions
+        elif isinstance( sub, ( ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef ) ) :
+            names.add( sub.name )
+        # Import statements (only the first component of dotted imports is bound)
+        elif isinstance( sub, ( ast.Import, ast.ImportFrom ) ) :
+            for a in sub.names :
+                names.add( ( a.asname or a.name ).split( "." )[0] )
+        # Exception aliases
+        elif isinstance( sub, ast.ExceptHandler ) and sub.name :
+            names.add( sub.name )
+
+    return names
+
+# -----------------------------------------------------------------------------
+def _global_names( node ) :
+    """
+    Return the names declared 'global' by the functions defined inside an AST node,
+    which may be rebound whenever these functions are called.
+
+    Args:
+        - node (ast.AST): The statement to be inspected.
+
+    Returns:
+        set: The names declared global.
+    """
+
+    return { name for sub in ast.walk( node ) if isinstance( sub, ast.Global ) for name in sub.names }
+
+# -----------------------------------------------------------------------------
+# The calls changing the environment of the program: the working directory, the module search path,
+# the environment variables and the random seeds ( matched on the last components of their names )
+ENVIRONMENT_CALLS = { "chdir", "putenv", "unsetenv", "addsitedir", 
+                      "path.insert", "path.append", "path.extend", "path.remove", 
+                      "environ.update", "environ.setdefault", "environ.pop", "environ.clear", 
+                      "random.seed", "manual_seed" }
+
+# -----------------------------------------------------------------------------
+def _dotted_name( node ) :
+    """
+    Return the dotted name of an expression like 'a.b.c' ( None for other expressions ).
+    """
+
+    parts = []
+    while isinstance( node, ast.Attribute ) :
+        parts.append( node.attr )
+        node = node.value
+    if not isinstance( node, ast.Name ) :
+        return None
+    parts.append( node.id )
+
+    return ".".join( reversed( parts ) )
+
+# -----------------------------------------------------------------------------
+def _side_effect( stmt, writers=() ) :
+    """
+    Whether a top-level statement changes the environment of the program, which the following 
+    statements may depend on without reading any of its names: a call changing the working directory, 
+    'sys.path', the environment variables or a random seed ( see 'ENVIRONMENT_CALLS' ), an assignment 
+    to 'os.environ[...]', or a call to one of the 'writers', the functions assigning global variables.
+    Other calls ( e.g. 'print' or plotting ) are not side effects the loop depends on.
+
+    Args:
+        - stmt (ast.stmt): The statement.
+        - writers (set, optional): The names of the functions declaring global variables. Defaults to ().
+
+    Returns:
+        bool: Whether the statement changes the environment.
+    """
+
+    if isinstance( stmt, ( ast.Assign, ast.AugAssign, ast.Delete ) ) :
+        targets = stmt.targets if isinstance( stmt, ( ast.Assign, ast.Delete ) ) else [ stmt.target ]
+        return any( isinstance( target, ast.Subscript ) and 
+                    ( _dotted_name( target.value ) or "" ).endswith( "environ" ) for target in targets )
+
+    if not isinstance( stmt, ast.Expr ) :
+        return False
+    for sub in ast.walk( stmt.value ) :
+        if isinstance( sub, ast.Call ) :
+            name = _dotted_name( sub.func ) or ""
+            if name in writers or any( name == call or name.endswith( "." + call ) for call in ENVIRONMENT_CALLS ) :
+                return True
+
+    return False
+
+# -----------------------------------------------------------------------------
+def _global_writers( statements ) :
+    """
+    Return the names of the functions, defined by top-level statements, that declare global variables.
+    """
+
+    return { stmt.name for stmt in statements 
+             if isinstance( stmt, ( ast.FunctionDef, ast.AsyncFunctionDef ) ) and _global_names( stmt ) }
+
+# -----------------------------------------------------------------------------
+def _used_names( node ) :
+    """
+    Return the names read anywhere inside an AST node.
+
+    Args:
+        - node (ast.AST): The statement or expression to be inspected.
+
+    Returns:
+        set: The names loaded by the node.
+    """
+
+    return { sub.id for sub in ast.walk( node )
+             if isinstance( sub, ast.Name ) and isinstance( sub.ctx, ast.Load ) }
+
+# -----------------------------------------------------------------------------
+def _mutated_names( node ) :
+    """
+    Return the names whose objects may be modified in place by a statement,
+    e.g. 'x[0] = 1', 'x.a = 1', 'x.append( 1 )' or 'x += [1]'.
+
+    Args:
+        - node (ast.AST): The statement to be inspected.
+
+    Returns:
+        set: The names of the objects that may be mutated.
+    """
+
+    names = set()
+    for sub in ast.walk( node ) :
+        # Item or attribute assignment/deletion ( x[...] = ..., x.a = ... )
+        if isinstance( sub, ( ast.Subscript, ast.Attribute ) ) and \
+           isinstance( sub.ctx, ( ast.Store, ast.Del ) ) :
+            base = sub.value
+            while isinstance( base, ( ast.Subscript, ast.Attribute ) ) :
+                base = base.value
+            if isinstance( base, ast.Name ) :
+                names.add( base.id )
+        # Method calls ( x.append(...), x.update(...), ... )
+        elif isinstance( sub, ast.Call ) and isinstance( sub.func, ast.Attribute ) :
+            base = sub.func.value
+            while isinstance( base, ( ast.Subscript, ast.Attribute ) ) :
+                base = base.value
+            if isinstance( base, ast.Name ) :
+                names.add( base.id )
+
+    return names
+
+# -----------------------------------------------------------------------------
+def _program_slice( statements, names ) :
+    """
+    Compute the minimal subset of a list of top-level statements
+    that is needed to define the given names.
+
+    The statements are scanned backwards: a statement is kept if it binds
+    or mutates one of the needed names ( or defines a function declaring one
+    of them 'global' ), and the names it reads are then added to the needed ones.
+    Star-imports and the statements changing the environment ( e.g. the working 
+    directory or 'sys.path', see '_side_effect' ) are always kept, since the names 
+    they bind, or the state they change, cannot be known statically.
+
+    Args:
+        - statements (list): The top-level ast statements preceding the loop.
+        - names (set): The names needed to evaluate the loop iterable.
+
+    Returns:
+        - list: The statements to be executed, in their original order.
+        - set: The names still unresolved by the slice (e.g. builtins).
+    """
+
+    needed = set( names )
+    kept = []
+    writers = _global_writers( statements )
+
+    for stmt in reversed( statements ) :
+        star_import = isinstance( stmt, ast.ImportFrom ) and \
+                      any( a.name == "*" for a in stmt.names )
+        bound = _bound_names( stmt )
+        if star_import or _side_effect( stmt, writers ) or \
+           ( needed & ( bound | _mutated_names( stmt ) | _global_names( stmt ) ) ) :
+            kept.append( stmt )
+            # Unconditional (re)definitions kill the older values of the names they bind
+            if isinstance( stmt, ( ast.Assign, ast.AnnAssign, ast.Import, ast.ImportFrom,
+                                   ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef ) ) :
+                needed = needed - bound
+            needed = needed | _used_names( stmt )
+
+    return kept[::-1], needed
+
+# -----------------------------------------------------------------------------
+def _const_value( node, consts, numpy_names ) :
+    """
+    Statically evaluate an expression made only of literals,
+    constant names, arithmetic operators and a few well known calls
+    (len, range, enumerate, numpy.arange, numpy.linspace).
+
+    Args:
+        - node (ast.AST): The expression to be evaluated.
+        - consts (dict): The names known to be bound to constant values.
+        - numpy_names (set): The names bound to the numpy module.
+
+    Returns:
+        The value of the expression.
+
+    Raises:
+        ValueError: If the expression cannot be evaluated statically.
+    """
+
+    # Literals ( 10, 'abc', [1, 2], (1, 2), {1: 2}, ... )
+    try :
+        return ast.literal_eval( node )
+    except ( ValueError, TypeError, SyntaxError, MemoryError, RecursionError ) :
+        pass
+
+    if isinstance( node, ast.Name ) and node.id in consts :
+        return consts[ node.id ]
+
+    if isinstance( node, ( ast.List, ast.Tuple, ast.Set ) ) :
+        values = [ _const_value( e, consts, numpy_names ) for e in node.elts ]
+        return { ast.List: list, ast.Tuple: tuple, ast.Set: set }[ type( node ) ]( values )
+
+    if isinstance( node, ast.UnaryOp ) :
+        operand = _const_value( node.operand, consts, numpy_names )
+        if isinstance( node.op, ast.USub ) :
+            return -operand
+        if isinstance( node.op, ast.UAdd ) :
+            return +operand
+
+    if isinstance( node, ast.BinOp ) :
+        left = _const_value( node.left, consts, numpy_names )
+        right = _const_value( node.right, consts, numpy_names )
+        operators = { ast.Add: lambda a, b : a + b,
+                      ast.Sub: lambda a, b : a - b,
+                      ast.Mult: lambda a, b : a * b,
+                      ast.Div: lambda a, b : a / b,
+                      ast.FloorDiv: lambda a, b : a // b,
+                      ast.Mod: lambda a, b : a % b,
+                      ast.Pow: lambda a, b : a ** b }
+        if type( node.op ) in operators :
+            return operators[ type( node.op ) ]( left, right )
+
+    if isinstance( node, ast.Call ) and not node.keywords :
+        args = [ _const_value( a, consts, numpy_names ) for a in node.args ]
+        func = node.func
+        # Builtins ( only if they are not shadowed by the user code )
+        if isinstance( func, ast.Name ) and func.id not in consts :
+            if func.id == "len" :
+                return len( *args )
+            if func.id == "range" :
+                return range( *args )
+            if func.id == "enumerate" :
+                return list( enumerate( *args ) )
+        # numpy functions with a known output length
+        if isinstance( func, ast.Attribute ) and isinstance( func.value, ast.Name ) and \
+           func.value.id in numpy_names :
+            if func.attr == "arange" :
+                if len( args ) == 1 :
+                    start, stop, step = 0, args[0], 1
+                elif len( args ) == 2 :
+                    start, stop, step = args[0], args[1], 1
+                else :
+                    start, stop, step = args[:3]
+                return range( max( 0, int( np.ceil( ( stop - start ) / step ) ) ) )
+            if func.attr == "linspace" :
+                return range( int( args[2] ) if len( args ) > 2 else 50 )
+        # The product of nested loops (see '_flatten_loops')
+        if isinstance( func, ast.Attribute ) and isinstance( func.value, ast.Name ) and \
+           func.value.id == "_cp" and func.attr == "Product" :
+            return Product( *args )
+
+    raise ValueError( f"Expression at line {getattr( node, 'lineno', '?' )} is not static" )
+
+# -----------------------------------------------------------------------------
+def _static_consts( statements ) :
+    """
+    Collect the names bound exactly once, by a plain top-level assignment,
+    to a statically known value (e.g. 'n = 100' or 'lst = [1, 2, 3]').
+
+    Args:
+        - statements (list): The top-level ast statements preceding the loop.
+
+    Returns:
+        - dict: The constant names and their values.
+        - set: The names bound to the numpy module.
+    """
+
+    consts = {}
+    numpy_names = set()
+    # Count how many times each name is bound or mutated, 
+    # constant assignments are trusted only if they are never changed afterwards
+    counts = {}
+    for stmt in statements :
+        for name in _bound_names( stmt ) | _mutated_names( stmt ) | _global_names( stmt ) :
+            counts[ name ] = counts.get( name, 0 ) + 1
+        if isinstance( stmt, ast.Import ) :
+            for a in stmt.names :
+                if a.name == "numpy" :
+                    numpy_names.add( a.asname or a.name )
+
+    for stmt in statements :
+        if isinstance( stmt, ast.Assign ) and len( stmt.targets ) == 1 and \
+           isinstance( stmt.targets[0], ast.Name ) and counts[ stmt.targets[0].id ] == 1 :
+            try :
+                consts[ stmt.targets[0].id ] = _const_value( stmt.value, consts, numpy_names )
+            except ( ValueError, TypeError, ZeroDivisionError, OverflowError ) :
+                pass
+
+    return consts, numpy_names - set( consts )
+
+# -----------------------------------------------------------------------------
+def _find_loop( source, ifor=0, filename="<parfor>" ) :
+    """
+    Parse a python source and locate its 'ifor'-th for-loop.
+
+    Args:
+        - source (str): The python source code containing the loop.
+        - ifor (int, optional): The index of the for loop. Defaults to 0.
+        - filename (str, optional): The file name used in tracebacks. Defaults to "<parfor>".
+
+    Returns:
+        - ast.Module: The parsed source.
+        - ast.For: The for-loop node.
+        - int: The index, in the module body, of the top-level statement containing the loop.
+    """
+
+    tree = ast.parse( source, filename=filename )
+    loops = _for_loops( tree )
+    if ifor >= len( loops ) :
+        raise ValueError( f"The code contains {len( loops )} for-loops, 'ifor={ifor}' is out of range." )
+    for_node = loops[ ifor ]
+
+    # Find the top-level statement containing the loop: only what precedes it is the prelude
+    for istmt, stmt in enumerate( tree.body ) :
+        if stmt.lineno <= for_node.lineno <= stmt.end_lineno :
+            break
+
+    return tree, for_node, istmt
+
+# -----------------------------------------------------------------------------
+def _flatten_loops( source, ifor, filename="<parfor>" ) :
+    """
+    Rewrite perfectly nested for-loops as a single loop over the Cartesian product 
+    of their iterables (see 'Product'), e.g.:
+
+        for a in A :                  
+            for b in B :       ->     for ( a, b ) in _cp.Product( A, B ) :
+                body                      body
+
+    The selected loops must be directly nested ( each one being the only statement 
+    of the previous one ), without 'else' clauses, and the iterables of the inner loops
+    must not depend on the targets of the outer ones.
+
+    Args:
+        - source (str): The python source code containing the loops.
+        - ifor (list): The indices of the nested for-loops, from the outermost.
+        - filename (str, optional): The file name used in tracebacks. Defaults to "<parfor>".
+
+    Returns:
+        - str: The rewritten source code.
+        - int: The index of the flattened loop in the rewritten source.
+    """
+
+    tree = ast.parse( source, filename=filename )
+    loops = _for_loops( tree )
+    if max( ifor ) >= len( loops ) :
+        raise ValueError( f"The code contains {len( loops )} for-loops, 'ifor={list( ifor )}' is out of range." )
+    selected = [ loops[ i ] for i in sorted( set( ifor ) ) ]
+
+    # Check that the loops are perfectly nested and rectangular
+    bound = set()
+    for outer, inner in zip( selected[ :-1 ], selected[ 1: ] ) :
+        if outer.body != [ inner ] :
+            raise ValueError( f"The loop at line {inner.lineno} must be the only statement of the loop "
+                              f"at line {outer.lineno} to parallelize them together." )
+        bound = bound | _bound_names( outer.target )
+        if _used_names( inner.iter ) & bound :
+            raise ValueError( f"The iterable of the loop at line {inner.lineno} depends on the outer loops." )
+    for loop in selected :
+        if loop.orelse :
+            raise ValueError( f"The loop at line {loop.lineno} has an 'else' clause." )
+    outer, innermost = selected[0], selected[-1]
+    if innermost.body[0].lineno == innermost.lineno :
+        raise ValueError( f"The body of the loop at line {innermost.lineno} must start on a new line." )
+
+    # The header of the product loop
+    lines = source.split( "\n" )
+    targets = ", ".join( _source_segment( lines, loop.target ) for loop in selected )
+    iterables = ", ".join( _source_segment( lines, loop.iter ) for loop in selected )
+    indent = lines[ outer.lineno - 1 ][ :outer.col_offset ]
+    header = f"{indent}for ( {targets} ) in _cp.Product( {iterables} ) :"
+
+    # The body of the innermost loop, indented as the body of the outer one
+    body_lines = lines[ innermost.body[0].lineno - 1 : innermost.end_lineno ]
+    shift = innermost.body[0].col_offset - ( outer.col_offset + 4 )
+    body_lines = [ line[ shift: ] if line[ :shift ].strip() == "" else line for line in body_lines ]
+
+    new_lines = lines[ :outer.lineno - 1 ] + [ header ] + body_lines + lines[ innermost.end_lineno: ]
+    new_source = "\n".join( new_lines )
+
+    # The flattened loop keeps the position of the outermost one
+    new_ifor = [ i for i, loop in enumerate( _for_loops( ast.parse( new_source, filename=filename ) ) ) 
+                 if loop.lineno == outer.lineno ][0]
+
+    return new_source, new_ifor
+
+# -----------------------------------------------------------------------------
+def _run_prelude( statements, scope, filename="<parfor>", expr=None ) :
+    """
+    Execute top-level statements of the loop code in 'scope', then evaluate an expression 
+    ( e.g. the loop iterable ), restoring the working directory they may change ( 'os.chdir' ).
+
+    Args:
+        - statements (list): The ast statements.
+        - scope (dict): The global namespace.
+        - filename (str, optional): The file name used in tracebacks. Defaults to "<parfor>".
+        - expr (ast.expr, optional): The expression to evaluate. Defaults to None.
+
+    Returns:
+        The value of the expression ( None without expression ).
+    """
+
+    cwd = os.getcwd()
+    try :
+        exec( compile( ast.Module( body=statements, type_ignores=[] ), filename, "exec" ), scope )
+        if expr is not None :
+            return eval( compile( ast.Expression( body=expr ), filename, "eval" ), scope )
+    finally :
+        os.chdir( cwd )
+
+# -----------------------------------------------------------------------------
+def _loop_iterable( source, ifor=0, modules=[], alias=[], filename="<parfor>", static=True ) :
+    """
+    Evaluate the iterable of the 'ifor'-th for-loop in 'source'.
+
+    If 'static' is True, the iterable is first evaluated statically 
+    (e.g. range(n), np.arange(...), len(x) of a literal), in which case 
+    no user code is executed at all and only the length of the returned 
+    object is meaningful. Otherwise, only the minimal slice of top-level 
+    statements needed to evaluate the iterable is executed, instead of 
+    the whole loop prelude.
+
+    Args:
+        - source (str): The python source code containing the loop.
+        - ifor (int, optional): The index of the for loop. Defaults to 0.
+        - modules (list, optional): Additional modules available to the code. Defaults to [].
+        - alias (list, optional): The aliases of the additional modules. Defaults to [].
+        - filename (str, optional): The file name used in tracebacks. Defaults to "<parfor>".
+        - static (bool, optional): Whether to try the static evaluation first. Defaults to True.
+
+    Returns:
+        - The iterable object (or an object with the same length, if evaluated statically).
+        - ast.For: The for-loop node.
+        - ast.Module: The parsed source.
+    """
+
+    tree, for_node, istmt = _find_loop( source, ifor=ifor, filename=filename )
+    prelude = tree.body[ :istmt ]
+
+    # The additional modules imported by the generated script
+    extra_imports = []
+    for im, module in enumerate( modules ) :
+        extra_imports.append( ( module, alias[ im ] if im < len( alias ) else module.split( "." )[0] ) )
+    numpy_alias = { name for module, name in extra_imports if module == "numpy" }
+
+    # 1) Try to evaluate the iterable without executing anything
+    if static == True :
+        consts, numpy_names = _static_consts( prelude )
+        try :
+            return _const_value( for_node.iter, consts, numpy_names | numpy_alias ), for_node, tree
+        except ( ValueError, TypeError, ZeroDivisionError, OverflowError ) :
+            pass
+
+    # 2) Execute only the statements the iterable depends on
+    statements, unresolved = _program_slice( prelude, _used_names( for_node.iter ) )
+    scope = { "_cp": sys.modules[ __name__ ] }
+    for module, name in extra_imports :
+        if name in unresolved :
+            exec( f"import {module} as {name}" if name != module.split( "." )[0]
+                  else f"import {module}", scope )
+    iter_value = _run_prelude( statements, scope, filename, expr=for_node.iter )
+
+    return iter_value, for_node, tree
+
+# -----------------------------------------------------------------------------
+def _loop_length( source, ifor=0, modules=[], alias=[], filename="<parfor>" ) :
+    """
+    Compute the length of the iterable of the 'ifor'-th for-loop in 'source',
+    executing as little user code as possible (see '_loop_iterable').
+
+    Args:
+        - source (str): The python source code containing the loop.
+        - ifor (int, optional): The index of the for loop. Defaults to 0.
+        - modules (list, optional): Additional modules available to the code. Defaults to [].
+        - alias (list, optional): The aliases of the additional modules. Defaults to [].
+        - filename (str, optional): The file name used in tracebacks. Defaults to "<parfor>".
+
+    Returns:
+        - int: The length of the iterable.
+        - ast.For: The for-loop node.
+        - ast.Module: The parsed source.
+    """
+
+    iter_value, for_node, tree = _loop_iterable( source, ifor=ifor, modules=modules, 
+                                                 alias=alias, filename=filename )
+
+    return len( iter_value ), for_node, tree
+
+# -----------------------------------------------------------------------------
+def _iterable_only_statements( tree, for_node ) :
+    """
+    Return the top-level statements of the loop prelude that are needed only 
+    to build the iterable of the loop, i.e. whose names are not read by any
+    other part of the code. These statements can be skipped by the tasks
+    when the iterable is read from a precomputed manifest.
+
+    Args:
+        - tree (ast.Module): The parsed source.
+        - for_node (ast.For): The for-loop node.
+
+    Returns:
+        list: The removable top-level statements.
+    """
+
+    istmt = [ i for i, stmt in enumerate( tree.body ) 
+              if stmt.lineno <= for_node.lineno <= stmt.end_lineno ][0]
+    candidates, _ = _program_slice( tree.body[ :istmt ], _used_names( for_node.iter ) )
+    writers = _global_writers( tree.body[ :istmt ] )
+    # Imports are cheap and may be needed by the loop body, decorated definitions are left untouched, 
+    # and so are the changes of the environment, which the loop body may depend on
+    candidates = [ stmt for stmt in candidates 
+                   if not isinstance( stmt, ( ast.Import, ast.ImportFrom ) ) 
+                   and not getattr( stmt, "decorator_list", [] ) and not _side_effect( stmt, writers ) ]
+
+    # Names read by the rest of the code ( the loop iterable itself excluded )
+    iter_nodes = set( map( id, ast.walk( for_node.iter ) ) )
+    used_elsewhere = set()
+    for stmt in tree.body :
+        if stmt in candidates :
+            continue
+        for sub in ast.walk( stmt ) :
+            if id( sub ) not in iter_nodes and isinstance( sub, ast.Name ) and \
+               isinstance( sub.ctx, ast.Load ) :
+                used_elsewhere.add( sub.id )
+
+    # Iterate until no other candidate is needed by the ones kept
+    removable = list( candidates )
+    changed = True
+    while changed :
+        changed = False
+        needed = set( used_elsewhere )
+        for stmt in candidates :
+            if stmt not in removable :
+                needed = needed | _used_names( stmt )
+        for stmt in list( removable ) :
+            if ( _bound_names( stmt ) | _mutated_names( stmt ) ) & needed :
+                removable.remove( stmt )
+                changed = True
+
+    # Statements sharing their lines with other statements ( e.g. 'a = 1; b = 2' ) are kept
+    lines = {}
+    for stmt in tree.body :
+        for ln in range( stmt.lineno, stmt.end_lineno + 1 ) :
+            lines[ ln ] = lines.get( ln, 0 ) + 1
+    removable = [ stmt for stmt in removable 
+                  if all( lines[ ln ] == 1 for ln in range( stmt.lineno, stmt.end_lineno + 1 ) ) ]
+
+    return removable
+
+# -----------------------------------------------------------------------------
+def _replace_segment( lines, node, text ) :
+    """
+    Replace the source segment spanned by an AST node with a new text.
+
+    Args:
+        - lines (list): The source code lines (modified in place).
+        - node (ast.AST): The node whose segment is replaced.
+        - text (str): The new text.
+    """
+
+    # AST column offsets are expressed in bytes of the utf-8 encoded lines
+    first = lines[ node.lineno - 1 ].encode( "utf-8" )
+    last = lines[ node.end_lineno - 1 ].encode( "utf-8" )
+    head = first[ :node.col_offset ].decode( "utf-8" )
+    tail = last[ node.end_col_offset: ].decode( "utf-8" )
+    lines[ node.lineno - 1 : node.end_lineno ] = [ head + text + tail ]
+
+# -----------------------------------------------------------------------------
+def _source_segment( lines, node ) :
+    """
+    Return the source segment spanned by an AST node.
+
+    Args:
+        - lines (list): The source code lines.
+        - node (ast.AST): The node.
+
+    Returns:
+        str: The source code of the node.
+    """
+
+    segment = "\n".join( lines[ node.lineno - 1 : node.end_lineno ] ).encode( "utf-8" )
+    end = len( segment ) - len( lines[ node.end_lineno - 1 ].encode( "utf-8" ) ) + node.end_col_offset
+
+    return segment[ node.col_offset : end ].decode( "utf-8" )
+
+# -----------------------------------------------------------------------------
+def write_manifest( path, iterable, name="iterable" ) :
+    """
+    Materialize an iterable once into a compact on-disk manifest, 
+    which can then be read slice by slice by all the tasks of a job array.
+
+    Numeric arrays are stored as a '.npy' file, which is read back as a memory-map. 
+    Lists, tuples and ranges of python numbers of a single type ( e.g. 'range( n )' ) 
+    are also stored as a '.npy' file, whose items are read back as python numbers 
+    of the same type. Any other iterable ( e.g. a list mixing ints and floats, which 
+    an array would turn into floats ) is stored as an offset-indexed binary file: 
+    the items (utf-8 strings, bytes or pickled objects) are concatenated in '<name>.bin' 
+    and their offsets are stored in '<name>.idx.npy', so that each item can be reached 
+    with a single seek.
+
+    Args:
+        - path (str): The directory where the manifest files will be saved.
+        - iterable (iterable): The object to be materialized.
+        - name (str, optional): The base name of the manifest files. Defaults to "iterable".
+
+    Returns:
+        int: The number of items in the manifest.
+    """
+
+    # Check if the directory specified by 'path' exists
+    if os.path.exists( path ) == False :
+        # If not, create the directory
+        os.makedirs( path, exist_ok=True )
+
+    # Numeric arrays are saved as they are
+    array = None
+    scalars = False
+    if isinstance( iterable, np.ndarray ) :
+        if iterable.dtype.kind in "biufcmM" :
+            array = iterable
+    elif isinstance( iterable, range ) :
+        array, scalars = np.arange( iterable.start, iterable.stop, iterable.step, dtype=np.int64 ), True
+    # Python numbers of a single type are saved as an array, and converted back when read
+    elif isinstance( iterable, ( list, tuple ) ) and len( iterable ) > 0 and \
+         len( { type( v ) for v in iterable } ) == 1 and type( iterable[0] ) in ( bool, int, float, complex ) :
+        try :
+            array, scalars = np.asarray( iterable ), True
+        except OverflowError :
+            array = None
+        if array is not None and ( array.ndim != 1 or array.dtype.kind not in "biufc" ) :
+            array = None
+
+    if array is not None :
+        np.save( path +s+ name + ".npy", array )
+        kind, n = "npy", len( array )
+
+    # Other objects are written one by one in the offset-indexed binary file
+    else :
+        items = list( iterable ) if not isinstance( iterable, ( list, tuple ) ) else iterable
+        if all( isinstance( v, str ) for v in items ) :
+            kind = "str"
+        elif all( isinstance( v, bytes ) for v in items ) :
+            kind = "bytes"
+        else :
+            kind = "pickle"
+        offsets = np.zeros( len( items ) + 1, dtype=np.int64 )
+        with open( path +s+ name + ".bin", "wb" ) as fb :
+            for i, v in enumerate( items ) :
+                if kind == "str" :
+                    v = v.encode( "utf-8" )
+                elif kind == "pickle" :
+                    v = pickle.dumps( v, protocol=pickle.HIGHEST_PROTOCOL )
+                fb.write( v )
+                offsets[ i + 1 ] = offsets[ i ] + len( v )
+        np.save( path +s+ name + ".idx.npy", offsets )
+        n = len( items )
+
+    # Write the header describing the manifest
+    with open( path +s+ name + ".json", "w" ) as fj :
+        json.dump( { "kind": kind, "n": int( n ), "scalars": array is not None and scalars }, fj )
+
+    return int( n )
+
+# -----------------------------------------------------------------------------
+def load_manifest( path, name="iterable" ) :
+    """
+    Open a manifest written by 'write_manifest' without loading it in memory.
+
+    Args:
+        - path (str): The directory containing the manifest files.
+        - name (str, optional): The base name of the manifest files. Defaults to "iterable".
+
+    Returns:
+        A read-only memory-mapped numpy array (for numeric manifests) or a 
+        'Manifest' object ( also for the python numbers ), both supporting len() 
+        and zero-copy slicing.
+    """
+
+    with open( path +s+ name + ".json", "r" ) as fj :
+        header = json.load( fj )
+
+    if header.get( "scalars" ) :
+        return Manifest( path, name=name, kind="scalars" )
+    if header[ "kind" ] == "npy" :
+        return np.load( path +s+ name + ".npy", mmap_mode="r" )
+
+    return Manifest( path, name=name, kind=header[ "kind" ] )
+
+# -----------------------------------------------------------------------------
+class Manifest :
+    """
+    Read-only view of an offset-indexed binary manifest (see 'write_manifest').
+
+    Only the items actually accessed are read and decoded, so a task
+    iterating over its own slice needs O(chunk) memory, not O(N).
+
+    Args:
+        - path (str): The directory containing the manifest files.
+        - name (str, optional): The base name of the manifest files. Defaults to "iterable".
+        - kind (str, optional): The type of the items ("str", "bytes", "pickle", or "scalars" for 
+          the python numbers stored as an array). Defaults to "pickle".
+        - start (int, optional): The first item of the view. Defaults to 0.
+        - stop (int, optional): The end of the view (excluded). Defaults to None (the last item).
+    """
+
+    def __init__( self, path, name="iterable", kind="pickle", start=0, stop=None ) :
+
+        self.path = path
+        self.name = name
+        self.kind = kind
+        # The python numbers, memory-mapped
+        if kind == "scalars" :
+            self.array = np.load( path +s+ name + ".npy", mmap_mode="r" )
+            self.start, self.stop, _ = slice( start, stop ).indices( len( self.array ) )
+            self.stop = max( self.start, self.stop )
+            return
+        # The offsets of the items, memory-mapped
+        self.offsets = np.load( path +s+ name + ".idx.npy", mmap_mode="r" )
+        n = len( self.offsets ) - 1
+        self.start, self.stop, _ = slice( start, stop ).indices( n )
+        self.stop = max( self.start, self.stop )
+        # The items, memory-mapped ( an empty file cannot be memory-mapped )
+        if self.offsets[-1] > 0 :
+            self.data = np.memmap( path +s+ name + ".bin", dtype=np.uint8, mode="r" )
+        else :
+            self.data = np.zeros( 0, dtype=np.uint8 )
+
+    def __len__( self ) :
+
+        return self.stop - self.start
+
+    def _item( self, i ) :
+
+        # Decode the i-th item of the whole manifest
+        if self.kind == "scalars" :
+            return self.array[ i ].item()
+        raw = self.data[ self.offsets[ i ] : self.offsets[ i + 1 ] ].tobytes()
+        if self.kind == "str" :
+            return raw.decode( "utf-8" )
+        if self.kind == "bytes" :
+            return raw
+        return pickle.loads( raw )
+
+    def __getitem__( self, key ) :
+
+        # Slices return a new lazy view, without reading anything
+        if isinstance( key, slice ) :
+            start, stop, step = key.indices( len( self ) )
+            if step != 1 :
+                return [ self[ i ] for i in range( start, stop, step ) ]
+            return Manifest( self.path, name=self.name, kind=self.kind,
+                             start=self.start + start, stop=self.start + max( start, stop ) )
+
+        # Lists or arrays of indices return the list of the decoded items
+        if isinstance( key, ( list, tuple, np.ndarray ) ) :
+            return [ self[ i ] for i in key ]
+
+        # Integers return the decoded item
+        key = int( key )
+        if key < 0 :
+            key = key + len( self )
+        if not 0 <= key < len( self ) :
+            raise IndexError( "Manifest index out of range" )
+
+        return self._item( self.start + key )
+
+    def __iter__( self ) :
+
+        if self.kind == "scalars" :
+            # Converted by blocks, not to convert the items one by one
+            for a in range( self.start, self.stop, 65536 ) :
+                yield from self.array[ a : min( a + 65536, self.stop ) ].tolist()
+            return
+        for i in range( self.start, self.stop ) :
+            yield self._item( i )
+
+# -----------------------------------------------------------------------------
+def write_stream_shards( path, iterable, shard_size ) :
+    """
+    Consume an iterable once ( e.g. a generator, whose length is unknown ) and write its items 
+    to shard files of 'shard_size' items each, 'path/shard_<k>.pkl' with k = 1, 2, ..., 
+    keeping in memory only the item being written. The items are pickled one after the other,
+    so that a task reads its shard as a stream (see 'read_stream_shard').
+
+    Args:
+        - path (str): The directory where the shard files will be saved.
+        - iterable (iterable): The items.
+        - shard_size (int): The number of items of each shard.
+
+    Returns:
+        - int: The number of items.
+        - int: The number of shards.
+    """
+
+    os.makedirs( path, exist_ok=True )
+
+    n = 0
+    fs = None
+    try :
+        for item in iterable :
+            # Start a new shard
+            if n % shard_size == 0 :
+                if fs is not None :
+                    fs.close()
+                fs = open( path +s+ f"shard_{n // shard_size + 1}.pkl", "wb" )
+            pickle.dump( item, fs, protocol=pickle.HIGHEST_PROTOCOL )
+            n = n + 1
+    finally :
+        if fs is not None :
+            fs.close()
+    nshards = ( n + shard_size - 1 ) // shard_size
+
+    # Remove the shards of a previous, longer stream
+    for fname in os.listdir( path ) :
+        if fname.startswith( "shard_" ) and fname.endswith( ".pkl" ) and int( fname[ 6:-4 ] ) > nshards :
+            os.remove( path +s+ fname )
+
+    # Write the header describing the shards
+    with open( path +s+ "stream.json", "w" ) as fj :
+        json.dump( { "n": n, "shard_size": int( shard_size ), "shards": nshards }, fj )
+
+    return n, nshards
+
+# -----------------------------------------------------------------------------
+def read_stream_shard( path, itask ) :
+    """
+    Yield the items of a shard written by 'write_stream_shards', one at a time.
+
+    Args:
+        - path (str): The directory of the shard files.
+        - itask (int): The shard number, i.e. the SLURM_ARRAY_TASK_ID (starting from 1).
+
+    Yields:
+        The items of the shard.
+    """
+
+    with open( path +s+ f"shard_{itask}.pkl", "rb" ) as fs :
+        while True :
+            try :
+                yield pickle.load( fs )
+            except EOFError :
+                return
+
+# -----------------------------------------------------------------------------
+def write_snapshot( path, values, mmap_min=1 << 20 ) :
+    """
+    Save a set of variables to a snapshot directory, read by 'load_snapshot'.
+
+    The numeric numpy arrays larger than 'mmap_min' bytes are saved as '.npy' files, 
+    memory-mapped by the tasks (so that the tasks on the same node share the page cache), 
+    the other variables are pickled together in 'globals.pkl'.
+
+    Args:
+        - path (str): The snapshot directory.
+        - values (dict): The variables.
+        - mmap_min (int, optional): The minimum size in bytes of the memory-mapped arrays. Defaults to 1 MB.
+
+    Returns:
+        list: The names of the variables saved as '.npy' files.
+    """
+
+    if os.path.exists( path ) :
+        shutil.rmtree( path )
+    os.makedirs( path, exist_ok=True )
+
+    arrays = []
+    others = {}
+    for name, value in values.items() :
+        if isinstance( value, np.ndarray ) and not value.dtype.hasobject and value.nbytes >= mmap_min :
+            np.save( path +s+ name + ".npy", value )
+            arrays.append( name )
+        else :
+            try :
+                pickle.dumps( value, protocol=pickle.HIGHEST_PROTOCOL )
+            except Exception as e :
+                raise ValueError( f"The prelude variable '{name}' cannot be pickled ( {e} ), use snapshot=False" )
+            others[ name ] = value
+
+    with open( path +s+ "globals.pkl", "wb" ) as fp :
+        pickle.dump( others, fp, protocol=pickle.HIGHEST_PROTOCOL )
+    with open( path +s+ "snapshot.json", "w" ) as fj :
+        json.dump( { "arrays": arrays, "pickled": sorted( others ) }, fj )
+
+    return arrays
+
+# -----------------------------------------------------------------------------
+def load_snapshot( path ) :
+    """
+    Load the variables saved by 'write_snapshot'.
+
+    The large arrays are memory-mapped copy-on-write: they are read from the page cache 
+    shared by the tasks on the node, and a task modifying them only changes its own copy.
+
+    Args:
+        - path (str): The snapshot directory.
+
+    Returns:
+        dict: The variables.
+    """
+
+    with open( path +s+ "snapshot.json", "r" ) as fj :
+        header = json.load( fj )
+    with open( path +s+ "globals.pkl", "rb" ) as fp :
+        values = pickle.load( fp )
+    for name in header[ "arrays" ] :
+        values[ name ] = np.load( path +s+ name + ".npy", mmap_mode="c" )
+
+    return values
+
+# -----------------------------------------------------------------------------
+def _snapshot_prelude( path, source, ifor=0, modules=[], alias=[], filename="<parfor>" ) :
+    """
+    Run the prelude of the 'ifor'-th loop once, and save the variables it computes 
+    that are read by the rest of the code to a snapshot (see 'write_snapshot').
+
+    The imports, the function and class definitions, and the statements acting on 
+    modules ( e.g. 'np.random.seed( 0 )', 'sys.path.append( ... )' ) are still run by 
+    the tasks; the other prelude statements are replaced by the snapshot.
+
+    Args:
+        - path (str): The snapshot directory.
+        - source (str): The python source code containing the loop.
+        - ifor (int, optional): The index of the for loop. Defaults to 0.
+        - modules (list, optional): Additional modules available to the code. Defaults to [].
+        - alias (list, optional): The aliases of the additional modules. Defaults to [].
+        - filename (str, optional): The file name used in tracebacks. Defaults to "<parfor>".
+
+    Returns:
+        - The iterable of the loop.
+        - ast.For: The for-loop node.
+        - ast.Module: The parsed source.
+        - list: The top-level statements replaced by the snapshot.
+    """
+
+    tree, for_node, istmt = _find_loop( source, ifor=ifor, filename=filename )
+    prelude = tree.body[ :istmt ]
+
+    # Run the whole prelude, with the additional modules
+    scope = { "__name__": "__main__", "_cp": sys.modules[ __name__ ] }
+    for im, module in enumerate( modules ) :
+        name = alias[ im ] if im < len( alias ) else module.split( "." )[0]
+        exec( f"import {module} as {name}" if name != module.split( "." )[0] else f"import {module}", scope )
+    iter_value = _run_prelude( prelude, scope, filename, expr=for_node.iter )
+
+    # The names of the modules acted on by a statement: bare calls ( 'np.random.seed( 0 )' ) 
+    # and assignments ( 'os.environ[ "X" ] = "1"' )
+    module_type = type( os )
+    def acts_on_modules( stmt ) :
+        if isinstance( stmt, ast.Expr ) :
+            names = _mutated_names( stmt )
+        elif isinstance( stmt, ( ast.Assign, ast.AugAssign, ast.AnnAssign ) ) :
+            targets = stmt.targets if isinstance( stmt, ast.Assign ) else [ stmt.target ]
+            names = set()
+            for target in targets :
+                names = names | _mutated_names( ast.Assign( targets=[ target ], value=ast.Constant( None ) ) )
+        else :
+            names = _mutated_names( stmt )
+        return any( isinstance( scope.get( name ), module_type ) for name in names )
+
+    # The statements replaced by the snapshot
+    definitions = ( ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef )
+    removed = [ stmt for stmt in prelude 
+                if not isinstance( stmt, definitions ) and not acts_on_modules( stmt ) ]
+    kept = [ stmt for stmt in prelude if stmt not in removed ]
+
+    # The variables computed by the removed statements and read by the rest of the code, 
+    # also those assigned by the functions declaring them global ( e.g. called by a removed 'setup()' )
+    computed = set()
+    for stmt in removed :
+        computed = computed | _bound_names( stmt ) | _mutated_names( stmt )
+    for stmt in prelude :
+        computed = computed | _global_names( stmt )
+    read = set()
+    for stmt in kept + tree.body[ istmt: ] :
+        read = read | _used_names( stmt )
+    values = { name: scope[ name ] for name in sorted( computed & read ) 
+               if name in scope and not isinstance( scope[ name ], module_type ) }
+    write_snapshot( path, values )
+
+    return iter_value, for_node, tree, removed
+
+# -----------------------------------------------------------------------------
+def balanced_partition( weights, nbins ) :
+    """
+    Partition a set of weighted items into 'nbins' bins with similar total weight,
+    using the greedy LPT (Longest Processing Time first) algorithm: the items are 
+    sorted by decreasing weight and each one is assigned to the least loaded bin.
+
+    Args:
+        - weights (array-like): The cost of each item.
+        - nbins (int): The number of bins.
+
+    Returns:
+        - list: The sorted indices of the items assigned to each bin.
+        - numpy.ndarray: The total weight of each bin.
+    """
+
+    weights = np.asarray( weights, dtype=float )
+    if np.any( weights < 0 ) :
+        raise ValueError( "The weights must be non-negative." )
+
+    # Heap of ( load, bin ) pairs: the least loaded bin is always on top
+    heap = [ ( 0.0, b ) for b in range( nbins ) ]
+    bins = [ [] for _ in range( nbins ) ]
+    loads = np.zeros( nbins )
+    for i in np.argsort( -weights, kind="stable" ) :
+        load, b = heapq.heappop( heap )
+        bins[ b ].append( i )
+        loads[ b ] = load + weights[ i ]
+        heapq.heappush( heap, ( loads[ b ], b ) )
+
+    # Keep the original order of the items inside each bin
+    bins = [ np.sort( np.asarray( b, dtype=np.int64 ) ) for b in bins ]
+
+    return bins, loads
+
+# -----------------------------------------------------------------------------
+def write_partition( path, bins, name="partition" ) :
+    """
+    Write the lists of indices assigned to each task of a job array.
+
+    The indices of all the tasks are concatenated in '<name>.npy', 
+    and the offsets of each task are stored in '<name>.idx.npy'.
+
+    Args:
+        - path (str): The directory where the files will be saved.
+        - bins (list): The arrays of indices of each task.
+        - name (str, optional): The base name of the files. Defaults to "partition".
+    """
+
+    # Check if the directory specified by 'path' exists
+    if os.path.exists( path ) == False :
+        # If not, create the directory
+        os.makedirs( path, exist_ok=True )
+
+    offsets = np.zeros( len( bins ) + 1, dtype=np.int64 )
+    offsets[ 1: ] = np.cumsum( [ len( b ) for b in bins ] )
+    indices = np.concatenate( bins ).astype( np.int64 ) if bins else np.zeros( 0, dtype=np.int64 )
+
+    np.save( path +s+ name + ".npy", indices )
+    np.save( path +s+ name + ".idx.npy", offsets )
+
+# -----------------------------------------------------------------------------
+def load_partition( path, itask, name="partition" ) :
+    """
+    Read the indices assigned to one task of a job array (see 'write_partition').
+
+    Args:
+        - path (str): The directory containing the partition files.
+        - itask (int): The task ID, i.e. the SLURM_ARRAY_TASK_ID (starting from 1).
+        - name (str, optional): The base name of the files. Defaults to "partition".
+
+    Returns:
+        numpy.ndarray: The indices of the iterations assigned to the task.
+    """
+
+    offsets = np.load( path +s+ name + ".idx.npy", mmap_mode="r" )
+    indices = np.load( path +s+ name + ".npy", mmap_mode="r" )
+
+    return np.array( indices[ offsets[ itask - 1 ] : offsets[ itask ] ] )
+
+# -----------------------------------------------------------------------------
+def take( iterable, indices ) :
+    """
+    Select the items of an iterable at the given indices.
+
+    Args:
+        - iterable (iterable): The object to select from.
+        - indices (array-like): The sorted indices of the items to be selected.
+
+    Returns:
+        The selected items (a numpy array if 'iterable' is an array, a list otherwise).
+    """
+
+    if isinstance( iterable, np.ndarray ) :
+        return iterable[ np.asarray( indices, dtype=np.int64 ) ]
+
+    # Sequences ( list, tuple, range, Manifest, ... ) are accessed randomly
+    if hasattr( iterable, "__getitem__" ) and hasattr( iterable, "__len__" ) and \
+       not isinstance( iterable, dict ) :
+        return [ iterable[ int( i ) ] for i in indices ]
+
+    # Other iterables are scanned once
+    wanted = set( int( i ) for i in indices )
+    return [ v for i, v in enumerate( iterable ) if i in wanted ]
+
+# -----------------------------------------------------------------------------
+class Product :
+    """
+    The Cartesian product of several sequences, indexed by a flat index without 
+    materializing it: the flat index k maps to the tuple of indices of the sequences 
+    in row-major order ( the last sequence varies fastest ), as nested loops would 
+    visit them. Slices are products too, so the tasks of a parfor job over nested loops 
+    select their range of the flat index space with 'Product( A, B )[ imin : imax ]'.
+
+    Args:
+        - *iterables : The sequences ( other iterables are converted to lists ).
+    """
+
+    def __init__( self, *iterables, flat=None ) :
+
+        self.iterables = [ it if hasattr( it, "__getitem__" ) and hasattr( it, "__len__" ) 
+                           and not isinstance( it, dict ) else list( it ) for it in iterables ]
+        self.shape = tuple( len( it ) for it in self.iterables )
+        size = 1
+        for n in self.shape :
+            size = size * n
+        # The flat indices of the items, a range of the whole product
+        self.flat = range( size ) if flat is None else flat
+
+    def __len__( self ) :
+
+        return len( self.flat )
+
+    def unravel( self, k ) :
+        """
+        Return the indices in each sequence of the item with flat index k ( in the whole product ).
+        """
+
+        indices = []
+        for n in reversed( self.shape ) :
+            k, i = divmod( k, n )
+            indices.append( i )
+
+        return tuple( reversed( indices ) )
+
+    def __getitem__( self, key ) :
+
+        if isinstance( key, slice ) :
+            return Product( *self.iterables, flat=self.flat[ key ] )
+
+        indices = self.unravel( self.flat[ key ] )
+
+        return tuple( it[ i ] for it, i in zip( self.iterables, indices ) )
+
+    def __iter__( self ) :
+
+        for k in range( len( self.flat ) ) :
+            yield self[ k ]
+
+# -----------------------------------------------------------------------------
+def profile_items( iterable, out_file ) :
+    """
+    Yield the items of an iterable, measuring the time and the memory of the loop body 
+    run on each of them, and save the measures to 'out_file' (used by '_autosize').
+
+    Args:
+        - iterable (iterable): The items of the loop.
+        - out_file (str): The JSON file of the measures.
+    """
+
+    proc = psutil.Process()
+    # The time from the start of the process to the loop ( imports, prelude )
+    startup = Time.time() - proc.create_time()
+    rss0 = proc.memory_info().rss
+    times = []
+    rss = []
+    try :
+        for item in iterable :
+            t0 = Time.perf_counter()
+            yield item
+            times.append( Time.perf_counter() - t0 )
+            rss.append( proc.memory_info().rss )
+    finally :
+        with open( out_file, "w" ) as fj :
+            json.dump( { "startup": startup, "rss0": rss0, "times": times, "rss": rss }, fj )
+
+# -----------------------------------------------------------------------------
+def _slurm_time_str( seconds ) :
+    """
+    Format a number of seconds as a SLURM time limit ( "H:MM:SS" or "D-HH:MM:SS" ).
+    """
+
+    seconds = int( np.ceil( seconds ) )
+    days, seconds = divmod( seconds, 86400 )
+    hours, seconds = divmod( seconds, 3600 )
+    minutes, seconds = divmod( seconds, 60 )
+    if days > 0 :
+        return f"{days}-{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+# -----------------------------------------------------------------------------
+def _autosize( path, source, for_node, n, modules=[], alias=[], sample=5, 
+               target_time=1800.0, margin=1.5, timeout=None ) :
+    """
+    Choose the chunk size, the time limit and the memory of the tasks of a parfor job
+    by running a random sample of the loop iterations locally, in a subprocess.
+
+    The code following the loop is not run. The time of each sampled iteration and the startup 
+    time of the process ( imports and prelude ) give the iterations per task that fill 'target_time'.
+    The memory is the peak resident memory of the process ( and its children ), 
+    plus the growth per iteration measured over the sample, times the chunk size.
+    Time and memory are multiplied by the safety 'margin'.
+
+    Args:
+        - path (str): The job directory ( the profile files are saved in 'path/autosize' ).
+        - source (str): The python source code containing the loop.
+        - for_node (ast.For): The for-loop node.
+        - n (int): The number of iterations of the loop.
+        - modules (list, optional): Additional modules imported by the code. Defaults to [].
+        - alias (list, optional): The aliases of the additional modules. Defaults to [].
+        - sample (int, optional): The number of iterations to run. Defaults to 5.
+        - target_time (float, optional): The target duration of each task in seconds. Defaults to 1800.
+        - margin (float, optional): The safety factor of the time and memory requests. Defaults to 1.5.
+        - timeout (float, optional): The maximum duration of the profiling in seconds. 
+          Defaults to None ( 'target_time' ).
+
+    Returns:
+        dict: The chosen "chunk_size", "time" ( SLURM format ) and "mem" ( MB ), and the measures.
+    """
+
+    prof_dir = path +s+ "autosize"
+    os.makedirs( prof_dir, exist_ok=True )
+
+    # A random sample of the iterations
+    rng = np.random.default_rng( 0 )
+    indices = np.sort( rng.choice( n, size=min( sample, n ), replace=False ) )
+    np.save( prof_dir +s+ "indices.npy", indices )
+
+    # The code up to the end of the loop ( the code following it is not profiled, and must not 
+    # overwrite any output ), or of the top-level statement containing it if the cut code is not valid
+    lines = source.split( "\n" )
+    tree = ast.parse( source )
+    top = [ stmt for stmt in tree.body if stmt.lineno <= for_node.lineno <= stmt.end_lineno ][0]
+    for end in ( for_node.end_lineno, top.end_lineno ) :
+        try :
+            ast.parse( "\n".join( lines[ :end ] ) )
+            break
+        except SyntaxError :
+            continue
+    lines = lines[ :end ]
+    # The loop runs on the sampled items only
+    iter_text = _source_segment( lines, for_node.iter )
+    _replace_segment( lines, for_node.iter, 
+                      f"_cp.profile_items( _cp.take( {iter_text}, _cp_sample ), {prof_dir +s+ 'profile.json'!r} )" )
+    header = [ "import sys" ] + _runtime_import_lines()
+    for im, module in enumerate( modules ) :
+        header.append( f"import {module}" + ( f" as {alias[ im ]}" if im < len( alias ) else "" ) )
+    header.append( f"_cp_sample = _cp.np.load( {prof_dir +s+ 'indices.npy'!r} )" )
+    with open( prof_dir +s+ "profile.py", "w" ) as fp :
+        fp.write( "\n".join( header + lines ) + "\n" )
+
+    # Run it, following the memory of the process and of its children
+    timeout = timeout or target_time
+    t0 = Time.time()
+    with open( prof_dir +s+ "profile.err", "w" ) as ferr :
+        proc = psutil.Popen( [ sys.executable, prof_dir +s+ "profile.py" ], cwd=path, 
+                             stdout=subprocess.DEVNULL, stderr=ferr )
+        peak = 0
+        while proc.poll() is None :
+            try :
+                peak = max( peak, sum( p.memory_info().rss for p in [ proc ] + proc.children( recursive=True ) ) )
+            except psutil.Error :
+                pass
+            if Time.time() - t0 > timeout :
+                proc.kill()
+                raise RuntimeError( f"The profiling of the loop took more than {timeout:.0f} s, "
+                                    "reduce 'autosize_sample' or size the job manually." )
+            Time.sleep( 0.05 )
+    if proc.returncode != 0 :
+        with open( prof_dir +s+ "profile.err", "r" ) as ferr :
+            raise RuntimeError( f"The profiling of the loop failed:\n{ferr.read()}" )
+
+    with open( prof_dir +s+ "profile.json", "r" ) as fj :
+        measures = json.load( fj )
+    times = np.asarray( measures[ "times" ] )
+    rss = np.asarray( [ measures[ "rss0" ] ] + measures[ "rss" ], dtype=float )
+    peak = max( peak, rss.max() )
+
+    # The cost model: startup + chunk_size * time per iteration, peak + chunk_size * memory growth
+    t_iter = times.mean() if len( times ) > 0 else 0.0
+    startup = measures[ "startup" ]
+    growth = max( 0.0, np.polyfit( np.arange( len( rss ) ), rss, 1 )[0] ) if len( rss ) > 2 else 0.0
+    if t_iter > 0 :
+        chunk_size = int( max( 1, ( target_time - startup ) // t_iter ) )
+    else :
+        chunk_size = n
+    chunk_size = int( min( chunk_size, n ) )
+
+    task_time = startup + chunk_size * t_iter
+    task_mem = peak + growth * max( 0, chunk_size - len( times ) )
+    plan = { "chunk_size": chunk_size, 
+             "chunks": int( np.ceil( n / chunk_size ) ), 
+             "time": _slurm_time_str( max( 60.0, margin * task_time ) ), 
+             "mem": int( np.ceil( margin * task_mem / 1024 ** 2 / 100 ) * 100 ), 
+             "seconds_per_iteration": float( t_iter ), 
+             "startup": float( startup ), 
+             "peak_rss_mb": float( peak / 1024 ** 2 ), 
+             "growth_mb_per_iteration": float( growth / 1024 ** 2 ), 
+             "task_time": float( task_time ) }
+    with open( prof_dir +s+ "plan.json", "w" ) as fj :
+        json.dump( plan, fj, indent=1 )
+
+    print( f"autosize : {len( times )} sampled iterations, {t_iter:.4g} s/iteration "
+           f"(+ {startup:.1f} s startup), peak memory {peak / 1024 ** 2:.0f} MB "
+           f"(+ {growth / 1024 ** 2:.3g} MB/iteration)" )
+    print( f"autosize : chunk_size={chunk_size} -> {plan[ 'chunks' ]} tasks of ~{task_time:.0f} s, "
+           f"--time={plan[ 'time' ]}, --mem={plan[ 'mem' ]} (margin {margin})" )
+
+    return plan
+
+# -----------------------------------------------------------------------------
+def write_queue( path, n, batch_size, weights=None, indices=None ) :
+    """
+    Create a work queue for the "dynamic" schedule of a job array.
+
+    Each batch of iterations is an empty file in 'path/todo', whose name encodes 
+    its position in the queue and its index range ( e.g. '00000012_120_130' ). 
+    A task claims a batch by renaming it into 'path/claimed' and, once the batch 
+    is processed, moves it into 'path/done'. A rename within the same file system 
+    is atomic (also on GPFS and Lustre), so each batch is processed by exactly 
+    one task, without locks and without reading any file content.
+
+    Args:
+        - path (str): The queue directory (any existing queue is removed).
+        - n (int): The number of iterations.
+        - batch_size (int): The number of iterations per batch.
+        - weights (array-like, optional): The expected cost of each iteration. If given, 
+          the batches are queued in order of decreasing total cost. Defaults to None.
+        - indices (array-like, optional): The sorted indices of the iterations to be queued.
+          Defaults to None (all the 'n' iterations).
+
+    Returns:
+        int: The number of batches.
+    """
+
+    # Remove any previous queue and create the queue directories
+    if os.path.exists( path ) :
+        shutil.rmtree( path )
+    for sub in ( "todo", "claimed", "done" ) :
+        os.makedirs( path +s+ sub, exist_ok=True )
+
+    # Split the runs of consecutive indices in batches
+    if indices is None :
+        runs = [ ( 0, n ) ] if n > 0 else []
+    else :
+        indices = np.asarray( indices, dtype=np.int64 )
+        breaks = np.flatnonzero( np.diff( indices ) != 1 ) + 1
+        runs = [ ( int( r[0] ), int( r[-1] ) + 1 ) for r in np.split( indices, breaks ) if len( r ) ]
+    batches = [ ( a, min( a + batch_size, b ) ) for a0, b in runs for a in range( a0, b, batch_size ) ]
+
+    # The most expensive batches are processed first
+    ordered = weights is not None
+    if ordered :
+        cumulative = np.concatenate( [ [0.0], np.cumsum( np.asarray( weights, dtype=float ) ) ] )
+        batches = sorted( batches, key=lambda ab : cumulative[ ab[0] ] - cumulative[ ab[1] ] )
+
+    for seq, ( a, b ) in enumerate( batches ) :
+        open( path +s+ "todo" +s+ f"{seq:08d}_{a}_{b}", "w" ).close()
+
+    # Write the header describing the queue
+    with open( path +s+ "queue.json", "w" ) as fj :
+        json.dump( { "n": int( n ), "batches": len( batches ), "ordered": ordered }, fj )
+
+    return len( batches )
+
+# -----------------------------------------------------------------------------
+def claim_items( iterable, path, itask=1, ntasks=1, indexed=False ) :
+    """
+    Yield the items of an iterable claimed batch by batch from a work queue 
+    (see 'write_queue'), until the queue is empty.
+
+    The directory of the pending batches is listed only once; each task then 
+    tries to claim the batches starting from its own share of the queue 
+    (or from the first one, if the queue is ordered by cost) and wrapping around, 
+    so that the tasks seldom compete for the same batch. A batch is marked 
+    as done when the item following its last one is requested.
+
+    Args:
+        - iterable (iterable): The whole loop iterable ( a sequence, or an iterable converted to a list ).
+        - path (str): The queue directory.
+        - itask (int, optional): The task ID, i.e. the SLURM_ARRAY_TASK_ID (starting from 1). Defaults to 1.
+        - ntasks (int, optional): The number of tasks of the job array. Defaults to 1.
+        - indexed (bool, optional): Whether to yield ( index, item ) pairs. Defaults to False.
+
+    Yields:
+        The items of the claimed batches.
+    """
+
+    # Random access is needed to slice the batches
+    if not ( hasattr( iterable, "__getitem__" ) and hasattr( iterable, "__len__" ) ) :
+        iterable = list( iterable )
+
+    with open( path +s+ "queue.json", "r" ) as fj :
+        header = json.load( fj )
+
+    names = sorted( os.listdir( path +s+ "todo" ) )
+    start = 0 if header[ "ordered" ] else ( ( itask - 1 ) * len( names ) ) // max( ntasks, 1 )
+
+    for name in names[ start: ] + names[ :start ] :
+        # Claim the batch, if no other task did it before
+        try :
+            os.rename( path +s+ "todo" +s+ name, path +s+ "claimed" +s+ name )
+        except FileNotFoundError :
+            continue
+        a, b = [ int( v ) for v in name.split( "_" )[ 1: ] ]
+        for i, item in enumerate( iterable[ a : b ], a ) :
+            yield ( i, item ) if indexed else item
+        # Mark the batch as done
+        os.rename( path +s+ "claimed" +s+ name, path +s+ "done" +s+ name )
+
+# -----------------------------------------------------------------------------
+def _pool_call( item ) :
+    """
+    Call the function set by 'pool_map' in a worker of the process pool.
+
+    Args:
+        - item: The argument of the function.
+
+    Returns:
+        The result of the function.
+    """
+
+    return _pool_func( item )
+
+# -----------------------------------------------------------------------------
+def pool_map( func, iterable, kind="process", workers=None, chunksize=None ) :
+    """
+    Apply a function to all the items of an iterable using a pool of 
+    processes or threads, yielding the results in the order of the items.
+
+    Processes are created with the "fork" start method, so 'func' 
+    (e.g. the body of a loop, with its closures) is not pickled: only the 
+    items and the results are sent between processes. Threads are useful 
+    when 'func' spends its time in code releasing the GIL (e.g. NumPy).
+
+    Args:
+        - func (callable): The function to be applied.
+        - iterable (iterable): The items.
+        - kind (str, optional): "process" or "thread". Defaults to "process".
+        - workers (int, optional): The size of the pool. Defaults to None, i.e. 
+          the SLURM_CPUS_PER_TASK environment variable or the number of CPUs available.
+        - chunksize (int, optional): The number of items sent to a worker at once. 
+          Defaults to None, i.e. about 4 chunks per worker (1 if the length is unknown).
+
+    Yields:
+        The result of 'func' for each item.
+    """
+
+    global _pool_func
+
+    if kind not in ( "process", "thread" ) :
+        raise ValueError( f"Unknown pool kind '{kind}', use 'process' or 'thread'." )
+
+    if workers is None :
+        workers = int( os.environ.get( "SLURM_CPUS_PER_TASK", len( os.sched_getaffinity( 0 ) ) 
+                       if hasattr( os, "sched_getaffinity" ) else os.cpu_count() ) )
+
+    # A single worker runs the function serially, without any overhead
+    if workers <= 1 :
+        for item in iterable :
+            yield func( item )
+        return
+
+    if chunksize is None :
+        chunksize = max( 1, len( iterable ) // ( workers * 4 ) ) if hasattr( iterable, "__len__" ) else 1
+
+    if kind == "thread" :
+        pool = multiprocessing.pool.ThreadPool( workers )
+        call = func
+    else :
+        _pool_func = func
+        pool = multiprocessing.get_context( "fork" ).Pool( workers )
+        call = _pool_call
+
+    try :
+        for result in pool.imap( call, iterable, chunksize ) :
+            yield result
+    finally :
+        pool.terminate()
+        pool.join()
+
+# The function called by the workers of 'pool_map' ( inherited when forking )
+_pool_func = None
+
+# -----------------------------------------------------------------------------
+def _loop_to_function( lines, for_node, runner, sink="pass", result=None, indexed=False ) :
+    """
+    Rewrite a for-loop as a function applied to each item, i.e.
+
+        for TARGET in ITER :            def _cp_body( _cp_item ) :
+            BODY                  -->       TARGET = _cp_item
+                                            BODY
+                                            return RESULT
+                                        for _cp_result in RUNNER :
+                                            SINK
+
+    where RUNNER is an expression calling '_cp_body' on the items (e.g. a pool map).
+    The 'continue' statements of the loop body become 'return' statements, 
+    while 'break' statements are not supported. If 'indexed' is True, the
+    items are ( index, item ) pairs and '_cp_body' returns ( index, RESULT ), 
+    or ( index, SKIPPED ) for the iterations ended by a 'continue'.
+
+    Args:
+        - lines (list): The source code lines (modified in place).
+        - for_node (ast.For): The for-loop node.
+        - runner (str): The expression yielding the results of '_cp_body'.
+        - sink (str, optional): The statement consuming each '_cp_result'. Defaults to "pass".
+        - result (str, optional): The expression returned by '_cp_body'. Defaults to None.
+        - indexed (bool, optional): Whether the items are paired with their index. Defaults to False.
+    """
+
+    body = for_node.body
+    first = min( [ body[0].lineno ] + [ d.lineno for d in getattr( body[0], "decorator_list", [] ) ] )
+    if first == for_node.lineno :
+        raise ValueError( f"The body of the loop at line {for_node.lineno} must start on a new line." )
+
+    # The 'continue'/'break' statements of this loop ( not those of nested loops or functions )
+    jumps = []
+    todo = list( body )
+    while todo :
+        sub = todo.pop()
+        if isinstance( sub, ( ast.Continue, ast.Break ) ) :
+            jumps.append( sub )
+        if not isinstance( sub, ( ast.For, ast.AsyncFor, ast.While, ast.FunctionDef, 
+                                  ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda ) ) :
+            todo.extend( ast.iter_child_nodes( sub ) )
+    if any( isinstance( j, ast.Break ) for j in jumps ) :
+        raise ValueError( f"'break' statements are not supported in the body of the loop at line {for_node.lineno}." )
+
+    indent = lines[ for_node.lineno - 1 ][ :for_node.col_offset ]
+    body_indent = lines[ body[0].lineno - 1 ][ :body[0].col_offset ]
+    if indexed :
+        ret = f"return _cp_index, {result}"
+        skip = "return _cp_index, _cp.SKIPPED"
+    else :
+        ret = "return" if result is None else f"return {result}"
+        skip = "return"
+
+    # 1) The loop running the function, after the body ( and before any 'else' clause )
+    last = body[-1].end_lineno
+    lines[ last : last ] = ( [ f"{body_indent}{ret}" ] if ( result is not None or indexed ) else [] ) + \
+                           [ f"{indent}for _cp_result in {runner} :", f"{indent}    {sink}" ]
+
+    # 2) The 'continue' statements, from the last one
+    for j in sorted( jumps, key=lambda j : ( j.lineno, j.col_offset ), reverse=True ) :
+        _replace_segment( lines, j, skip )
+
+    # 3) The function header, replacing the loop header
+    target = _source_segment( lines, for_node.target )
+    if indexed :
+        target = f"_cp_index, ( {target} )"
+    lines[ for_node.lineno - 1 : first - 1 ] = [ f"{indent}def _cp_body( _cp_item ) :",
+                                                 f"{body_indent}{target} = _cp_item" ]
+
+# -----------------------------------------------------------------------------
+def _run_id() :
+    """
+    Return an identifier of the current run of a task, unique across 
+    resubmissions ( the SLURM job ID, or the process ID when run locally ).
+
+    Returns:
+        str: The run identifier.
+    """
+
+    if "SLURM_JOB_ID" in os.environ :
+        return os.environ[ "SLURM_JOB_ID" ]
+
+    return f"local{os.getpid()}"
+
+# -----------------------------------------------------------------------------
+def _npy_header( dtype, shape, size=128 ) :
+    """
+    Build a '.npy' (version 1.0) header padded to a fixed size, so that it can be
+    rewritten in place once the final shape of a streamed array is known.
+
+    Args:
+        - dtype (numpy.dtype): The data type of the array.
+        - shape (tuple): The shape of the array.
+        - size (int, optional): The total size of the header in bytes. Defaults to 128.
+
+    Returns:
+        bytes: The header.
+    """
+
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % ( 
+             np.lib.format.dtype_to_descr( np.dtype( dtype ) ), tuple( shape ) )
+    header = header.ljust( size - 10 - 1 ) + "\n"
+
+    return b"\x93NUMPY\x01\x00" + struct.pack( "<H", len( header ) ) + header.encode( "latin1" )
+
+# -----------------------------------------------------------------------------
+class _Skipped :
+    """
+    The type of 'SKIPPED', the result of the iterations ended by a 'continue'.
+    It is pickled by reference, so it is still 'SKIPPED' when sent between processes.
+    """
+
+    def __reduce__( self ) :
+
+        return "SKIPPED"
+
+    def __repr__( self ) :
+
+        return "SKIPPED"
+
+SKIPPED = _Skipped()
+
+# -----------------------------------------------------------------------------
+class ShardWriter :
+    """
+    Write the results of the iterations of one task to a compact binary shard.
+
+    As long as all the results are numeric arrays (or scalars) with the same 
+    shape and data type, they are streamed to 'shard.<task>.<run>.npy', with 
+    their iteration indices in 'shard.<task>.<run>.idx' (a '.npy' file too).
+    Otherwise, the results are written as a stream of pickles, followed by 
+    an index footer ( iteration indices, offsets, number of results and a
+    magic string ) in 'shard.<task>.<run>.pkl'. The shard becomes visible only 
+    when it is closed, so partial shards of killed tasks are never read.
+
+    When 'interval' is given, the current shard is closed and a new one
+    (with an increasing part number in its name) is opened every 'interval'
+    seconds, so that the results computed so far survive a task failure; 
+    the indices of each closed shard are then marked as done in 'checkpoint'.
+
+    Args:
+        - path (str): The directory of the shards.
+        - itask (int): The task ID.
+        - interval (float, optional): The time in seconds after which a new shard is started. 
+          Defaults to None (a single shard per task).
+        - checkpoint (Checkpoint, optional): The completion bitmap updated when a shard is closed. 
+          Defaults to None.
+    """
+
+    MAGIC = b"CPSHARD1"
+
+    def __init__( self, path, itask, interval=None, checkpoint=None ) :
+
+        os.makedirs( path, exist_ok=True )
+        self.base = path +s+ f"shard.{int( itask ):06d}.{_run_id()}"
+        self.interval = interval
+        self.checkpoint = checkpoint
+        self.part = 0
+        self.closed = False
+        self._open()
+
+    def _open( self ) :
+
+        # Start a new (empty) shard
+        self.name = self.base + f".{self.part:04d}"
+        self.indices = []
+        self.offsets = [ 0 ]
+        self.numeric = True
+        self.dtype = None
+        self.shape = None
+        self.file = open( self.name + ".npy.tmp", "wb" )
+        self.start = Time.time()
+
+    def _to_pickle( self ) :
+
+        # Convert the numeric values written so far to the pickle stream
+        self.file.close()
+        values = np.fromfile( self.name + ".npy.tmp", dtype=self.dtype, 
+                              offset=128 ).reshape( ( -1, ) + self.shape ) if self.indices else []
+        self.file = open( self.name + ".pkl.tmp", "wb" )
+        self.numeric = False
+        for v in values :
+            self._write_pickle( v if self.shape else v[ () ] )
+        os.remove( self.name + ".npy.tmp" )
+
+    def _write_pickle( self, value ) :
+
+        data = pickle.dumps( value, protocol=pickle.HIGHEST_PROTOCOL )
+        self.file.write( data )
+        self.offsets.append( self.offsets[-1] + len( data ) )
+
+    def write( self, index, value ) :
+        """
+        Write the result of one iteration.
+
+        Args:
+            - index (int): The index of the iteration.
+            - value: The result of the iteration ( nothing is written if it is 'SKIPPED' ).
+        """
+
+        if value is SKIPPED :
+            # The iteration is completed anyway
+            if self.checkpoint is not None :
+                self.checkpoint.mark( index )
+            return
+
+        written = False
+        if self.numeric :
+            array = np.asarray( value ) if isinstance( value, ( np.ndarray, np.generic, bool, int, float, complex ) ) else None
+            if array is not None and array.dtype.kind in "biufc" and \
+               ( self.dtype is None or ( array.dtype == self.dtype and array.shape == self.shape ) ) :
+                if self.dtype is None :
+                    self.dtype, self.shape = array.dtype, array.shape
+                    self.file.write( _npy_header( self.dtype, ( 0, ) + self.shape ) )
+                self.file.write( np.ascontiguousarray( array ).tobytes() )
+                written = True
+            else :
+                self._to_pickle()
+
+        if not written :
+            self._write_pickle( value )
+        self.indices.append( int( index ) )
+
+        # Start a new shard, if the current one is old enough
+        if self.interval is not None and Time.time() - self.start > self.interval :
+            self._finish()
+            self.part = self.part + 1
+            self._open()
+
+    def _finish( self ) :
+
+        # Finalize the current shard
+        indices = np.asarray( self.indices, dtype=np.int64 )
+
+        if len( indices ) == 0 :
+            self.file.close()
+            os.remove( self.file.name )
+        elif self.numeric :
+            # Rewrite the header with the final number of results
+            self.file.seek( 0 )
+            self.file.write( _npy_header( self.dtype, ( len( indices ), ) + self.shape ) )
+            self.file.close()
+            with open( self.name + ".idx", "wb" ) as fi :
+                np.save( fi, indices )
+            os.replace( self.name + ".npy.tmp", self.name + ".npy" )
+        else :
+            # Write the index footer
+            self.file.write( indices.tobytes() )
+            self.file.write( np.asarray( self.offsets, dtype=np.int64 ).tobytes() )
+            self.file.write( struct.pack( "<q", len( indices ) ) + self.MAGIC )
+            self.file.close()
+            os.replace( self.name + ".pkl.tmp", self.name + ".pkl" )
+
+        # The results are safe on disk: mark the iterations as done
+        if self.checkpoint is not None :
+            self.checkpoint.mark_many( indices )
+            self.checkpoint.flush()
+
+    def close( self ) :
+        """
+        Finalize the shard and make it visible to 'gather' and 'reduce'.
+        """
+
+        if self.closed :
+            return
+        self._finish()
+        self.closed = True
+
+# -----------------------------------------------------------------------------
+class _PickleShard :
+    """
+    Lazy, read-only view of the results of a pickle shard (see 'ShardWriter').
+
+    Args:
+        - file_name (str): The path of the '.pkl' shard.
+    """
+
+    def __init__( self, file_name ) :
+
+        self.data = np.memmap( file_name, dtype=np.uint8, mode="r" )
+        n, magic = struct.unpack( "<q8s", self.data[ -16: ].tobytes() )
+        if magic != ShardWriter.MAGIC :
+            raise ValueError( f"{file_name} is not a valid shard." )
+        footer = len( self.data ) - 16 - 8 * ( 2 * n + 1 )
+        self.indices = np.frombuffer( self.data, dtype=np.int64, count=n, offset=footer )
+        self.offsets = np.frombuffer( self.data, dtype=np.int64, count=n + 1, offset=footer + 8 * n )
+        # The positions of the visible results in the shard
+        self.positions = np.arange( n )
+
+    def subset( self, keep ) :
+        """
+        Return a view of the results selected by a boolean mask.
+        """
+
+        view = object.__new__( _PickleShard )
+        view.__dict__.update( self.__dict__ )
+        view.indices = self.indices[ keep ]
+        view.positions = self.positions[ keep ]
+
+        return view
+
+    def __len__( self ) :
+
+        return len( self.indices )
+
+    def __getitem__( self, i ) :
+
+        k = self.positions[ i ]
+        return pickle.loads( self.data[ self.offsets[ k ] : self.offsets[ k + 1 ] ].tobytes() )
+
+    def __iter__( self ) :
+
+        for i in range( len( self ) ) :
+            yield self[ i ]
+
+# -----------------------------------------------------------------------------
+def _results_dir( path ) :
+    """
+    Return the directory of the result shards of a job.
+
+    Args:
+        - path (str): The job directory or the results directory itself.
+
+    Returns:
+        str: The results directory.
+    """
+
+    if os.path.isdir( path +s+ "results" ) :
+        return path +s+ "results"
+
+    return path
+
+# -----------------------------------------------------------------------------
+def _clear_results( path ) :
+    """
+    Move the result shards of a previous generation of a job aside and delete them 
+    in the background, so that they are not mixed with the results of the new one.
+
+    Args:
+        - path (str): The job directory.
+    """
+
+    results = path +s+ "results"
+    if os.path.isdir( results ) :
+        old = results + f".old.{os.getpid()}.{Time.time_ns()}"
+        os.rename( results, old )
+        _purge_in_background( old )
+
+# -----------------------------------------------------------------------------
+def _shard_order( path, name ) :
+    """
+    The sort key of the shards from the oldest to the most recent: their modification time,
+    then their run ID ( numerically for SLURM job IDs ) and their part number.
+    """
+
+    fields = name.split( "." )
+    run = int( fields[2] ) if fields[2].isdigit() else -1
+    part = int( fields[3] ) if fields[3].isdigit() else 0
+
+    return ( os.stat( path +s+ name ).st_mtime_ns, run, part )
+
+# -----------------------------------------------------------------------------
+def iter_shards( path ) :
+    """
+    Iterate over the result shards of a job, sorted by their first iteration index.
+
+    If an iteration has results in several shards ( e.g. a task resubmitted after writing
+    some of them ), only its most recent result is kept.
+
+    Args:
+        - path (str): The job directory (or its 'results' subdirectory).
+
+    Yields:
+        tuple: The iteration indices (numpy array) and the results of each shard,
+        either a memory-mapped numpy array or a lazy sequence of unpickled objects.
+    """
+
+    path = _results_dir( path )
+    shards = []
+    for name in os.listdir( path ) :
+        if name.startswith( "shard." ) and name.endswith( ".npy" ) :
+            indices = np.load( path +s+ name[ :-4 ] + ".idx" )
+            values = np.load( path +s+ name, mmap_mode="r" )
+        elif name.startswith( "shard." ) and name.endswith( ".pkl" ) :
+            values = _PickleShard( path +s+ name )
+            indices = values.indices
+        else :
+            continue
+        if len( indices ) > 0 :
+            shards.append( ( _shard_order( path, name ), name, indices, values ) )
+
+    # From the most recent shard, the results of the iterations already seen are dropped
+    n = max( [ int( indices.max() ) + 1 for _, _, indices, _ in shards ] + [ 0 ] )
+    seen = np.zeros( n, dtype=bool )
+    unique = []
+    for _, name, indices, values in sorted( shards, key=lambda sh : sh[0], reverse=True ) :
+        keep = ~seen[ indices ]
+        seen[ indices ] = True
+        if not keep.any() :
+            continue
+        if not keep.all() :
+            indices = indices[ keep ]
+            values = values[ keep ] if isinstance( values, np.ndarray ) else values.subset( keep )
+        unique.append( ( int( indices.min() ), name, indices, values ) )
+
+    for _, _, indices, values in sorted( unique, key=lambda sh : ( sh[0], sh[1] ) ) :
+        yield indices, values
+
+# -----------------------------------------------------------------------------
+def gather( path ) :
+    """
+    Assemble the results of a parfor job (see the 'result' argument of 'parfor')
+    in iteration order.
+
+    Numeric shards are memory-mapped and copied once, directly into their 
+    positions of the output array; other results are unpickled one at a time.
+    Missing iterations (e.g. of failed tasks) are NaN in float arrays, 
+    zero in other arrays and None in lists, and their number is printed.
+
+    Args:
+        - path (str): The job directory (or its 'results' subdirectory).
+
+    Returns:
+        numpy.ndarray or list: The results, indexed by iteration.
+    """
+
+    path = _results_dir( path )
+    shards = list( iter_shards( path ) )
+
+    # The total number of iterations
+    if os.path.isfile( path +s+ "results.json" ) :
+        with open( path +s+ "results.json", "r" ) as fj :
+            n = json.load( fj )[ "n" ]
+    else :
+        n = max( [ int( indices.max() ) + 1 for indices, _ in shards ] + [ 0 ] )
+
+    numeric = shards and all( isinstance( values, np.ndarray ) for _, values in shards ) and \
+              len( { ( values.dtype, values.shape[ 1: ] ) for _, values in shards } ) == 1
+    filled = np.zeros( n, dtype=bool )
+
+    if numeric :
+        values = shards[0][1]
+        out = np.zeros( ( n, ) + values.shape[ 1: ], dtype=values.dtype )
+        if out.dtype.kind in "fc" :
+            out[...] = np.nan
+        for indices, values in shards :
+            out[ indices ] = values
+            filled[ indices ] = True
+    else :
+        out = [ None ] * n
+        for indices, values in shards :
+            for i, v in zip( indices, values ) :
+                # Rows of memory-mapped shards are copied, not to keep the files open
+                if isinstance( values, np.ndarray ) :
+                    v = np.array( v )
+                    v = v[ () ] if v.ndim == 0 else v
+                out[ i ] = v
+            filled[ indices ] = True
+
+    if not filled.all() :
+        print( f"gather : {int( n - filled.sum() )} of {n} iterations have no result (skipped or not run)" )
+
+    return out
+
+# -----------------------------------------------------------------------------
+def reduce( path, op="sum", initial=None ) :
+    """
+    Reduce the results of a parfor job (see the 'result' argument of 'parfor')
+    streaming over the shards, in bounded memory.
+
+    Args:
+        - path (str): The job directory (or its 'results' subdirectory).
+        - op (str or callable, optional): The reduction:
+            "sum" : the sum of all the results (summed shard by shard for numeric shards);
+            "concat" : the results concatenated in iteration order 
+                       (numpy.concatenate for arrays, list concatenation otherwise);
+            callable : a binary function op( accumulator, result ), applied to the results 
+                       shard by shard (in iteration order within each shard).
+          Defaults to "sum".
+        - initial (optional): The initial value of the accumulator. Defaults to None, 
+          i.e. the first result.
+
+    Returns:
+        The reduced value.
+    """
+
+    if op == "concat" :
+        # The concatenation needs the iteration order of all the results
+        shards = list( iter_shards( path ) )
+        order = np.argsort( np.concatenate( [ indices for indices, _ in shards ] + [ np.zeros( 0, dtype=np.int64 ) ] ), 
+                            kind="stable" )
+        if shards and all( isinstance( values, np.ndarray ) for _, values in shards ) :
+            # One copy to concatenate the shards, and one to sort the results
+            parts = np.concatenate( [ values for _, values in shards ] )[ order ]
+            # Array results are concatenated along their first axis
+            if parts.ndim > 1 :
+                parts = parts.reshape( ( -1, ) + parts.shape[ 2: ] )
+            if initial is not None :
+                parts = np.concatenate( [ np.atleast_1d( initial ), parts ] )
+            return parts
+        locations = [ ( ish, k ) for ish, ( indices, _ ) in enumerate( shards ) for k in range( len( indices ) ) ]
+        out = list( initial ) if initial is not None else []
+        for i in order :
+            ish, k = locations[ i ]
+            v = shards[ ish ][ 1 ][ k ]
+            # Sequences are concatenated, single values are appended
+            if isinstance( v, ( list, tuple, np.ndarray ) ) and np.ndim( v ) > 0 :
+                out.extend( v )
+            else :
+                out.append( v )
+        return out
+
+    if op == "sum" :
+        acc = initial
+        for indices, values in iter_shards( path ) :
+            if isinstance( values, np.ndarray ) :
+                part = values.sum( axis=0 )
+            else :
+                part = None
+                for v in values :
+                    part = v if part is None else part + v
+            acc = part if acc is None else acc + part
+        return acc
+
+    if not callable( op ) :
+        raise ValueError( f"Unknown reduction '{op}', use 'sum', 'concat' or a function." )
+
+    acc = initial
+    first = initial is None
+    for indices, values in iter_shards( path ) :
+        for k in np.argsort( indices, kind="stable" ) :
+            v = values[ k ]
+            if first :
+                acc, first = v, False
+            else :
+                acc = op( acc, v )
+
+    return acc
+
+# -----------------------------------------------------------------------------
+def create_checkpoint( path, n ) :
+    """
+    Create an empty completion bitmap for a loop of 'n' iterations,
+    i.e. a file of ceil( n / 8 ) zero bytes in 'path/done.bitmap'.
+
+    Args:
+        - path (str): The checkpoint directory.
+        - n (int): The number of iterations.
+    """
+
+    os.makedirs( path, exist_ok=True )
+    with open( path +s+ "done.bitmap", "wb" ) as fb :
+        fb.write( bytes( ( n + 7 ) // 8 ) )
+
+# -----------------------------------------------------------------------------
+def read_checkpoint( path, n=None ) :
+    """
+    Read a completion bitmap (see 'create_checkpoint').
+
+    Args:
+        - path (str): The checkpoint directory.
+        - n (int, optional): The number of iterations. Defaults to None (a multiple of 8).
+
+    Returns:
+        numpy.ndarray: A boolean array, True for the completed iterations.
+    """
+
+    with open( path +s+ "done.bitmap", "rb" ) as fb :
+        done = np.unpackbits( np.frombuffer( fb.read(), dtype=np.uint8 ) ).astype( bool )
+
+    return done if n is None else done[ :n ]
+
+# -----------------------------------------------------------------------------
+class Checkpoint :
+    """
+    Record the completed iterations of a task in the completion bitmap of a job.
+
+    The iterations are marked in memory and written to the shared bitmap at most 
+    every 'interval' seconds, and when the task ends (also because of an 
+    unhandled exception). Each update sets only 
+    the bits of the task, with a read-modify-write of the bytes involved, 
+    done under a POSIX byte-range lock ( fcntl.lockf ), so concurrent tasks 
+    sharing a byte never lose each other's bits.
+
+    Args:
+        - path (str): The checkpoint directory (see 'create_checkpoint').
+        - interval (float, optional): The minimum time in seconds between two writes. Defaults to 10.
+    """
+
+    def __init__( self, path, interval=10.0 ) :
+
+        self.file_name = path +s+ "done.bitmap"
+        self.done = read_checkpoint( path )
+        self.marked = []
+        self.interval = interval
+        self.last = Time.time()
+        # The iterations completed before a failure are written anyway
+        atexit.register( self.flush )
+
+    def is_done( self, index ) :
+
+        return bool( self.done[ index ] )
+
+    def mark( self, index ) :
+        """
+        Mark one iteration as completed.
+
+        Args:
+            - index (int): The index of the iteration.
+        """
+
+        self.marked.append( int( index ) )
+        if Time.time() - self.last > self.interval :
+            self.flush()
+
+    def mark_many( self, indices ) :
+        """
+        Mark several iterations as completed.
+
+        Args:
+            - indices (array-like): The indices of the iterations.
+        """
+
+        self.marked.extend( int( i ) for i in indices )
+        if Time.time() - self.last > self.interval :
+            self.flush()
+
+    def flush( self ) :
+        """
+        Write the marked iterations to the bitmap file.
+        """
+
+        import fcntl
+
+        self.last = Time.time()
+        if not self.marked :
+            return
+
+        indices = np.unique( np.asarray( self.marked, dtype=np.int64 ) )
+        positions = indices // 8
+        lo, hi = int( positions.min() ), int( positions.max() ) + 1
+        update = np.zeros( hi - lo, dtype=np.uint8 )
+        np.bitwise_or.at( update, positions - lo, ( 1 << ( 7 - indices % 8 ) ).astype( np.uint8 ) )
+
+        fd = os.open( self.file_name, os.O_RDWR )
+        try :
+            fcntl.lockf( fd, fcntl.LOCK_EX, hi - lo, lo )
+            current = np.frombuffer( os.pread( fd, hi - lo, lo ), dtype=np.uint8 )
+            os.pwrite( fd, ( current | update ).tobytes(), lo )
+            os.fsync( fd )
+            fcntl.lockf( fd, fcntl.LOCK_UN, hi - lo, lo )
+        finally :
+            os.close( fd )
+
+        self.done[ indices ] = True
+        self.marked = []
+
+    def track( self, indexed ) :
+        """
+        Yield the items of ( index, item ) pairs that are not completed yet,
+        marking each one as completed when the next one is requested.
+
+        Args:
+            - indexed (iterable): The ( index, item ) pairs.
+
+        Yields:
+            The items still to be processed.
+        """
+
+        previous = None
+        for i, item in indexed :
+            if previous is not None :
+                self.mark( previous )
+                previous = None
+            if self.done[ i ] :
+                continue
+            previous = i
+            yield item
+        if previous is not None :
+            self.mark( previous )
+        self.flush()
+
+    def todo( self, indexed ) :
+        """
+        Filter out the completed iterations from ( index, item ) pairs.
+
+        Args:
+            - indexed (iterable): The ( index, item ) pairs.
+
+        Yields:
+            tuple: The ( index, item ) pairs still to be processed.
+        """
+
+        for i, item in indexed :
+            if not self.done[ i ] :
+                yield i, item
+
+    def close( self ) :
+
+        self.flush()
+
+# -----------------------------------------------------------------------------
+class Telemetry :
+    """
+    Record the duration and the memory of each iteration of a task, and a summary of the task,
+    as JSON lines in 'path/task_<itask>.jsonl' (see 'profile_report').
+
+    The records are kept in memory and appended to the file every 'buffer' iterations
+    or 'interval' seconds, and when the task ends (also because of an unhandled exception),
+    so the cost per iteration is a couple of clock readings and a 'getrusage' call.
+
+    Each iteration record has the fields "i" ( the index of the iteration, or its position
+    in the task ), "start" and "end" ( UNIX times ), "dur" ( seconds ) and "rss" ( the peak resident 
+    memory of the process so far, in bytes ). The task record ( "type": "task" ) also has 
+    the host name, the SLURM job and array IDs, the startup time of the process and the number 
+    of iterations.
+
+    Args:
+        - path (str): The telemetry directory.
+        - itask (int, optional): The task ID. Defaults to 0.
+        - buffer (int, optional): The maximum number of records kept in memory. Defaults to 10000.
+        - interval (float, optional): The maximum time in seconds between two writes. Defaults to 60.
+    """
+
+    def __init__( self, path, itask=0, buffer=10000, interval=60.0 ) :
+
+        import resource
+
+        os.makedirs( path, exist_ok=True )
+        self.file_name = path +s+ f"task_{itask}.jsonl"
+        self.getrusage = lambda : resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss * 1024
+        self.task = { "type": "task", 
+                      "task": int( itask ), 
+                      "array": os.environ.get( "SLURM_ARRAY_TASK_ID" ), 
+                      "job": os.environ.get( "SLURM_ARRAY_JOB_ID", os.environ.get( "SLURM_JOB_ID" ) ), 
+                      "host": os.uname().nodename, 
+                      "pid": os.getpid(), 
+                      "created": psutil.Process().create_time(), 
+                      "loop": None, 
+                      "iterations": 0 }
+        self.records = []
+        self.buffer = buffer
+        self.interval = interval
+        self.last = Time.time()
+        self.closed = False
+        # The records of a task that fails are written anyway
+        atexit.register( self.close )
+
+    def track( self, iterable, indexed=False ) :
+        """
+        Yield the items of an iterable, recording the time spent by the loop body on each of them.
+
+        Args:
+            - iterable (iterable): The items of the loop.
+            - indexed (bool, optional): Whether the items are ( index, item ) pairs. Defaults to False.
+
+        Yields:
+            The items, unchanged.
+        """
+
+        if self.task[ "loop" ] is None :
+            self.task[ "loop" ] = Time.time()
+        k = 0
+        for item in iterable :
+            start = Time.time()
+            yield item
+            end = Time.time()
+            self.records.append( ( item[0] if indexed else k, start, end, self.getrusage() ) )
+            k = k + 1
+            if len( self.records ) >= self.buffer or end - self.last > self.interval :
+                self.flush()
+
+    def flush( self ) :
+        """
+        Append the buffered records to the telemetry file.
+        """
+
+        self.last = Time.time()
+        if not self.records :
+            return
+        self.task[ "iterations" ] = self.task[ "iterations" ] + len( self.records )
+        lines = [ json.dumps( { "i": int( i ), "start": start, "end": end, "dur": end - start, "rss": rss } ) 
+                  for i, start, end, rss in self.records ]
+        with open( self.file_name, "a" ) as ft :
+            ft.write( "\n".join( lines ) + "\n" )
+        self.records = []
+
+    def close( self ) :
+        """
+        Write the last records and the record of the task.
+        """
+
+        if self.closed :
+            return
+        self.closed = True
+        self.flush()
+        task = dict( self.task )
+        task[ "end" ] = Time.time()
+        task[ "dur" ] = task[ "end" ] - task[ "created" ]
+        task[ "startup" ] = ( task[ "loop" ] or task[ "end" ] ) - task[ "created" ]
+        task[ "rss" ] = self.getrusage()
+        with open( self.file_name, "a" ) as ft :
+            ft.write( json.dumps( task ) + "\n" )
+
+# -----------------------------------------------------------------------------
+def profile_report( path, straggler=1.5, bins=10, printf=True ) :
+    """
+    Summarize the telemetry of a parfor job generated with 'telemetry=True' (see 'Telemetry'):
+    the throughput of each node, the histogram of the iteration durations, the straggler tasks
+    and the speedup expected from a better chunking.
+
+    The speedup compares the longest task with the longest one of an ideal chunking, 
+    i.e. the measured iteration durations distributed over the same number of tasks 
+    with 'balanced_partition', plus the mean startup time of the tasks.
+
+    Args:
+        - path (str): The job directory ( or its 'telemetry' directory ).
+        - straggler (float, optional): The tasks longer than 'straggler' times the median task
+          are reported as stragglers. Defaults to 1.5.
+        - bins (int, optional): The number of bins of the histogram. Defaults to 10.
+        - printf (bool, optional): Whether to print the report. Defaults to True.
+
+    Returns:
+        dict: The "tasks", "nodes", "histogram" ( counts and edges ), "stragglers", 
+              "makespan", "balanced_makespan" and "speedup".
+    """
+
+    tel_dir = path +s+ "telemetry" if os.path.isdir( path +s+ "telemetry" ) else path
+    tasks = []
+    durations = []
+    for fname in sorted( os.listdir( tel_dir ) ) :
+        if not ( fname.startswith( "task_" ) and fname.endswith( ".jsonl" ) ) :
+            continue
+        iterations = []
+        task = None
+        with open( tel_dir +s+ fname, "r" ) as ft :
+            for line in ft :
+                try :
+                    record = json.loads( line )
+                except ValueError :
+                    continue
+                if record.get( "type" ) == "task" :
+                    # A resubmitted task: the last run counts
+                    task = record
+                    task[ "durations" ] = iterations
+                    iterations = []
+                else :
+                    iterations.append( record[ "dur" ] )
+        if task is None :
+            # The task did not end ( it is running, or it was killed )
+            if iterations == [] :
+                continue
+            task = { "task": int( fname[ 5:-6 ] ), "host": None, "startup": 0.0, 
+                     "dur": float( np.sum( iterations ) ), "incomplete": True }
+        elif iterations != [] :
+            task[ "durations" ] = task[ "durations" ] + iterations
+        task[ "durations" ] = task.get( "durations", iterations )
+        task[ "iterations" ] = len( task[ "durations" ] )
+        tasks.append( task )
+        durations.extend( task[ "durations" ] )
+
+    if tasks == [] :
+        raise ValueError( f"No telemetry in {tel_dir}." )
+    durations = np.asarray( durations, dtype=float )
+    task_dur = np.asarray( [ t[ "dur" ] for t in tasks ] )
+
+    # The throughput of each node
+    nodes = {}
+    for t in tasks :
+        node = nodes.setdefault( t[ "host" ], { "tasks": 0, "iterations": 0, "busy": 0.0 } )
+        node[ "tasks" ] = node[ "tasks" ] + 1
+        node[ "iterations" ] = node[ "iterations" ] + t[ "iterations" ]
+        node[ "busy" ] = node[ "busy" ] + float( np.sum( t[ "durations" ] ) )
+    for node in nodes.values() :
+        node[ "throughput" ] = node[ "iterations" ] / node[ "busy" ] if node[ "busy" ] > 0 else float( "inf" )
+
+    # The histogram of the iteration durations ( logarithmic bins if they span decades )
+    if len( durations ) > 0 and durations.min() > 0 and durations.max() > 10 * durations.min() :
+        edges = np.geomspace( durations.min(), durations.max(), bins + 1 )
+    else :
+        edges = bins
+    counts, edges = np.histogram( durations, bins=edges )
+
+    # The tasks much longer than the median
+    median = float( np.median( task_dur ) )
+    stragglers = sorted( ( t for t in tasks if t[ "dur" ] > straggler * median ), 
+                         key=lambda t : t[ "dur" ], reverse=True )
+
+    # The longest task with an ideal chunking of the same iterations over the same number of tasks
+    makespan = float( task_dur.max() )
+    startup = float( np.mean( [ t[ "startup" ] for t in tasks ] ) )
+    _, loads = balanced_partition( durations, len( tasks ) )
+    balanced = startup + float( loads.max() )
+    speedup = makespan / balanced if balanced > 0 else 1.0
+
+    report = { "tasks": [ { k: v for k, v in t.items() if k != "durations" } for t in tasks ], 
+               "nodes": nodes, 
+               "histogram": ( counts, edges ), 
+               "stragglers": [ { k: v for k, v in t.items() if k != "durations" } for t in stragglers ], 
+               "makespan": makespan, 
+               "balanced_makespan": balanced, 
+               "speedup": speedup }
+
+    if printf == True :
+        print( f"{len( tasks )} tasks, {len( durations )} iterations, "
+               f"task duration median {median:.1f} s, max {makespan:.1f} s" )
+        print( "\nnode                      tasks  iterations   busy [s]   iterations/s" )
+        for host, node in sorted( nodes.items(), key=lambda kv : str( kv[0] ) ) :
+            print( f"{str( host ):24s} {node[ 'tasks' ]:6d} {node[ 'iterations' ]:11d} "
+                   f"{node[ 'busy' ]:10.1f} {node[ 'throughput' ]:14.3f}" )
+        print( "\niteration duration [s]" )
+        for c, lo, hi in zip( counts, edges[ :-1 ], edges[ 1: ] ) :
+            bar = "#" * int( np.ceil( 40 * c / max( 1, counts.max() ) ) )
+            print( f"{lo:10.4g} - {hi:<10.4g} {c:8d} {bar}" )
+        print( f"\n{len( stragglers )} stragglers ( > {straggler} x median )" )
+        for t in stragglers[ :10 ] :
+            print( f"   task {t[ 'task' ]:5d} on {t[ 'host' ]} : {t[ 'dur' ]:.1f} s, "
+                   f"{t[ 'iterations' ]} iterations, {t[ 'startup' ]:.1f} s startup" )
+        print( f"\nbalanced chunking : longest task {balanced:.1f} s instead of {makespan:.1f} s "
+               f"( estimated speedup {speedup:.2f}x )" )
+
+    return report
+
+# -----------------------------------------------------------------------------
+def _cache_dir( cache ) :
+    """
+    Return the directory of a result cache: the given one, or '$CINECA_SCRATCH/cp_cache'
+    ( '~/.cp_cache' outside Cineca ) if 'cache' is True.
+    """
+
+    if cache is True :
+        return os.path.join( os.environ.get( "CINECA_SCRATCH", os.path.expanduser( "~" ) ), 
+                             "cp_cache" if "CINECA_SCRATCH" in os.environ else ".cp_cache" )
+
+    return os.path.expandvars( os.path.expanduser( cache ) )
+
+# -----------------------------------------------------------------------------
+class ResultCache :
+    """
+    A content-addressed on-disk store of iteration results, shared by the jobs that use it.
+
+    Each result is pickled in its own file '<path>/<key[:2]>/<key>.pkl', written atomically,
+    so the tasks of many jobs can add results concurrently. Reading a result refreshes 
+    its modification time, which 'evict' uses to delete the least recently used results first.
+
+    Args:
+        - path (str): The directory of the cache.
+    """
 
-    if not os.path.exists( path +os.sep + logs_dir_out ):
-        os.makedirs( path +os.sep + logs_dir_out, exist_ok=True )
-    else :
-        shutil.rmtree( path +os.sep + logs_dir_out )
-        os.makedirs( path +os.sep + logs_dir_out, exist_ok=True )
+    def __init__( self, path ) :
 
-    if not os.path.exists(path +os.sep + logs_dir_err):
-        os.makedirs( path +os.sep + logs_dir_err, exist_ok=True )
-    else :
-        shutil.rmtree( path +os.sep + logs_dir_err )
-        os.makedirs( path +os.sep + logs_dir_err, exist_ok=True )
-
-    # Open a file at the specified path with write permissions
-    with open( path +s+ filename, "w") as f :
-        # Write the shebang line for a bash script
-        f.write("#!/bin/bash\n\n")
-        # Write the SLURM directives for the job resources
-        f.write(f"#SBATCH --nodes={nodes}\n")
-        f.write(f"#SBATCH --ntasks={ntasks}\n") 
-        f.write(f"#SBATCH --cpus-per-task={ncpus}\n")
-        f.write(f"#SBATCH --time {time}\n")
-        f.write(f"#SBATCH --mem={mem}\n")
-        f.write(f"#SBATCH --out {out}\n")
-        f.write(f"#SBATCH --err {err}\n")
-        f.write(f"#SBATCH --account={account}\n")
-        f.write(f"#SBATCH --partition {partition} # partition to be used Galileo and debug queue\n")
-        f.write(f"#SBATCH --mail-type={mail_type}\n")
-        f.write(f"#SBATCH --mail-user={mail_user}\n")
-        f.write("\n")
-        # Write the job to be executed
-        f.write("# main code\n")
-        if ( type( other_lines ) == str ) and ( other_lines != '' ) :
-            f.write(f"{other_lines}")
-        if ( type( other_lines ) in ( list, tuple ) ) and ( not other_lines is False):
-            for line in other_lines :
-                f.write(f"{line}\n")
-        f.write(job)
-        f.write("\n")
+        self.path = path
+        os.makedirs( path, exist_ok=True )
 
-    # If the 'printf' flag is True, print the contents of the file
+    def _file( self, key ) :
+
+        return self.path +s+ key[ :2 ] +s+ key + ".pkl"
+
+    def __contains__( self, key ) :
+
+        return os.path.exists( self._file( key ) )
+
+    def get( self, key ) :
+        """
+        Return the result with the given key, marking it as recently used.
+        """
+
+        file_name = self._file( key )
+        with open( file_name, "rb" ) as fc :
+            value = pickle.load( fc )
+        try :
+            os.utime( file_name )
+        except OSError :
+            pass
+
+        return value
+
+    def put( self, key, value ) :
+        """
+        Store a result with the given key.
+        """
+
+        file_name = self._file( key )
+        os.makedirs( os.path.dirname( file_name ), exist_ok=True )
+        tmp = file_name + f".{os.getpid()}.tmp"
+        with open( tmp, "wb" ) as fc :
+            pickle.dump( value, fc, protocol=pickle.HIGHEST_PROTOCOL )
+        os.replace( tmp, file_name )
+
+    def evict( self, max_size ) :
+        """
+        Delete the least recently used results until the cache is smaller than 'max_size'.
+
+        Args:
+            - max_size (float): The maximum size of the cache in MB.
+
+        Returns:
+            int: The number of deleted results.
+        """
+
+        entries = []
+        total = 0
+        for shard in os.scandir( self.path ) :
+            if not shard.is_dir() :
+                continue
+            for entry in os.scandir( shard.path ) :
+                if entry.name.endswith( ".pkl" ) :
+                    st = entry.stat()
+                    entries.append( ( st.st_mtime, st.st_size, entry.path ) )
+                    total = total + st.st_size
+
+        removed = 0
+        for _, size, file_name in sorted( entries ) :
+            if total <= max_size * 1024 ** 2 :
+                break
+            try :
+                os.remove( file_name )
+            except OSError :
+                continue
+            total = total - size
+            removed = removed + 1
+
+        return removed
+
+# -----------------------------------------------------------------------------
+class CachingWriter :
+    """
+    Write the results of a task both to its shard and to a result cache (see 'ResultCache'),
+    under the keys computed by 'parfor' for each iteration.
+
+    Args:
+        - writer (ShardWriter): The writer of the shard of the task.
+        - path (str): The directory of the cache.
+        - keys_file (str): The '.npy' file of the keys of the iterations.
+    """
+
+    def __init__( self, writer, path, keys_file ) :
+
+        self.writer = writer
+        self.cache = ResultCache( path )
+        self.keys = np.load( keys_file, mmap_mode="r" )
+
+    def write( self, index, value ) :
+
+        self.writer.write( index, value )
+        if value is not SKIPPED :
+            self.cache.put( self.keys[ index ].decode(), value )
+
+    def close( self ) :
+
+        self.writer.close()
+
+# -----------------------------------------------------------------------------
+def _cache_keys( source, tree, for_node, items, result=None, modules=[], alias=[], filename="<parfor>" ) :
+    """
+    Compute the cache key of each iteration of a loop: the digest of the loop body source,
+    of the 'result' expression, of the values of the prelude variables they read, 
+    and of the item of the iteration.
+
+    Only the prelude statements those variables depend on are executed (see '_program_slice').
+    The values that cannot be hashed reliably (see '_digest_update') raise a ValueError,
+    rather than risking that different values share a key.
+
+    Args:
+        - source (str): The python source code containing the loop.
+        - tree (ast.Module): The parsed source.
+        - for_node (ast.For): The for-loop node.
+        - items (iterable): The items of the loop.
+        - result (str, optional): The expression whose value is the result of an iteration. Defaults to None.
+        - modules (list, optional): Additional modules available to the code. Defaults to [].
+        - alias (list, optional): The aliases of the additional modules. Defaults to [].
+        - filename (str, optional): The file name used in tracebacks. Defaults to "<parfor>".
+
+    Returns:
+        list: The keys ( hexadecimal strings ).
+    """
+
+    lines = source.split( "\n" )
+    for istmt, stmt in enumerate( tree.body ) :
+        if stmt.lineno <= for_node.lineno <= stmt.end_lineno :
+            break
+    prelude = tree.body[ :istmt ]
+
+    # The prelude variables read by the loop body and the result expression
+    read = set()
+    for stmt in for_node.body :
+        read = read | _used_names( stmt )
+    if result is not None :
+        read = read | _used_names( ast.parse( result, mode="eval" ) )
+    defined = set()
+    for stmt in prelude :
+        defined = defined | _bound_names( stmt ) | _mutated_names( stmt )
+    names = read & defined
+
+    statements, unresolved = _program_slice( prelude, names )
+    scope = { "_cp": sys.modules[ __name__ ] }
+    for im, module in enumerate( modules ) :
+        name = alias[ im ] if im < len( alias ) else module.split( "." )[0]
+        if name in unresolved :
+            exec( f"import {module} as {name}" if name != module.split( "." )[0] else f"import {module}", scope )
+    _run_prelude( statements, scope, filename )
+    values = { name: scope[ name ] for name in sorted( names ) 
+               if name in scope and not isinstance( scope[ name ], types.ModuleType ) }
+
+    h = hashlib.sha1()
+    try :
+        _digest_update( h, [ _source_segment( lines, for_node.target ), 
+                             [ _source_segment( lines, stmt ) for stmt in for_node.body ], 
+                             result, values ], strict=True )
+        keys = []
+        for item in items :
+            hi = h.copy()
+            _digest_update( hi, item, strict=True )
+            keys.append( hi.hexdigest() )
+    except TypeError as e :
+        raise ValueError( f"The results of the loop cannot be cached: {e} "
+                          "Use only numbers, strings, containers, numpy arrays and functions, or cache=None." ) from e
+
+    return keys
+
+# -----------------------------------------------------------------------------
+def _array_ranges( ids ) :
+    """
+    Compress a list of task IDs in the format of the sbatch '--array' option.
+
+    Args:
+        - ids (array-like): The task IDs.
+
+    Returns:
+        str: The task IDs, e.g. "1-3,7,9-12".
+    """
+
+    ids = sorted( set( int( i ) for i in ids ) )
+    ranges = []
+    for i in ids :
+        if ranges and i == ranges[-1][1] + 1 :
+            ranges[-1][1] = i
+        else :
+            ranges.append( [ i, i ] )
+
+    return ",".join( f"{a}" if a == b else f"{a}-{b}" for a, b in ranges )
+
+# -----------------------------------------------------------------------------
+class Deadline :
+    """
+    Stop the loop of a task before the time limit of its job, and record the iterations
+    left unfinished, so that a resubmission runs only those (see 'resume').
+
+    The deadline is the end time of the job ( CP_END_TIME ) minus the time reserved
+    to flush the results ( CP_GRACE ), both exported by the sbatch file (see the 'signal_time'
+    argument of 'create_sbatch_file'), or the arrival of SIGUSR1, which SLURM sends 
+    'signal_time' seconds before the time limit. No new iteration is started when the time
+    left before the deadline is shorter than the longest iteration observed so far.
+
+    The unfinished iterations are saved in 'path/task_<itask>.npy'. If this file exists 
+    when the task starts, only the iterations it lists are run, and it is removed once they
+    are all completed.
+
+    Args:
+        - path (str): The directory of the lists of unfinished iterations.
+        - itask (int): The task ID.
+        - indices (iterable, optional): The indices of the iterations of the task. 
+          Defaults to None ( unknown, e.g. with the "dynamic" schedule: nothing is saved ).
+    """
+
+    def __init__( self, path, itask, indices=None ) :
+
+        os.makedirs( path, exist_ok=True )
+        self.file_name = path +s+ f"task_{itask}.npy"
+        end = os.environ.get( "CP_END_TIME", "" )
+        grace = float( os.environ.get( "CP_GRACE", "0" ) or 0 )
+        self.deadline = float( end ) - grace if end.strip() != "" else None
+        self.signaled = False
+        signal.signal( signal.SIGUSR1, self._handler )
+        self.planned = indices
+        # The unfinished iterations of a previous run, the only ones to be run
+        self.only = None
+        if os.path.exists( self.file_name ) :
+            self.only = set( np.load( self.file_name ).tolist() )
+            self.planned = sorted( self.only )
+        self.done = []
+        self.longest = 0.0
+        self.stopped = False
+        self.closed = False
+
+    def _handler( self, signum, frame ) :
+
+        self.signaled = True
+
+    def expired( self ) :
+        """
+        Whether there is no time left for another iteration.
+        """
+
+        if self.signaled :
+            return True
+
+        return self.deadline is not None and Time.time() + self.longest > self.deadline
+
+    def track( self, indexed ) :
+        """
+        Yield the ( index, item ) pairs until the deadline, timing the loop body on each of them.
+
+        Args:
+            - indexed (iterable): The ( index, item ) pairs.
+
+        Yields:
+            tuple: The ( index, item ) pairs to be processed.
+        """
+
+        for i, item in indexed :
+            if self.only is not None and int( i ) not in self.only :
+                continue
+            if self.expired() :
+                self.stopped = True
+                break
+            t0 = Time.time()
+            yield i, item
+            self.longest = max( self.longest, Time.time() - t0 )
+            self.done.append( int( i ) )
+
+    def items( self, indexed ) :
+        """
+        Yield the items of ( index, item ) pairs.
+        """
+
+        for _, item in indexed :
+            yield item
+
+    def close( self ) :
+        """
+        Save the unfinished iterations if the loop was stopped, otherwise remove their list.
+        """
+
+        if self.closed :
+            return
+        self.closed = True
+
+        if not self.stopped :
+            if os.path.exists( self.file_name ) :
+                os.remove( self.file_name )
+            return
+
+        if self.planned is None :
+            print( "Stopped before the time limit, the unfinished iterations are unknown", file=sys.stderr )
+            return
+        unfinished = np.setdiff1d( np.fromiter( self.planned, dtype=np.int64 ), 
+                                   np.asarray( self.done, dtype=np.int64 ) )
+        with open( self.file_name + ".tmp", "wb" ) as fu :
+            np.save( fu, unfinished )
+        os.replace( self.file_name + ".tmp", self.file_name )
+        print( f"Stopped before the time limit: {len( unfinished )} iterations unfinished, "
+               f"listed in {self.file_name}", file=sys.stderr )
+
+# -----------------------------------------------------------------------------
+def _unfinished_array( path, printf=True ) :
+    """
+    Return the tasks of a parfor job generated with 'grace' that were stopped before
+    the time limit (see 'Deadline'), in the format of the sbatch '--array' option
+    ( None if there are none ).
+    """
+
+    unfinished = {}
+    folder = path +s+ "unfinished"
+    if os.path.isdir( folder ) :
+        for fname in os.listdir( folder ) :
+            if fname.startswith( "task_" ) and fname.endswith( ".npy" ) :
+                unfinished[ int( fname[ 5:-4 ] ) ] = len( np.load( folder +s+ fname ) )
+    tasks = sorted( itask for itask, k in unfinished.items() if k > 0 )
     if printf == True :
-        print( "\n# ---------------------------------------------------------" )
-        print( path +s+ filename )
-        print( "CONTENT :\n" )
-        print_file( path +s+ filename )
+        print( f"{sum( unfinished.values() )} iterations are unfinished in {len( tasks )} tasks" )
 
-    # Close the file
-    f.close()
+    return _array_ranges( tasks ) if tasks != [] else None
 
-    # If the 'run' flag is True, submit the job to the queue
+# -----------------------------------------------------------------------------
+def resume( path, run=False, repartition=False, printf=True, return_job=False ) :
+    """
+    Resubmit only the missing work of a parfor job generated with 'checkpoint=True' 
+    ( or with 'grace', the tasks stopped before the time limit, see 'Deadline' ).
+
+    The completion bitmap of the job is read and:
+        - for the "static" schedule, the job array is resubmitted with a sparse 
+          '--array' list of the tasks having missing iterations; each task skips 
+          the iterations already completed. If 'repartition' is True and the job 
+          uses index lists ('weights'/'cost_fn'), the missing iterations are instead 
+          re-partitioned among the tasks (using the stored weights);
+        - for the "dynamic" schedule, the work queue is refilled with the missing 
+          iterations only.
+
+    Args:
+        - path (str): The job directory.
+        - run (bool, optional): Whether to submit the job (or to run it with 'run_local' outside Cineca). Defaults to False.
+        - repartition (bool, optional): Whether to re-partition the missing iterations. Defaults to False.
+        - printf (bool, optional): Whether to print a summary. Defaults to True.
+        - return_job (bool, optional): Whether to also return the handle of the submitted job. Defaults to False.
+
+    Returns:
+        str: The SLURM command to resubmit the job ( None if nothing is missing ).
+        SlurmJob: The job handle ( the 'LocalTask' list outside Cineca, None if not run ), only if 'return_job' is True.
+    """
+
+    with open( path +s+ "parfor.json", "r" ) as fj :
+        spec = json.load( fj )
+    if not spec.get( "checkpoint" ) :
+        if spec.get( "grace" ) is None :
+            raise ValueError( f"The job in {path} was not generated with 'checkpoint=True' or 'grace'." )
+        # Without checkpoint, only the tasks stopped before the time limit are resubmitted
+        array = _unfinished_array( path, printf=printf )
+        if array is None :
+            return None
+        return _resubmit( path, spec, array, run=run, printf=printf, return_job=return_job )
+
+    n = spec[ "n" ]
+    missing = np.flatnonzero( ~read_checkpoint( path +s+ "checkpoint", n ) )
+    if printf == True :
+        print( f"{len( missing )} of {n} iterations are missing" )
+    if len( missing ) == 0 :
+        return None
+
+    if spec[ "schedule" ] == "dynamic" :
+        # Refill the queue with the missing iterations
+        nbatches = write_queue( path +s+ "queue", n, spec[ "batch_size" ], indices=missing )
+        array = f"1-{min( spec[ 'chunks' ], nbatches )}"
+
+    elif spec[ "weighted" ] and repartition == True :
+        # Balance the missing iterations among the tasks
+        weights = np.load( path +s+ "manifest" +s+ "weights.npy" )[ missing ]
+        ntasks = min( spec[ "chunks" ], len( missing ) )
+        bins, loads = balanced_partition( weights, ntasks )
+        write_partition( path +s+ "manifest", [ missing[ b ] for b in bins ] )
+        array = f"1-{ntasks}"
+
+    elif spec[ "weighted" ] :
+        # The tasks owning the missing iterations
+        offsets = np.load( path +s+ "manifest" +s+ "partition.idx.npy" )
+        indices = np.load( path +s+ "manifest" +s+ "partition.npy" )
+        owner = np.zeros( n, dtype=np.int64 )
+        for itask in range( len( offsets ) - 1 ) :
+            owner[ indices[ offsets[ itask ] : offsets[ itask + 1 ] ] ] = itask + 1
+        array = _array_ranges( owner[ missing ] )
+
+    else :
+        if repartition == True and printf == True :
+            print( "Contiguous chunks cannot be re-partitioned, resubmitting the incomplete tasks" )
+        array = _array_ranges( missing // spec[ "chunk_size" ] + 1 )
+
+    return _resubmit( path, spec, array, run=run, printf=printf, return_job=return_job )
+
+# -----------------------------------------------------------------------------
+def _resubmit( path, spec, array, run=False, printf=True, return_job=False ) :
+    """
+    Resubmit some tasks of a parfor job (see 'resume').
+
+    Args:
+        - path (str): The job directory.
+        - spec (dict): The description of the job ( 'parfor.json' ).
+        - array (str): The task IDs, in the format of the sbatch '--array' option.
+        - run (bool, optional): Whether to submit the job (or to run it with 'run_local' outside Cineca). Defaults to False.
+        - printf (bool, optional): Whether to print the command. Defaults to True.
+        - return_job (bool, optional): Whether to also return the handle of the submitted job. Defaults to False.
+    """
+
+    # A job running all the chunks inside its allocation runs the listed ones
+    if spec.get( "launch", "array" ) != "array" :
+        with open( path +s+ "farm.chunks", "w" ) as fc :
+            fc.write( array + "\n" )
+        array = None
+
+    cmd = f"sbatch {'' if array is None else '--array=' + array + ' '}{path+os.sep+spec[ 'filename' ]} &> log &"
+    if printf == True :
+        print( cmd )
+
+    # If run is True
+    handle = None
     if run == True :
-        os.system( f"sbatch {path +s+ filename} &" )
+        if is_cineca_system() :
+            # Submit the slurm script
+            handle = submit( path +s+ spec[ 'filename' ], array=array )
+        else :
+            # Outside SLURM, run the job array with the local executor
+            handle = run_local( path +s+ spec[ 'filename' ], array=array )
 
-    return path +s+ filename
+    if return_job == True :
+        return cmd, handle
+
+    return cmd
+
+# -----------------------------------------------------------------------------
+def _runtime_import_lines() :
+    """
+    Return the lines importing this module in the generated task scripts, 
+    which use it to read manifests and the other job-directory files.
+
+    Returns:
+        list: The import lines.
+    """
+
+    # The directory containing the CinecaPy package, in case it is not installed
+    package_root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+    return [ f"sys.path.append( {package_root!r} )",
+             "from CinecaPy import cineca as _cp" ]
+
+# -----------------------------------------------------------------------------
+def _farm_lines( path, launch, chunk_lines, chunks, nodes=1, ntasks=1, ncpus=1, mem=50000 ) :
+    """
+    Write the files running all the chunks of a parfor job inside a single allocation 
+    of 'ntasks' slots, and return the lines of the sbatch file launching them.
+
+    The chunk IDs are read from 'path/farm.chunks' ( in the format of the sbatch '--array' 
+    option, rewritten by 'resume' ) and 'path/farm.sh chunk <n>' runs the chunk 'n', 
+    exactly as the array task 'n' would. With "multi-prog", 'srun --multi-prog farm.conf' 
+    starts one rank per slot, and each rank runs the chunks rank+1, rank+1+ntasks, ... 
+    With "farm", the batch script starts one 'srun --exact' step per chunk as soon as a slot 
+    is free. The chunks that fail are listed in 'path/farm.failed', and make the job fail.
+    Where 'srun' is not available ( e.g. with 'run_local' ), the slots are background processes.
+
+    Args:
+        - path (str): The job directory.
+        - launch (str): "multi-prog" or "farm".
+        - chunk_lines (list): The lines of the chunk 'n' ( the variable 'n' is its ID ).
+        - chunks (int): The number of chunks.
+        - nodes (int, optional): The number of nodes. Defaults to 1.
+        - ntasks (int, optional): The number of slots. Defaults to 1.
+        - ncpus (int, optional): The number of CPUs per slot. Defaults to 1.
+        - mem (int or str, optional): The memory per node. Defaults to 50000.
+
+    Returns:
+        list: The lines of the sbatch file.
+    """
+
+    # The chunks to run, all of them unless 'resume' rewrites the list
+    _write_if_changed( path +s+ "farm.chunks", f"1-{chunks}\n" )
+
+    farm = [ "#!/bin/bash",
+             "# Run the chunks of the job: 'farm.sh chunk <n>', 'farm.sh rank <rank>' or 'farm.sh list'",
+             "_cp_chunks=()",
+             "for _cp_r in $(tr ',' ' ' < farm.chunks) ; do",
+             "    _cp_chunks+=( $(seq ${_cp_r%-*} ${_cp_r#*-}) )",
+             "done",
+             "_cp_chunk() {",
+             "    n=$1" ] + \
+           [ "    " + line for line in chunk_lines ] + \
+           [ "    _cp_rc=$?",
+             "    [ $_cp_rc -eq 0 ] || echo $n >> farm.failed",
+             "    return $_cp_rc",
+             "}",
+             "case $1 in",
+             "    chunk ) _cp_chunk $2 ;;",
+             "    rank )",
+             "        _cp_rc=0",
+             "        for (( _cp_k=$2 ; _cp_k < ${#_cp_chunks[@]} ; _cp_k+=${SLURM_NTASKS:-1} )) ; do",
+             "            _cp_chunk ${_cp_chunks[$_cp_k]} || _cp_rc=1",
+             "        done",
+             "        exit $_cp_rc ;;",
+             "    list ) echo ${_cp_chunks[@]} ;;",
+             "esac" ]
+    _write_if_changed( path +s+ "farm.sh", "\n".join( farm ) + "\n" )
+
+    lines = [ "# Run all the chunks inside this allocation",
+              "rm -f farm.failed" ]
+    if launch == "multi-prog" :
+        # Each rank of a single job step runs its share of the chunks
+        _write_if_changed( path +s+ "farm.conf", "* bash farm.sh rank %t\n" )
+        lines = lines + [ "if command -v srun > /dev/null ; then",
+                          "    srun --multi-prog farm.conf",
+                          "else",
+                          "    for (( _cp_t=0 ; _cp_t < ${SLURM_NTASKS:-1} ; _cp_t++ )) ; do",
+                          "        bash farm.sh rank $_cp_t &",
+                          "    done",
+                          "    wait",
+                          "fi" ]
+    else :
+        # A job step per chunk, started as soon as a slot is free
+        step_mem = max( 1, int( _slurm_mem( mem ) * nodes // max( 1, ntasks ) ) )
+        lines = lines + [ "_cp_srun=''",
+                          "command -v srun > /dev/null && " + 
+                          f"_cp_srun='srun --exact --nodes=1 --ntasks=1 --cpus-per-task={ncpus} --mem={step_mem}'",
+                          "for _cp_n in $(bash farm.sh list) ; do",
+                          "    while (( $(jobs -rp | wc -l) >= ${SLURM_NTASKS:-1} )) ; do",
+                          "        wait -n",
+                          "    done",
+                          "    $_cp_srun bash farm.sh chunk $_cp_n &",
+                          "done",
+                          "wait" ]
+    lines = lines + [ "[ ! -s farm.failed ] || { echo \"Failed chunks: $(cat farm.failed)\" >&2 ; exit 1 ; }" ]
+
+    return lines
 
 # -----------------------------------------------------------------------------
-def parfor( loop, 
+def parfor( loop,
             path, 
             chunks=2, 
             chunk_size=None,
@@ -179,12 +5249,46 @@ def parfor( loop,
             mail_user="lzampa@ogs.it",
             other_lines='', 
             ifor=0,
-            readme_file_name="README_2_RUN" ) :
+            readme_file_name="README_2_RUN",
+            manifest=False,
+            weights=None,
+            cost_fn=None,
+            schedule="static",
+            batch_size=None,
+            pool=None,
+            pool_chunksize=None,
+            result=None,
+            checkpoint=False,
+            return_job=False,
+            fast_env=False,
+            bundle=False,
+            snapshot=False,
+            stage_in=None,
+            stage_out=None,
+            stage_workers=8,
+            keep_logs=0,
+            log_mode="files",
+            incremental=False,
+            autosize=False,
+            target_time=1800.0,
+            autosize_sample=5,
+            autosize_margin=1.5,
+            telemetry=False,
+            launch="array",
+            stream=False,
+            cache=None,
+            cache_size=100000,
+            grace=None ) :
     
     """
     Generate a simple parallelized version of a python for-loop 
     to be run as a SLURM-job script on cineca Systems (Tested only on g100).
 
+    The loop code is parsed with the 'ast' module: only the statements the 
+    iterable of the 'ifor'-th loop depends on are executed to get its length, 
+    and nothing is executed at all when the length is statically known 
+    (e.g. range(n), np.arange(...), len(x) of a literal).
+
     Args:
         - loop (str): The path to the file containing the for loop code or the string containing the code itself.
         
@@ -203,7 +5307,8 @@ def parfor( loop,
         - alias (list, optional): A list of aliases for the imported modules. 
           Must have the same length as the 'modules' list. Defaults to [].
         
-        - run (bool, optional): Whether to run the generated SLURM job script immediately. Defaults to False.
+        - run (bool, optional): Whether to run the generated SLURM job script immediately. 
+          Outside Cineca, the script is run by the local executor ( see 'run_local' ). Defaults to False.
         
         - add_time (bool, optional): Whether to append the current timestamp to the job script name. Defaults to False.
         
@@ -235,112 +5340,411 @@ def parfor( loop,
 
         - other_lines (str, optional): Other lines to be added to the SLURM job script. Defaults to ''.
 
-        - ifor (int, optional): The index of the for loop to parallelize. Defaults to 0.
+        - ifor (int or list, optional): The index of the for loop to parallelize. With a list of indices
+          of perfectly nested loops ( e.g. [0, 1, 2] for 'for a in A : for b in B : for c in C :' ), 
+          the loops are parallelized together over the Cartesian product of their iterables: 
+          the iterations are numbered with a flat index, mapped in the tasks to the items 
+          of each loop without building the product (see 'Product' and '_flatten_loops'), 
+          and the chunks are balanced over the whole product. Defaults to 0.
 
         - readme_file_name (str, optional): The name of the README file. Defaults to "README_2_RUN".
 
+        - manifest (bool, optional): Whether to evaluate the iterable once, in the submitting process,
+          and store it in a memory-mapped manifest in 'path/manifest' (see 'write_manifest').
+          The tasks then read only their own slice of it, and skip the prelude statements
+          needed only to build the iterable. Defaults to False.
+
+        - weights (array-like, optional): The expected cost of each iteration. If given, the iterations 
+          are partitioned into 'chunks' bins of similar total cost (see 'balanced_partition'), 
+          and the indices of each task are stored in 'path/manifest/partition*.npy'. Defaults to None.
+
+        - cost_fn (callable, optional): A function returning the expected cost of an item of the iterable,
+          used to compute the 'weights' when they are not given. Defaults to None.
+
+        - schedule (str, optional): "static" to assign a fixed set of iterations to each task, or
+          "dynamic" to let the tasks claim small batches of iterations from a work queue in 'path/queue'
+          (see 'write_queue' and 'claim_items') until it is empty. With "dynamic", the 'weights' are
+          only used to process the most expensive batches first. Defaults to "static".
+
+        - batch_size (int, optional): The number of iterations per batch of the "dynamic" schedule.
+          Defaults to None, i.e. about 8 batches per task.
+
+        - pool (str, optional): If "process" or "thread", each task spreads its iterations over a pool 
+          of processes or threads sized from SLURM_CPUS_PER_TASK (i.e. 'ncpus'), see 'pool_map'.
+          The loop body is run as a function, so it cannot contain 'break' statements and the variables 
+          it assigns are not visible after the loop. It cannot be combined with the "dynamic" schedule, 
+          whose batches would all be claimed at once by the pool reading its items ahead. 
+          Defaults to None (serial loop).
+
+        - pool_chunksize (int, optional): The number of iterations sent at once to a worker of the pool.
+          Defaults to None, i.e. about 4 chunks per worker.
+
+        - result (str, optional): An expression of the loop body (e.g. the name of a variable) whose value, 
+          at the end of each iteration, is the result of the iteration. The results of each task are 
+          written to a binary shard in 'path/results' (see 'ShardWriter'), and can be collected with 
+          'gather( path )' or 'reduce( path, op )'. As with 'pool', the loop body is run as a function.
+          Defaults to None (no results are captured).
+
+        - checkpoint (bool, optional): Whether the tasks record their completed iterations in the bitmap
+          'path/checkpoint/done.bitmap' (see 'Checkpoint'), updated every few seconds. The tasks skip the
+          iterations already completed, and 'resume( path )' resubmits only the missing work.
+          With 'result', iterations are marked as completed only once their results are on disk.
+          Defaults to False.
+
+        - return_job (bool, optional): Whether to also return the handle of the submitted job 
+          (see 'submit' and 'SlurmMonitor'). Defaults to False.
+
+        - fast_env (bool, optional): Whether the tasks export the environment captured once at generation 
+          time (see 'capture_environment') and run its python directly, instead of sourcing .bashrc and
+          running 'conda activate' each. Defaults to False.
+
+        - bundle (bool, optional): Whether to pack CinecaPy and the 'modules' into a bundle with precompiled
+          '.pyc' files (see 'build_bundle'), extracted once per node to the node-local storage and put first 
+          on the python path, to avoid the import metadata storm on the shared filesystem. Defaults to False.
+
+        - snapshot (bool, optional): Whether to run the code preceding the loop once, at generation time, 
+          and save the variables it computes to 'path/snapshot' (see '_snapshot_prelude'), so that the 
+          tasks load them instead of re-running the setup. Large numpy arrays are memory-mapped. 
+          The variables read by the loop must be picklable. Defaults to False.
+
+        - stage_in, stage_out, stage_workers : The data staged to and from the node-local storage 
+          (see 'create_sbatch_file'). Defaults to None, None, 8.
+
+        - keep_logs, log_mode : The handling of the previous logs and the aggregated logs 
+          (see 'create_sbatch_file'). Defaults to 0, "files".
+
+        - incremental (bool, optional): Whether to leave the job directory untouched if the loop, 
+          the arguments, the environment and the generated files did not change since the last 
+          generation (see '.cp_manifest.json' and 'generate_many'). The data read by the loop 
+          prelude is not tracked. Defaults to False.
+
+        - autosize (bool, optional): Whether to choose 'chunk_size', 'time' and 'mem' by running a random 
+          sample of 'autosize_sample' iterations locally, in a subprocess, and measuring their time and 
+          memory (see '_autosize'). The tasks are sized to last about 'target_time' seconds, and the 
+          requests include the safety factor 'autosize_margin'. The chosen plan is printed and saved
+          in 'path/autosize/plan.json'. Defaults to False.
+
+        - target_time (float, optional): The target duration of each task in seconds, with 'autosize'. Defaults to 1800.
+
+        - autosize_sample (int, optional): The number of iterations profiled by 'autosize'. Defaults to 5.
+
+        - autosize_margin (float, optional): The safety factor of the requests of 'autosize'. Defaults to 1.5.
+
+        - telemetry (bool, optional): Whether the tasks write the duration and the peak memory of each
+          iteration, and a summary of the task ( host, array ID, startup time ), as JSON lines in 
+          'path/telemetry' (see 'Telemetry' and 'profile_report'). With 'pool', only the task summary
+          is written. Defaults to False.
+
+        - launch (str, optional): How the chunks are run. With "array", each chunk is a task of a job array. 
+          With "multi-prog" or "farm", a single job allocates 'nodes' x 'ntasks' slots of 'ncpus' CPUs 
+          and runs all the chunks inside it, replacing the scheduling of every array task: "multi-prog" 
+          runs one 'srun --multi-prog' step whose ranks take the chunks in turn, "farm" starts an 
+          'srun' step per chunk as soon as a slot is free, which balances chunks of uneven duration 
+          (see '_farm_lines'). The chunks receive the same 'imin'/'imax' or task ID as the array tasks.
+          Defaults to "array".
+
+        - stream (bool, optional): Whether the iterable is consumed once, in the submitting process, 
+          and written to shard files of 'chunk_size' items in 'path/stream' as it is read, 
+          without ever holding it in memory or computing its length first (see 'write_stream_shards'). 
+          This is meant for generators and other iterables of unknown length ( e.g. 'glob.iglob', 
+          the lines of a huge file ). The job array has one task per shard, and each task streams 
+          only its own shard. Requires 'chunk_size', and the "static" schedule without weights.
+          Defaults to False.
+
+        - cache (str or bool, optional): The directory of a result cache shared by the jobs (see 'ResultCache'), 
+          or True for '$CINECA_SCRATCH/cp_cache'. Each iteration is identified by the digest of the loop body 
+          source, of the values of the prelude variables it reads, and of its item (see '_cache_keys'). 
+          The results already in the cache are written to the results of the job at generation time, 
+          the job array runs only the other iterations ( in fewer tasks ), and the tasks add their 
+          results to the cache. If all the iterations are cached, no command is returned ( None ). 
+          Values that cannot be hashed reliably raise a ValueError. Requires 'result'. Defaults to None (no cache).
+
+        - cache_size (float, optional): The maximum size of the cache in MB; the least recently used results 
+          are deleted beyond it. Defaults to 100000.
+
+        - grace (int, optional): The seconds reserved, before the time limit of the job, to flush the results. 
+          The tasks stop starting new iterations when the time left before the deadline is shorter than their 
+          longest iteration, or when SLURM signals them 'grace' seconds before the time limit 
+          ( '--signal=B:USR1@grace' ), write their results, save the list of their unfinished iterations 
+          and exit with code 75 (see 'Deadline'). 'resume( path )' then resubmits these tasks, which run only 
+          their unfinished iterations. With the "dynamic" schedule, the unfinished iterations are known only 
+          with 'checkpoint'. It cannot be combined with 'pool'. Defaults to None.
+
     Returns:
         - A tuple containing the paths of the generated SLURM job script, 
           the modified loop file, and the SLURM command to run the job.
+          If 'return_job' is True, the handle of the submitted job is appended 
+          ( a 'SlurmJob', the 'LocalTask' list outside Cineca, None if not run ).
     """
 
+    # The arguments of the call, recorded in the manifest of the job directory
+    params = dict( locals() )
+
     # Check if the directory specified by 'path' exists
     if os.path.exists( path ) == False :
         # If not, create the directory
         os.makedirs( path, exist_ok=True )
 
-    # 'path' is assumed to be the directory where you want to check/copy the file
-    path_file = os.path.join(path, os.path.basename(loop))
-
-    # Check if the file exists at the given path
+    # Copy the loop file to the job directory, if it changed
     if os.path.isfile(loop):
-        # Open the file and read its content
-        with open(loop, "r") as fl:
-            loop_content = fl.read()
-
-        # Check if the file exists in the destination path
-        if os.path.isfile(path_file):
-            # Open the file and read its content
-            with open(path_file, "r") as fl:
-                path_file_content = fl.read()
-
-            # If the content of the two files is different, copy the file to the destination path
-            if loop_content != path_file_content:
-                shutil.copy2(loop, path)  # Overwrite file in path if content is different
-        else:
-            # If the file does not exist in the destination path, copy it there
-            shutil.copy2(loop, path)  # Copy file to path if it does not exist there
+        _copy_if_changed( loop, path )
 
     # Create a the file name for the python job file
     if '.' not in filename :
         filename = filename + ".bat"
     job = filename.split(".")[0]
 
-    # Create an empty dictionary to store the local variables of the exec function
-    scope = {}
-
     # If add_time is True, append the current time to the job name
     if add_time == True :
         job = job + "_" + Time.strftime('%y_%m_%d_%H_%M_%S') + ".py" 
     else :
         job = job + ".py"
 
-    # Open a new file in write mode
-    f = open( path +s+ job, "w" )
-    # Split the loop content by the word "import"
-    imports = loop.split("import")
+    # Read the loop source code (from the file or from the string itself)
+    loop_source = _read_source( loop )
 
-    import_lines = []
-    # If there are imports in the loop content
-    if len( imports ) > 1 :
-        # For each import statement
-        for i in range(1, len( imports )) :
-            # Write the import statement to the new file
-            f.write( f"import {imports[i].split()[0]}" )
-            # Add the import statement to the list of import lines
-            import_lines.append( f"import {imports[i].split()[0]}" )
-            # If the import statement has an alias
-            if ( len( imports[i].split() ) > 2 ) and ( imports[i].split()[1] == "as" ) :
-                # Write the alias to the new file
-                f.write( f" as {imports[i].split()[2]}" )
-                # Add the alias to the last import line in the list
-                import_lines[-1] = import_lines[-1] + f" as {imports[i].split()[2]}"
-                exec( import_lines[-1], scope )
-            # Write a newline character to the new file
-            f.write("\n")
-    
-    # For each import line
-    import_argparse = False
-    import_os = False
-    import_sys = False
-    for im in import_lines :
-        # If the import line imports the argparse module
-        if "import argparse" in im :
-            import_argparse = True
-        # If the import line imports the os module
-        if "import os" in im :
-            import_os = True
-        # If the import line imports the sys module
-        if "import sys" in im :
-            import_sys = True
-    # If the argparse module is not imported
-    if import_argparse == False :
-        # Write an import statement for the argparse module to the new file
-        import_lines.append( "import argparse" )
-        exec( import_lines[-1], scope )
-        f.write("import argparse\n")
-    # If the os module is not imported
-    if import_os == False :
-        # Write an import statement for the os module to the new file
-        import_lines.append( "import os" )
-        exec( import_lines[-1], scope )
-        f.write("import os\n")
-    # If the sys module is not imported
-    if import_sys == False :
-        # Write an import statement for the sys module to the new file
-        import_lines.append( "import sys" )
-        exec( import_lines[-1], scope )
-        f.write("import sys\n")
+    # File name used in the tracebacks of the loop code
+    loop_filename = loop if os.path.isfile( loop ) else "<parfor>"
+
+    # Nested loops are parallelized together, over the product of their iterables
+    nested = isinstance( ifor, ( list, tuple ) ) and len( set( ifor ) ) > 1
+    if nested :
+        loop_source, ifor = _flatten_loops( loop_source, ifor, filename=loop_filename )
+    elif isinstance( ifor, ( list, tuple ) ) :
+        ifor = ifor[0]
+
+    # If nothing changed since the last generation, the job directory is left untouched
+    if incremental == True :
+        inputs = _inputs_digest( "parfor", loop_source, params )
+        previous = _unchanged_job( path, inputs )
+        if previous is not None and run == False :
+            if printf == True :
+                print( f"{path} : unchanged, nothing regenerated" )
+            return previous
+
+    # Check the scheduling mode
+    if schedule not in ( "static", "dynamic" ) :
+        raise ValueError( f"Unknown schedule '{schedule}', use 'static' or 'dynamic'." )
+    dynamic = ( schedule == "dynamic" )
+
+    if launch not in ( "array", "multi-prog", "farm" ) :
+        raise ValueError( f"Unknown launch '{launch}', use 'array', 'multi-prog' or 'farm'." )
+    if launch != "array" :
+        # A single job: its logs are named after the job ID
+        out = out.replace( "%a", "%j" )
+        err = err.replace( "%a", "%j" )
+
+    if grace is not None and pool is not None :
+        raise ValueError( "'grace' cannot be combined with 'pool'." )
+    # The pool reads its items ahead: it would claim ( and mark as done ) the whole queue at once
+    if dynamic and pool is not None :
+        raise ValueError( "The 'dynamic' schedule cannot be combined with 'pool'." )
+
+    if cache is not None :
+        if result is None :
+            raise ValueError( "'cache' stores the results of the iterations, it needs 'result'." )
+        if stream == True :
+            raise ValueError( "'cache' cannot be combined with 'stream'." )
+
+    # Whether the iterations are assigned to the tasks as lists of indices
+    weighted = ( weights is not None ) or ( cost_fn is not None ) or ( cache is not None )
+
+    # Whether the tasks select their iterations from their task ID, instead of imin/imax
+    by_task = weighted or dynamic
+
+    if stream == True :
+        if chunk_size is None :
+            raise ValueError( "'stream' needs 'chunk_size', the number of items of each shard." )
+        if by_task or ( manifest == True ) or ( autosize == True ) :
+            raise ValueError( "'stream' cannot be combined with 'manifest', 'autosize', "
+                              "'weights', 'cost_fn' or the 'dynamic' schedule." )
+
+    # Whether the generated script needs this module at run time
+    runtime = ( manifest == True ) or ( stream == True ) or by_task or ( pool is not None ) or ( result is not None ) or \
+              ( checkpoint == True ) or ( snapshot == True ) or ( telemetry == True ) or nested or \
+              ( grace is not None )
+
+    # If stream is True, write the items to shards as the iterable is consumed
+    if stream == True :
+        if snapshot == True :
+            iter_value, for_node, tree, skip_statements = _snapshot_prelude( path +s+ "snapshot", 
+                                                                             loop_source, 
+                                                                             ifor=ifor, 
+                                                                             modules=modules, 
+                                                                             alias=alias, 
+                                                                             filename=loop_filename )
+        else :
+            iter_value, for_node, tree = _loop_iterable( loop_source, 
+                                                         ifor=ifor, 
+                                                         modules=modules, 
+                                                         alias=alias, 
+                                                         filename=loop_filename,
+                                                         static=False )
+            # The prelude statements needed only to build the iterable are not run by the tasks
+            skip_statements = _iterable_only_statements( tree, for_node )
+        loop_len, _ = write_stream_shards( path +s+ "stream", iter_value, chunk_size )
+        del iter_value
+    # If snapshot is True, run the whole prelude once and save its variables
+    elif snapshot == True :
+        iter_value, for_node, tree, skip_statements = _snapshot_prelude( path +s+ "snapshot", 
+                                                                         loop_source, 
+                                                                         ifor=ifor, 
+                                                                         modules=modules, 
+                                                                         alias=alias, 
+                                                                         filename=loop_filename )
+        loop_len = len( iter_value )
+        # Compute the cost of each iteration
+        if weights is None and cost_fn is not None :
+            weights = [ cost_fn( v ) for v in iter_value ]
+        # Compute the cache key of each iteration
+        if cache is not None :
+            cache_keys = _cache_keys( loop_source, tree, for_node, iter_value, result=result, 
+                                      modules=modules, alias=alias, filename=loop_filename )
+        # If manifest is True, store the iterable on disk
+        if manifest == True :
+            write_manifest( path +s+ "manifest", iter_value )
+        del iter_value
+    # If the actual items are needed, build the iterable once
+    elif ( manifest == True ) or ( weights is None and cost_fn is not None ) or ( cache is not None ) :
+        iter_value, for_node, tree = _loop_iterable( loop_source, 
+                                                     ifor=ifor, 
+                                                     modules=modules, 
+                                                     alias=alias, 
+                                                     filename=loop_filename,
+                                                     static=False )
+        loop_len = len( iter_value )
+        # Compute the cost of each iteration
+        if weights is None and cost_fn is not None :
+            weights = [ cost_fn( v ) for v in iter_value ]
+        # Compute the cache key of each iteration
+        if cache is not None :
+            cache_keys = _cache_keys( loop_source, tree, for_node, iter_value, result=result, 
+                                      modules=modules, alias=alias, filename=loop_filename )
+        skip_statements = []
+        # If manifest is True, store the iterable on disk
+        if manifest == True :
+            write_manifest( path +s+ "manifest", iter_value )
+            # The prelude statements needed only to build the iterable are not run by the tasks
+            skip_statements = _iterable_only_statements( tree, for_node )
+        del iter_value
+    # Otherwise, compute the length of the iterable of the 'ifor'-th loop,
+    # executing only the statements it depends on (or nothing, if it is static)
+    else :
+        loop_len, for_node, tree = _loop_length( loop_source, 
+                                                 ifor=ifor, 
+                                                 modules=modules, 
+                                                 alias=alias, 
+                                                 filename=loop_filename )
+        skip_statements = []
+
+    # An empty loop would generate tasks with nothing to do
+    if loop_len == 0 :
+        raise ValueError( "The iterable of the loop is empty." )
+
+    # If autosize is True, profile a sample of iterations to size the tasks
+    if autosize == True :
+        plan = _autosize( path, loop_source, for_node, loop_len, modules=modules, alias=alias, 
+                          sample=autosize_sample, target_time=target_time, margin=autosize_margin )
+        chunk_size = plan[ "chunk_size" ]
+        time = plan[ "time" ]
+        mem = plan[ "mem" ]
+
+    # If the chunk size is not specified
+    if chunk_size is None:
+        # If the number of chunks is specified and is greater than 1
+        if chunks is not None and chunks > 1:
+            # Calculate the chunk size
+            chunk_size = int( np.ceil( loop_len / chunks ) )
+        else:
+            # Raise a ValueError
+            raise ValueError("The number of chunks must be greater than 1" +
+                            " if chunk_size is not specified.")
+    else:
+        # Calculate the number of chunks
+        chunks = int( np.ceil( loop_len / chunk_size ) )
+
+    if weights is None and cache is not None :
+        weights = np.ones( loop_len )
+    if weighted and len( weights ) != loop_len :
+        raise ValueError( f"'weights' has {len( weights )} elements, but the loop has {loop_len} iterations." )
+
+    # The results of a previous generation are not mixed with the new ones
+    _clear_results( path )
+
+    # With the cache, the results already computed are copied to the job, and only the others are run
+    todo = None
+    if cache is not None :
+        store = ResultCache( _cache_dir( cache ) )
+        os.makedirs( path +s+ "results", exist_ok=True )
+        np.save( path +s+ "cache_keys.npy", np.asarray( cache_keys, dtype="S40" ) )
+        hits = ShardWriter( path +s+ "results", 0 )
+        missing = []
+        for i, key in enumerate( cache_keys ) :
+            if key in store :
+                try :
+                    hits.write( i, store.get( key ) )
+                    continue
+                except ( OSError, EOFError, pickle.UnpicklingError ) :
+                    pass
+            missing.append( i )
+        hits.close()
+        todo = np.asarray( missing, dtype=np.int64 )
+        chunks = int( np.ceil( len( todo ) / chunk_size ) )
+        removed = store.evict( cache_size )
+        print( f"Cache : {loop_len - len( todo )} of {loop_len} iterations cached, {len( todo )} to run "
+               f"in {chunks} tasks" + ( f" ( {removed} old results evicted )" if removed > 0 else "" ) )
+
+    # If dynamic, fill the work queue with small batches of iterations
+    if dynamic :
+        if batch_size is None :
+            batch_size = max( 1, int( np.ceil( loop_len / ( max( chunks, 1 ) * 8 ) ) ) )
+        nbatches = write_queue( path +s+ "queue", loop_len, batch_size, weights=weights, indices=todo )
+        if printf == True :
+            print( f"Work queue : {nbatches} batches of {batch_size} iterations" )
+
+    # If the iterations have different costs, partition them into balanced bins
+    elif weighted and todo is not None :
+        # Only the iterations missing from the cache are partitioned
+        bins, loads = balanced_partition( np.asarray( weights, dtype=float )[ todo ], max( chunks, 1 ) )
+        write_partition( path +s+ "manifest", [ todo[ b ] for b in bins ] )
+        np.save( path +s+ "manifest" +s+ "weights.npy", np.asarray( weights, dtype=float ) )
+    elif weighted :
+        bins, loads = balanced_partition( weights, chunks )
+        write_partition( path +s+ "manifest", bins )
+        # The weights are kept to re-partition the missing iterations when resuming
+        np.save( path +s+ "manifest" +s+ "weights.npy", np.asarray( weights, dtype=float ) )
+        # Report the predicted load imbalance ( 1 is a perfect balance )
+        imbalance = loads.max() / loads.mean() if loads.mean() > 0 else 1.0
+        print( f"Predicted load imbalance (max/mean task cost) : {imbalance:.3f}" )
+        if printf == True :
+            print( f"Predicted cost of each task : {loads}" )
+
+    # Split the loop content by newline characters
+    loop_lines = loop_source.split("\n")
+
+    # Build the new file in memory ( written only if it changed )
+    f = io.StringIO()
+
+    # Copy the top-level import statements of the loop code to the new file
+    import_lines = []
+    imported = set()
+    for stmt in tree.body :
+        if isinstance( stmt, ( ast.Import, ast.ImportFrom ) ) :
+            import_lines.append( _source_segment( loop_lines, stmt ) )
+            imported = imported | _bound_names( stmt )
+            f.write( import_lines[-1] + "\n" )
+
+    # Import the modules needed by the generated script, if they are not imported yet
+    for module in ( "argparse", "os", "sys" ) :
+        if module not in imported :
+            import_lines.append( f"import {module}" )
+            f.write( f"import {module}\n" )
+
+    # Import this module, used by the tasks to read the job-directory files
+    if runtime :
+        for line in _runtime_import_lines() :
+            import_lines.append( line )
+            f.write( line + "\n" )
     
     # If there are modules to be imported
     if modules != [] :
@@ -356,13 +5760,9 @@ def parfor( loop,
                     line_import = line_import + f" as {alias[modules.index( module )]}"
             # Write the import statement to the new file
             import_lines.append( line_import )
-            exec( import_lines[-1], scope )
             f.write( line_import + "\n")
             # Write a newline character to the new file
             f.write("\n")
-    
-    # Split the loop content by newline characters
-    loop_lines = loop.split("\n")
 
     # Write the if __name__ == '__main__' statement to the new file
     f.write("\n\nif __name__ == '__main__' :\n\n")
@@ -371,69 +5771,208 @@ def parfor( loop,
     # Write the addition of the imin and imax arguments to the new file
     f.write("    p.add_argument('-imin', '--imin', type=int)\n")
     f.write("    p.add_argument('-imax', '--imax', type=int)\n")
+    # Write the addition of the task ID argument to the new file
+    if runtime :
+        f.write("    p.add_argument('-itask', '--itask', type=int)\n")
     # Write the parsing of the arguments to the new file
     f.write("    arg = p.parse_args()\n\n")
 
-    # Initialize the length of the iterable object in the for loop to None
-    loop_len = None
-    # Initialize the for loop counter to -1
-    fi = -1
-    # For each line in the loop content
-    for line in loop_lines:
-        # If the line is a for loop statement and the for loop has not started yet
-        if ( line.strip().startswith("for ") ) :
-            fi += 1
-            if fi == ifor :
-                # Get the iterable object in the for loop statement
-                iter_object = line.split(" in ")[1].split(':')[0].strip()
-                # Execute the iterable object to get its actual value
-                iter_value = eval( iter_object, scope )
-                # Get the length of the iterable object
-                loop_len = len(iter_value)
-                # Replace the iterable object in the for loop statement with a slice of itself
-                line = line.split(" in ")[0]+' in '+ iter_object + '[ arg.imin : arg.imax ] :'
-
-        # If we are not inside a loop
-        elif line.startswith(' ') == False :
-            # Execute the line
-            exec( line, scope )
-
-        # Write the line to the new file
+    # The directory of the job files
+    if runtime :
+        f.write("    _job_dir = os.path.dirname( os.path.abspath( __file__ ) )\n\n")
+
+    # The variables computed once by the prelude
+    if snapshot == True :
+        f.write("    globals().update( _cp.load_snapshot( _job_dir + os.sep + 'snapshot' ) )\n\n")
+
+    # The completion bitmap of the job
+    if checkpoint == True :
+        create_checkpoint( path +s+ "checkpoint", loop_len )
+        # The iterations found in the cache are completed
+        if todo is not None :
+            ckpt = Checkpoint( path +s+ "checkpoint" )
+            ckpt.mark_many( np.setdiff1d( np.arange( loop_len ), todo ) )
+            ckpt.flush()
+        f.write("    _cp_ckpt = _cp.Checkpoint( _job_dir + os.sep + 'checkpoint' )\n\n")
+
+    # The telemetry of the task
+    if telemetry == True :
+        os.makedirs( path +s+ "telemetry", exist_ok=True )
+        f.write("    _cp_tel = _cp.Telemetry( _job_dir + os.sep + 'telemetry', arg.itask )\n\n")
+
+    # The writer of the results of the task
+    if result is not None and checkpoint == True :
+        f.write("    _cp_shard = _cp.ShardWriter( _job_dir + os.sep + 'results', arg.itask, " + 
+                "interval=_cp_ckpt.interval, checkpoint=_cp_ckpt )\n\n")
+    elif result is not None :
+        f.write("    _cp_shard = _cp.ShardWriter( _job_dir + os.sep + 'results', arg.itask )\n\n")
+    # The results are also added to the cache
+    if cache is not None :
+        f.write(f"    _cp_shard = _cp.CachingWriter( _cp_shard, {_cache_dir( cache )!r}, " + 
+                "_job_dir + os.sep + 'cache_keys.npy' )\n\n")
+    if result is not None :
+        # The total number of iterations, used to assemble the results
+        os.makedirs( path +s+ "results", exist_ok=True )
+        with open( path +s+ "results" +s+ "results.json", "w" ) as fj :
+            json.dump( { "n": int( loop_len ) }, fj )
+
+    # Replace the iterable object in the for loop statement with a slice of itself
+    if manifest == True :
+        # The slice is a zero-copy view of the manifest
+        iter_object = "_cp.load_manifest( _job_dir + os.sep + 'manifest' )"
+    elif stream == True :
+        # The shard of the task is read as a stream
+        iter_object = "_cp.read_stream_shard( _job_dir + os.sep + 'stream', arg.itask )"
+    else :
+        iter_object = _source_segment( loop_lines, for_node.iter )
+        if not isinstance( for_node.iter, ( ast.Name, ast.Attribute, ast.Call, ast.Subscript ) ) :
+            iter_object = "( " + iter_object + " )"
+    # If the results are captured or the iterations are tracked, the items are paired with their index
+    indexed = ( result is not None ) or ( checkpoint == True ) or ( grace is not None )
+    if dynamic :
+        # The items are claimed batch by batch from the work queue
+        iter_object = f"_cp.claim_items( {iter_object}, _job_dir + os.sep + 'queue', arg.itask, {chunks}" + \
+                      ( ", indexed=True )" if indexed else " )" )
+    elif weighted :
+        # The items are selected with the list of indices of the task
+        f.write("    _cp_indices = _cp.load_partition( _job_dir + os.sep + 'manifest', arg.itask )\n\n")
+        iter_object = f"_cp.take( {iter_object}, _cp_indices )"
+        if indexed :
+            iter_object = f"zip( _cp_indices, {iter_object} )"
+    else :
+        if stream == False :
+            iter_object = iter_object + "[ arg.imin : arg.imax ]"
+        if indexed :
+            iter_object = f"enumerate( {iter_object}, arg.imin )"
+
+    # The completed iterations are skipped
+    if checkpoint == True :
+        iter_object = f"_cp_ckpt.todo( {iter_object} )"
+    # The loop body is timed on each item
+    if telemetry == True and pool is None :
+        iter_object = f"_cp_tel.track( {iter_object}, indexed={indexed} )"
+    # The loop stops before the time limit of the job
+    if grace is not None :
+        if dynamic :
+            planned = "None"
+        elif weighted :
+            planned = "_cp_indices"
+        else :
+            planned = f"range( arg.imin, min( arg.imax, {loop_len} ) )"
+        f.write(f"    _cp_deadline = _cp.Deadline( _job_dir + os.sep + 'unfinished', arg.itask, indices={planned} )\n\n")
+        iter_object = f"_cp_deadline.track( {iter_object} )"
+    if checkpoint == True :
+        # Each iteration is marked as completed when the next one starts
+        tracked_object = f"_cp_ckpt.track( {iter_object} )"
+    elif grace is not None :
+        tracked_object = f"_cp_deadline.items( {iter_object} )"
+    else :
+        tracked_object = iter_object
+
+    # If pool is given, the loop body is mapped over a pool of workers
+    if pool is not None :
+        runner = f"_cp.pool_map( _cp_body, {iter_object}, kind={pool!r}, chunksize={pool_chunksize} )"
+    else :
+        runner = f"map( _cp_body, {iter_object} )"
+    # The loop body becomes a function if it runs in a pool or if its results are captured
+    if result is not None :
+        _loop_to_function( loop_lines, for_node, runner, 
+                           sink="_cp_shard.write( *_cp_result )", result=result, indexed=True )
+    elif pool is not None :
+        _loop_to_function( loop_lines, for_node, runner, 
+                           sink="_cp_ckpt.mark( _cp_result[0] )" if indexed else "pass", indexed=indexed )
+    elif indexed :
+        # Each iteration is marked as completed when the next one starts
+        _replace_segment( loop_lines, for_node.iter, tracked_object )
+    else :
+        _replace_segment( loop_lines, for_node.iter, iter_object )
+
+    # Remove the statements the tasks do not need ( they all precede the loop )
+    for stmt in sorted( skip_statements, key=lambda stmt : stmt.lineno, reverse=True ) :
+        del loop_lines[ stmt.lineno - 1 : stmt.end_lineno ]
+
+    # Write the lines to the new file
+    for line in "\n".join( loop_lines ).split( "\n" ) :
         f.write( "    " + line + "\n" )
 
-    # Close the new file
+    # Finalize the shard with the results of the task
+    if result is not None :
+        f.write( "    _cp_shard.close()\n" )
+    # Write the last completed iterations
+    if checkpoint == True :
+        f.write( "    _cp_ckpt.close()\n" )
+    # Write the last records of the telemetry
+    if telemetry == True :
+        f.write( "    _cp_tel.close()\n" )
+    # Save the unfinished iterations, if the loop was stopped before the time limit
+    if grace is not None :
+        f.write( "    _cp_deadline.close()\n" )
+        f.write( "    if _cp_deadline.stopped :\n" )
+        f.write( "        sys.exit( 75 )\n" )
+
+    # The lines setting up the python environment of the tasks
+    env_lines, python = _environment_lines( fast_env, printf=printf )
+    if bundle == True :
+        env_lines = env_lines + _bundle_lines( *build_bundle( os.path.abspath( path ), modules ) )
+
+    # Write the description of the job, used e.g. by 'resume'
+    _write_if_changed( path +s+ "parfor.json", 
+        json.dumps( { "n": int( loop_len ), 
+                     "chunks": int( chunks ), 
+                     "chunk_size": int( chunk_size ), 
+                     "schedule": schedule, 
+                     "batch_size": batch_size, 
+                     "weighted": weighted, 
+                     "result": result, 
+                     "checkpoint": checkpoint == True, 
+                     "filename": filename, 
+                     "job": job,
+                     "fast_env": fast_env == True,
+                     "snapshot": snapshot == True,
+                     "telemetry": telemetry == True,
+                     "launch": launch,
+                     "stream": stream == True,
+                     "grace": grace }, indent=1 ) )
+
+    # Write the new file
+    _write_if_changed( path +s+ job, f.getvalue() )
     f.close()
 
-    # If the chunk size is not specified
-    if chunk_size is None:
-        # If the number of chunks is specified and is greater than 1
-        if chunks is not None and chunks > 1:
-            # Calculate the chunk size
-            chunk_size = int( np.ceil( loop_len / chunks ) )
-        else:
-            # Raise a ValueError
-            raise ValueError("The number of chunks must be greater than 1" +
-                            " if chunk_size is not specified.")
-    else:
-        # Calculate the number of chunks
-        chunks = int( np.ceil( loop_len / chunk_size ) )
+    # Create a list to store the lines running the chunk n
+    chunk_lst = []
+    if not by_task :
+        # Add the calculation of the start index of the slice to the list
+        chunk_lst.append( f'((imin=(n-1)*{chunk_size}))' )
+        # Add the calculation of the end index of the slice to the list
+        chunk_lst.append( f'((imax=n*{chunk_size}))' )
+    # Add the command to run the new file to the list
+    if by_task :
+        chunk_lst.append( f'{python} {job} -itask $n' )
+    elif runtime :
+        chunk_lst.append( f'{python} {job} -imin $imin -imax $imax -itask $n' )
+    else :
+        chunk_lst.append( f'{python} {job} -imin $imin -imax $imax' )
+    # The task runs in the background, so that the batch script can forward the signal to it
+    if grace is not None :
+        chunk_lst[-1] = chunk_lst[-1] + " &"
+        chunk_lst.extend( [ "_cp_pid=$!",
+                            "wait $_cp_pid ; _cp_rc=$?",
+                            "while kill -0 $_cp_pid 2> /dev/null ; do wait $_cp_pid ; _cp_rc=$? ; done",
+                            "( exit $_cp_rc )" ] )
 
     # Create a list to store the main part of the slurm script
     slurm_main_lst = []
-    # Add the calculation of the task ID to the list
-    slurm_main_lst.append( f'n=$SLURM_ARRAY_TASK_ID' )
-    # Add the calculation of the start index of the slice to the list
-    slurm_main_lst.append( f'((n=n*{chunk_size}))' )
-    # Add the calculation of the end index of the slice to the list
-    slurm_main_lst.append( f'((imin=n-{chunk_size}))' )
-    # Add the calculation of the end index of the slice to the list
-    slurm_main_lst.append( f'((imax=n+1))' )
-    # Add the source command to the list
-    slurm_main_lst.append( f'source $HOME/.bashrc' )
-    # Add the module commands to the list
-    slurm_main_lst.append( f'conda activate {sys.prefix}' )
-    # Add the command to run the new file to the list
-    slurm_main_lst.append( f'python {job} -imin $imin -imax $imax' )
+    if launch == "array" :
+        # Add the calculation of the task ID to the list
+        slurm_main_lst.append( f'n=$SLURM_ARRAY_TASK_ID' )
+        # Add the environment setup ( .bashrc + conda activate, or the captured environment ) to the list
+        slurm_main_lst.extend( env_lines )
+        slurm_main_lst.extend( chunk_lst )
+    else :
+        # The environment is set up once, and inherited by all the chunks
+        slurm_main_lst.extend( env_lines )
+        slurm_main_lst.extend( _farm_lines( path, launch, chunk_lst, chunks, 
+                                            nodes=nodes, ntasks=ntasks, ncpus=ncpus, mem=mem ) )
     
     # Create a string to store the main part of the slurm script
     slurm_main_str = ""
@@ -467,21 +6006,49 @@ def parfor( loop,
                             partition=partition,
                             mail_type=mail_type,
                             mail_user=mail_user,
-                            other_lines=other_lines )
+                            other_lines=other_lines,
+                            stage_in=stage_in,
+                            stage_out=stage_out,
+                            stage_workers=stage_workers,
+                            keep_logs=keep_logs,
+                            log_mode=log_mode,
+                            signal_time=grace )
 
-    # Create the command to submit the slurm script
-    sbatch_cmd = f"sbatch --array=1-{chunks} {path+os.sep+filename} &> log &"
+    # The job array, or a single job running all the chunks
+    array = f"1-{chunks}" if launch == "array" else None
+    array_option = f"--array={array} " if launch == "array" else ""
 
-    # Create a README file in the directory
-    with open( path +s+ readme_file_name, "w") as f :
-        f.write( "# Youcan run the job by executing the following command:\n" )
-        f.write( f"sbatch --array=1-{chunks} {path+os.sep+filename}\n" )
-    f.close()
+    if chunks > 0 :
+        # Create the command to submit the slurm script
+        sbatch_cmd = f"sbatch {array_option}{path+os.sep+filename} &> log &"
+        # Create a README file in the directory
+        _write_if_changed( path +s+ readme_file_name, 
+                           "# Youcan run the job by executing the following command:\n" + 
+                           f"sbatch {array_option}{path+os.sep+filename}\n" )
+    else :
+        # All the iterations are cached: there is no job to submit
+        sbatch_cmd = None
+        print( "Cache : all the iterations are cached, nothing is left to run" )
+        _write_if_changed( path +s+ readme_file_name, 
+                           "# All the iterations are cached, nothing is left to run.\n" + 
+                           f"# The results are in {path+os.sep}results ( see 'gather' ).\n" )
 
-    # If run is True
-    if run == True :
-        # Submit the slurm script
-        os.system( sbatch_cmd )
+    # Record the inputs of this generation
+    if incremental == True :
+        _record_job( path, inputs, [ path+s+filename, path+s+job, sbatch_cmd ] )
+
+    # If run is True ( and some iterations are not cached )
+    handle = None
+    if run == True and chunks > 0 :
+        if is_cineca_system() :
+            # Submit the slurm script
+            handle = submit( path +s+ filename, array=array )
+        else :
+            # Outside SLURM, run the job array with the local executor
+            handle = run_local( path +s+ filename, array=array )
+
+    if return_job == True :
+        return path+s+filename, path+s+job, sbatch_cmd, handle
 
     # Return the path of the slurm script, the path of the new file, and the command to submit the slurm script
     return path+s+filename, path+s+job, sbatch_cmd
@@ -508,7 +6075,16 @@ def script2slurm( pycode,
                   mail_user="lzampa@ogs.it",
                   other_lines='', 
                   readme_file_name="README_2_RUN",
-                  absolute_path=False ) :
+                  absolute_path=False,
+                  return_job=False,
+                  fast_env=False,
+                  bundle=False,
+                  stage_in=None,
+                  stage_out=None,
+                  stage_workers=8,
+                  keep_logs=0,
+                  log_mode="files",
+                  incremental=False ) :
     
     """
     Generate a simple parallelized version of a python for-loop 
@@ -532,7 +6108,8 @@ def script2slurm( pycode,
         - alias (list, optional): A list of aliases for the imported modules. 
           Must have the same length as the 'modules' list. Defaults to [].
         
-        - run (bool, optional): Whether to run the generated SLURM job script immediately. Defaults to False.
+        - run (bool, optional): Whether to run the generated SLURM job script immediately. 
+          Outside Cineca, the script is run by the local executor ( see 'run_local' ). Defaults to False.
         
         - add_time (bool, optional): Whether to append the current timestamp to the job script name. Defaults to False.
         
@@ -566,37 +6143,51 @@ def script2slurm( pycode,
 
         - readme_file_name (str, optional): The name of the README file. Defaults to "README_2_RUN".
 
+        - return_job (bool, optional): Whether to also return the handle of the submitted job. Defaults to False.
+
+        - fast_env (bool, optional): Whether the job exports the environment captured at generation time
+          (see 'capture_environment') instead of sourcing .bashrc and running 'conda activate'. Defaults to False.
+
+        - bundle (bool, optional): Whether to stage CinecaPy and the 'modules' on the node-local storage 
+          (see 'build_bundle'). Defaults to False.
+
+        - stage_in, stage_out, stage_workers : The data staged to and from the node-local storage 
+          (see 'create_sbatch_file'). Defaults to None, None, 8.
+
+        - keep_logs, log_mode : The handling of the previous logs and the aggregated logs 
+          (see 'create_sbatch_file'). Defaults to 0, "files".
+
+        - incremental (bool, optional): Whether to leave the job directory untouched if the code, 
+          the arguments, the environment and the generated files did not change since the last 
+          generation (see 'parfor'). Defaults to False.
+
     Returns:
         - A tuple containing the paths of the generated SLURM job script, 
           the modified loop file, and the SLURM command to run the job.
+          If 'return_job' is True, the handle of the submitted job is appended 
+          ( a 'SlurmJob', the 'LocalTask' list outside Cineca, None if not run ).
     """
 
+    # The arguments of the call, recorded in the manifest of the job directory
+    params = dict( locals() )
+
     # Check if the directory specified by 'path' exists
     if os.path.exists( path ) == False :
         # If not, create the directory
         os.makedirs( path, exist_ok=True )
 
-    # 'path' is assumed to be the directory where you want to check/copy the file
-    path_file = os.path.join(path, os.path.basename(pycode))
-
-    # Check if the file exists at the given path
+    # Copy the code file to the job directory, if it changed
     if os.path.isfile(pycode):
-        # Open the file and read its content
-        with open(pycode, "r") as fl:
-            loop_content = fl.read()
-
-        # Check if the file exists in the destination path
-        if os.path.isfile(path_file):
-            # Open the file and read its content
-            with open(path_file, "r") as fl:
-                path_file_content = fl.read()
-
-            # If the content of the two files is different, copy the file to the destination path
-            if loop_content != path_file_content:
-                shutil.copy2(pycode, path)  # Overwrite file in path if content is different
-        else:
-            # If the file does not exist in the destination path, copy it there
-            shutil.copy2(pycode, path)  # Copy file to path if it does not exist there
+        _copy_if_changed( pycode, path )
+
+    # If nothing changed since the last generation, the job directory is left untouched
+    if incremental == True :
+        inputs = _inputs_digest( "script2slurm", _read_source( pycode ), params )
+        previous = _unchanged_job( path, inputs )
+        if previous is not None and run == False :
+            if printf == True :
+                print( f"{path} : unchanged, nothing regenerated" )
+            return previous
 
     # Create a the file name for the python job file
     if '.' not in filename :
@@ -612,9 +6203,9 @@ def script2slurm( pycode,
     else :
         job = job + ".py"
 
-    # Open a new file in write mode
+    # Build the new file in memory ( written only if it changed )
     pyjob_file = path +s+ job
-    f = open( pyjob_file, "w" )
+    f = io.StringIO()
     # Split the loop content by the word "import"
     imports = pycode.split("import")
 
@@ -698,20 +6289,22 @@ def script2slurm( pycode,
             continue
         f.write( line + "\n" )
 
-    # Close the new file
+    # Write the new file
+    _write_if_changed( pyjob_file, f.getvalue() )
     f.close()
 
     # Create a list to store the main part of the slurm script
     slurm_main_lst = []
-    # Add the source command to the list
-    slurm_main_lst.append( f'source $HOME/.bashrc' )
-    # Add the module commands to the list
-    slurm_main_lst.append( f'conda activate {sys.prefix}' )
+    # Add the environment setup ( .bashrc + conda activate, or the captured environment ) to the list
+    env_lines, python = _environment_lines( fast_env, printf=printf )
+    slurm_main_lst.extend( env_lines )
+    if bundle == True :
+        slurm_main_lst.extend( _bundle_lines( *build_bundle( os.path.abspath( path ), modules ) ) )
     # Add the command to run the new file to the list
     if absolute_path == True :
-        slurm_main_lst.append( f'python {path +s+ job}' )
+        slurm_main_lst.append( f'{python} {path +s+ job}' )
     else :
-        slurm_main_lst.append( f'python {job}' )
+        slurm_main_lst.append( f'{python} {job}' )
     # Create a string to store the main part of the slurm script
     slurm_main_str = ""
     # For each line in the list
@@ -728,62 +6321,684 @@ def script2slurm( pycode,
         # Print the content of the new file
         print_file( path +s+ job )
 
+    # Create the slurm script file
+    _ = create_sbatch_file( path=path, 
+                            filename=filename, 
+                            job=slurm_main_str, 
+                            printf=printf,
+                            nodes=nodes, 
+                            ntasks=ntasks, 
+                            ncpus=ncpus, 
+                            mem=mem, 
+                            time=time, 
+                            out=out, 
+                            err=err, 
+                            account=account,
+                            partition=partition,
+                            mail_type=mail_type,
+                            mail_user=mail_user,
+                            other_lines=other_lines,
+                            stage_in=stage_in,
+                            stage_out=stage_out,
+                            stage_workers=stage_workers,
+                            keep_logs=keep_logs,
+                            log_mode=log_mode )
+
     # Check if you are in the Cineca system
     if is_cineca_system() :
-
-        # Create the slurm script file
-        _ = create_sbatch_file( path=path, 
-                                filename=filename, 
-                                job=slurm_main_str, 
-                                printf=printf,
-                                nodes=nodes, 
-                                ntasks=ntasks, 
-                                ncpus=ncpus, 
-                                mem=mem, 
-                                time=time, 
-                                out=out, 
-                                err=err, 
-                                account=account,
-                                partition=partition,
-                                mail_type=mail_type,
-                                mail_user=mail_user,
-                                other_lines=other_lines )
-
         # If you are in the Cineca system, create the command to submit the slurm script
         cmd = f"sbatch {path+os.sep+filename} &> log &"
     
     # If you are not in the Cineca system (e.g., you are testing the script locally)
     else :
-        # Check how many cpus are available
-        n_cpus = os.cpu_count()
-
-        # If the number of cpus is greater than 1
-        if n_cpus > 1:
-            # Wait until at least one CPU is free
-            while True:
-                cpu_usage = psutil.cpu_percent(interval=1, percpu=True)
-                if any( usage < 100 for usage in cpu_usage ):
-                    break
-                time.sleep(1)  # Wait for 1 second before checking again
-
-            # Write command line that : 
-            # 1) ensure conda is properly initialized 
-            # 2) activate the proper environment 
-            # 3) run the python job
-            conda_init = "source $(conda info --base)/etc/profile.d/conda.sh"
-            cmd = f"bash -c '{conda_init} && conda activate {sys.prefix} && python {path+os.sep+job}' &"
-            print( f"\n\t{cmd}" )
-
-    with open( path +s+ readme_file_name, "w") as f :
-        f.write( "# Youcan run the job by executing the following command:\n" )
-        f.write( f"{cmd}" )
+        # The same script is run by the local executor, 
+        # which emulates SLURM on the available cores ( see 'run_local' )
+        cmd = f"cd {path} && bash {filename} &> log &"
+
+    _write_if_changed( path +s+ readme_file_name, 
+                       "# Youcan run the job by executing the following command:\n" + f"{cmd}" )
+
+    # Record the inputs of this generation
+    if incremental == True :
+        _record_job( path, inputs, [ path+s+filename, path+s+job, cmd ] )
 
     # If run is True
+    handle = None
     if run == True :
-        # Submit the slurm script
-        os.system( cmd )
+        if is_cineca_system() :
+            # Submit the slurm script
+            handle = submit( path +s+ filename )
+        else :
+            # Run the slurm script with the local executor (it returns immediately)
+            handle = run_local( path +s+ filename )
+
+    if return_job == True :
+        return path+s+filename, path+s+job, cmd, handle
 
     # Return the path of the slurm script, the path of the new file, 
     # and the command to submit the slurm script
     return path+s+filename, path+s+job, cmd
 
+
+# -----------------------------------------------------------------------------
+def _pack_nodes( demands, node_cpus, node_mem ) :
+    """
+    Pack items with CPU and memory demands onto as few nodes as possible, using the 
+    first-fit decreasing heuristic: the items are sorted by decreasing demand ( the largest 
+    fraction of a node they need ) and each one is placed on the first node where it fits.
+
+    Args:
+        - demands (list): The ( cpus, mem ) of each item.
+        - node_cpus (int): The CPUs of a node.
+        - node_mem (float): The memory of a node in MB.
+
+    Returns:
+        list: The indices of the items placed on each node.
+    """
+
+    for i, ( cpus, mem ) in enumerate( demands ) :
+        if cpus > node_cpus or mem > node_mem :
+            raise ValueError( f"Item {i} needs {cpus} CPUs and {mem} MB, more than a node "
+                              f"( {node_cpus} CPUs, {node_mem} MB )." )
+
+    order = sorted( range( len( demands ) ), 
+                    key=lambda i : max( demands[ i ][0] / node_cpus, demands[ i ][1] / node_mem ), 
+                    reverse=True )
+    nodes = []
+    free = []
+    for i in order :
+        cpus, mem = demands[ i ]
+        for k, ( fc, fm ) in enumerate( free ) :
+            if cpus <= fc and mem <= fm :
+                break
+        else :
+            k = len( nodes )
+            nodes.append( [] )
+            free.append( ( node_cpus, node_mem ) )
+        nodes[ k ].append( i )
+        free[ k ] = ( free[ k ][0] - cpus, free[ k ][1] - mem )
+
+    return nodes
+
+# -----------------------------------------------------------------------------
+def pack_scripts( scripts, 
+                  path, 
+                  node_cpus=48, 
+                  node_mem=375000, 
+                  run=False, 
+                  printf=False, 
+                  filename="run_pack.bat", 
+                  time="1:00:00", 
+                  account="OGS23_PRACE_IT", 
+                  partition="g100_usr_prod", 
+                  mail_type="ALL", 
+                  mail_user="lzampa@ogs.it", 
+                  other_lines='', 
+                  return_job=False, 
+                  fast_env=False ) :
+    """
+    Run many small independent scripts in a single allocation, instead of a job each.
+
+    Each script is generated with 'script2slurm' in its own subdirectory 'path/<name>', 
+    and the scripts are bin-packed by CPUs and memory onto as few nodes as possible 
+    (see '_pack_nodes'). A single sbatch file allocates these nodes, sets up the environment 
+    once and runs all the scripts concurrently, each as a job step limited to its own CPUs 
+    and memory ( 'srun --exact' ) on the node it was packed on. Each script writes its output 
+    to 'path/<name>/logs' and its exit code to 'path/<name>/exit_code' (see 'pack_status'); 
+    the job fails if any of them fails. The sbatch file of each subdirectory, with the resources 
+    of its script, can be used to rerun that script alone.
+
+    Args:
+        - scripts (list): The scripts, each one either the python code ( or file ) or a dict with the keys 
+          "pycode", and optionally "name" ( the subdirectory, defaults to "script_<i>" or the file name ), 
+          "ncpus" ( defaults to 1 ), "mem" ( MB or a SLURM memory specification, defaults to 4000 ), 
+          "modules" and "alias" (see 'script2slurm').
+        - path (str): The directory where the generated files will be saved.
+        - node_cpus (int, optional): The CPUs of a node. Defaults to 48.
+        - node_mem (int, optional): The memory of a node in MB. Defaults to 375000.
+        - run (bool, optional): Whether to submit the job (or to run it with 'run_local' outside Cineca). Defaults to False.
+        - printf (bool, optional): Whether to print the packing and the sbatch file. Defaults to False.
+        - filename (str, optional): The name of the sbatch file. Defaults to "run_pack.bat".
+        - time (str, optional): The time limit of the job, i.e. of the longest script. Defaults to "1:00:00".
+        - account, partition, mail_type, mail_user, other_lines : See 'create_sbatch_file'.
+        - return_job (bool, optional): Whether to also return the handle of the submitted job. Defaults to False.
+        - fast_env (bool, optional): Whether to export the environment captured at generation time
+          (see 'capture_environment'). Defaults to False.
+
+    Returns:
+        - A tuple containing the path of the sbatch file, the paths of the python files of the scripts, 
+          and the SLURM command to run the job.
+          If 'return_job' is True, the handle of the submitted job is appended.
+    """
+
+    os.makedirs( path, exist_ok=True )
+
+    # Generate each script in its own directory
+    names = []
+    demands = []
+    pyfiles = []
+    for i, script in enumerate( scripts ) :
+        if not isinstance( script, dict ) :
+            script = { "pycode": script }
+        pycode = script[ "pycode" ]
+        default_name = os.path.splitext( os.path.basename( pycode ) )[0] if os.path.isfile( pycode ) else f"script_{i}"
+        # The code of the script files
+        pycode = _read_source( pycode )
+        name = script.get( "name", default_name )
+        if name in names :
+            raise ValueError( f"Two scripts are named '{name}'." )
+        names.append( name )
+        demands.append( ( int( script.get( "ncpus", 1 ) ), _slurm_mem( script.get( "mem", 4000 ) ) ) )
+        _, pyfile, _ = script2slurm( pycode, 
+                                     path +s+ name, 
+                                     modules=script.get( "modules", [] ), 
+                                     alias=script.get( "alias", [] ), 
+                                     ncpus=demands[-1][0], 
+                                     mem=int( demands[-1][1] ), 
+                                     time=time, 
+                                     account=account, 
+                                     partition=partition, 
+                                     mail_type=mail_type, 
+                                     mail_user=mail_user, 
+                                     other_lines=other_lines )
+        pyfiles.append( pyfile )
+        os.makedirs( path +s+ name +s+ "logs", exist_ok=True )
+
+    # Pack the scripts onto the nodes
+    nodes = _pack_nodes( demands, node_cpus, node_mem )
+    with open( path +s+ "pack.json", "w" ) as fj :
+        json.dump( { "scripts": names, "nodes": [ [ names[ i ] for i in items ] for items in nodes ] }, fj, indent=1 )
+    if printf == True :
+        for k, items in enumerate( nodes ) :
+            print( f"node {k} : {sum( demands[ i ][0] for i in items )} CPUs, "
+                   f"{sum( demands[ i ][1] for i in items ):.0f} MB : " + 
+                   " ".join( names[ i ] for i in items ) )
+
+    env_lines, python = _environment_lines( fast_env, printf=printf )
+    lines = env_lines + [ 
+        "# The nodes of the allocation",
+        "_cp_nodes=( $(scontrol show hostnames \"$SLURM_JOB_NODELIST\" 2> /dev/null || hostname -s) )",
+        "rm -f pack.status",
+        "# Run a script as a job step limited to its CPUs and memory: _cp_step name node cpus mem file",
+        "_cp_step() {",
+        "    rm -f $1/exit_code",
+        "    if command -v srun > /dev/null ; then",
+        f"        srun --exact --nodes=1 --ntasks=1 --nodelist=$2 --cpus-per-task=$3 --mem=$4 --chdir=$1 "
+        f"--output=$PWD/$1/logs/job.out --error=$PWD/$1/logs/job.err {python} $5",
+        "    else",
+        f"        ( cd $1 && {python} $5 > logs/job.out 2> logs/job.err )",
+        "    fi",
+        "    _cp_rc=$?",
+        "    echo $_cp_rc > $1/exit_code",
+        "    echo \"$1 $_cp_rc\" >> pack.status",
+        "}" ]
+    for k, items in enumerate( nodes ) :
+        for i in items :
+            lines.append( f"_cp_step {shlex.quote( names[ i ] )} \"${{_cp_nodes[{k}]}}\" "
+                          f"{demands[ i ][0]} {int( np.ceil( demands[ i ][1] ) )} "
+                          f"{shlex.quote( os.path.basename( pyfiles[ i ] ) )} &" )
+    lines = lines + [ "wait",
+                      "# The job fails if any script failed",
+                      "awk '$2 != 0 { bad = 1 } END { exit bad }' pack.status" ]
+
+    # A single job allocating the packed nodes
+    _ = create_sbatch_file( path=path, 
+                            filename=filename, 
+                            job="\n".join( lines ) + "\n", 
+                            printf=printf, 
+                            nodes=len( nodes ), 
+                            ntasks=len( nodes ) * node_cpus, 
+                            ncpus=1, 
+                            mem=int( max( 1, max( [ sum( demands[ i ][1] for i in items ) for items in nodes ] + [ 0 ] ) ) ), 
+                            time=time, 
+                            out="logs/pack.%j.out", 
+                            err="logs/pack.%j.err", 
+                            account=account, 
+                            partition=partition, 
+                            mail_type=mail_type, 
+                            mail_user=mail_user, 
+                            other_lines=other_lines )
+
+    cmd = f"sbatch {path+os.sep+filename} &> log &"
+
+    handle = None
+    if run == True :
+        if is_cineca_system() :
+            handle = submit( path +s+ filename )
+        else :
+            # Outside SLURM, the steps run as background processes
+            handle = run_local( path +s+ filename )
+
+    if return_job == True :
+        return path+s+filename, pyfiles, cmd, handle
+
+    return path+s+filename, pyfiles, cmd
+
+# -----------------------------------------------------------------------------
+def pack_status( path ) :
+    """
+    Read the exit codes of the scripts of a job generated with 'pack_scripts'.
+
+    Args:
+        - path (str): The job directory.
+
+    Returns:
+        dict: The exit code of each script ( None if it has not ended ).
+    """
+
+    with open( path +s+ "pack.json", "r" ) as fj :
+        names = json.load( fj )[ "scripts" ]
+
+    status = {}
+    for name in names :
+        try :
+            with open( path +s+ name +s+ "exit_code", "r" ) as fe :
+                status[ name ] = int( fe.read().strip() )
+        except ( OSError, ValueError ) :
+            status[ name ] = None
+
+    return status
+
+# -----------------------------------------------------------------------------
+def _by_value( obj ) :
+    """
+    Whether a function or a class cannot be pickled by reference, being defined 
+    in '__main__' ( or a notebook ) or inside another function.
+    """
+
+    return getattr( obj, "__module__", None ) == "__main__" or "<locals>" in getattr( obj, "__qualname__", "" )
+
+# -----------------------------------------------------------------------------
+def _encode_value( value, func, seen ) :
+    """
+    Encode a global or a closure variable of a function serialized with '_function_state':
+    modules by name, the functions and classes defined in '__main__' or in other functions 
+    ( and the instances of these classes ) by their state, other values as they are.
+    The functions and classes met again ( e.g. recursive ones ) are encoded by reference.
+    """
+
+    if isinstance( value, types.ModuleType ) :
+        return ( "module", value.__name__ )
+    if value is func :
+        return ( "self", None )
+    if isinstance( value, ( types.FunctionType, type ) ) and id( value ) in seen :
+        return ( "ref", id( value ) )
+    if isinstance( value, types.FunctionType ) :
+        if not _by_value( value ) :
+            try :
+                # Functions importable by reference
+                pickle.dumps( value )
+                return ( "value", value )
+            except ( pickle.PicklingError, AttributeError, TypeError ) :
+                pass
+        return ( "function", _function_state( value, seen ) )
+    if isinstance( value, type ) and _by_value( value ) :
+        return ( "class", _class_state( value, seen ) )
+    if isinstance( value, ( staticmethod, classmethod ) ) :
+        return ( type( value ).__name__, _encode_value( value.__func__, func, seen ) )
+    if _by_value( type( value ) ) and hasattr( value, "__dict__" ) :
+        return ( "instance", ( _encode_value( type( value ), func, seen ), 
+                               { k: _encode_value( v, func, seen ) for k, v in vars( value ).items() } ) )
+
+    return ( "value", value )
+
+# -----------------------------------------------------------------------------
+def _class_state( cls, seen ) :
+    """
+    Return a picklable description of a class defined in '__main__' or in a function:
+    its name, bases and attributes (see '_encode_value').
+    """
+
+    seen.add( id( cls ) )
+    skip = ( "__dict__", "__weakref__", "__module__", "__qualname__" )
+
+    return { "id": id( cls ), 
+             "name": cls.__name__, 
+             "bases": [ _encode_value( base, None, seen ) for base in cls.__bases__ ], 
+             "attributes": { k: _encode_value( v, None, seen ) for k, v in vars( cls ).items() if k not in skip } }
+
+# -----------------------------------------------------------------------------
+def _function_state( func, seen=None ) :
+    """
+    Return a picklable description of a function, also defined in '__main__', 
+    in a notebook or in another function ( a closure ): its code ( marshalled, so 
+    it can be loaded only by the same python version ), defaults, closure variables 
+    and the globals it reads (see '_function_from_state').
+
+    Args:
+        - func (function): The function.
+
+    Returns:
+        dict: The description.
+    """
+
+    seen = set() if seen is None else seen
+    seen.add( id( func ) )
+
+    # The global names read by the function and by the functions it defines
+    names = set()
+    codes = [ func.__code__ ]
+    while codes != [] :
+        code = codes.pop()
+        names = names | set( code.co_names )
+        codes.extend( c for c in code.co_consts if isinstance( c, types.CodeType ) )
+
+    return { "id": id( func ), 
+             "code": marshal.dumps( func.__code__ ), 
+             "name": func.__name__, 
+             "qualname": func.__qualname__, 
+             "defaults": func.__defaults__, 
+             "kwdefaults": func.__kwdefaults__, 
+             "globals": { name: _encode_value( func.__globals__[ name ], func, seen ) 
+                          for name in sorted( names ) if name in func.__globals__ }, 
+             "closure": [ _encode_value( cell.cell_contents, func, seen ) for cell in ( func.__closure__ or () ) ] }
+
+# -----------------------------------------------------------------------------
+def _decode_value( kind, value, memo ) :
+    """
+    Decode a value encoded by '_encode_value', 'memo' holding the functions and classes already rebuilt.
+    """
+
+    if kind == "module" :
+        return importlib.import_module( value )
+    if kind == "function" :
+        return _function_from_state( value, memo )
+    if kind == "ref" :
+        return memo[ value ]
+    if kind == "class" :
+        # The class is registered before its attributes are decoded, for its methods to refer to it
+        bases = tuple( _decode_value( *base, memo ) for base in value[ "bases" ] )
+        cls = type( value[ "name" ], bases, {} )
+        memo[ value[ "id" ] ] = cls
+        for k, v in value[ "attributes" ].items() :
+            setattr( cls, k, _decode_value( *v, memo ) )
+        return cls
+    if kind in ( "staticmethod", "classmethod" ) :
+        return { "staticmethod": staticmethod, "classmethod": classmethod }[ kind ]( _decode_value( *value, memo ) )
+    if kind == "instance" :
+        cls = _decode_value( *value[0], memo )
+        obj = object.__new__( cls )
+        obj.__dict__.update( { k: _decode_value( *v, memo ) for k, v in value[1].items() } )
+        return obj
+
+    return value
+
+# -----------------------------------------------------------------------------
+def _function_from_state( state, memo=None ) :
+    """
+    Rebuild a function described by '_function_state'.
+    """
+
+    memo = {} if memo is None else memo
+    scope = { "__builtins__": builtins }
+    # The function is registered before its globals and closure are decoded, for them to refer to it
+    closure = tuple( types.CellType() for _ in state[ "closure" ] )
+    func = types.FunctionType( marshal.loads( state[ "code" ] ), scope, state[ "name" ], 
+                               state[ "defaults" ], closure or None )
+    func.__kwdefaults__ = state[ "kwdefaults" ]
+    func.__qualname__ = state.get( "qualname", state[ "name" ] )
+    memo[ state.get( "id" ) ] = func
+    for cell, ( kind, value ) in zip( closure, state[ "closure" ] ) :
+        cell.cell_contents = func if kind == "self" else _decode_value( kind, value, memo )
+    for name, ( kind, value ) in state[ "globals" ].items() :
+        scope[ name ] = func if kind == "self" else _decode_value( kind, value, memo )
+
+    return func
+
+# -----------------------------------------------------------------------------
+def dump_function( file_name, func, args=(), kwargs={} ) :
+    """
+    Serialize a function with its arguments, for a task to call it (see 'load_function').
+
+    The function is serialized with cloudpickle, if it is installed, otherwise with pickle
+    if it can be imported by reference ( a function defined in a module ), otherwise by value 
+    with '_function_state', which supports the functions defined in '__main__' and closures, 
+    together with the arguments ( e.g. the instances of the classes defined in '__main__' ).
+
+    Args:
+        - file_name (str): The file.
+        - func (callable): The function.
+        - args (tuple, optional): The positional arguments following the first one. Defaults to ().
+        - kwargs (dict, optional): The keyword arguments. Defaults to {}.
+
+    Returns:
+        str: The serialization used ( "cloudpickle", "pickle" or "marshal" ).
+    """
+
+    try :
+        import cloudpickle
+        payload = cloudpickle.dumps( ( func, tuple( args ), dict( kwargs ) ), protocol=pickle.HIGHEST_PROTOCOL )
+        kind = "cloudpickle"
+    except ImportError :
+        try :
+            # The arguments too ( e.g. instances of classes defined in '__main__' )
+            if any( _by_value( v ) or _by_value( type( v ) ) for v in [ func ] + list( args ) + list( kwargs.values() ) ) :
+                raise pickle.PicklingError( "The function must be serialized by value." )
+            payload = pickle.dumps( ( func, tuple( args ), dict( kwargs ) ), protocol=pickle.HIGHEST_PROTOCOL )
+            kind = "pickle"
+        except ( pickle.PicklingError, AttributeError, TypeError ) :
+            seen = set()
+            state = _function_state( func, seen )
+            payload = pickle.dumps( ( state, 
+                                      [ _encode_value( v, None, seen ) for v in args ], 
+                                      { k: _encode_value( v, None, seen ) for k, v in kwargs.items() } ), 
+                                    protocol=pickle.HIGHEST_PROTOCOL )
+            kind = "marshal"
+
+    with open( file_name, "wb" ) as ff :
+        pickle.dump( { "kind": kind, "python": sys.version_info[ :2 ], "payload": payload }, ff )
+
+    return kind
+
+# -----------------------------------------------------------------------------
+def load_function( file_name ) :
+    """
+    Load a function and its arguments serialized with 'dump_function'.
+
+    Args:
+        - file_name (str): The file.
+
+    Returns:
+        tuple: The function, its positional arguments and its keyword arguments.
+    """
+
+    with open( file_name, "rb" ) as ff :
+        header = pickle.load( ff )
+
+    func, args, kwargs = pickle.loads( header[ "payload" ] )
+    if header[ "kind" ] == "marshal" :
+        if tuple( header[ "python" ] ) != sys.version_info[ :2 ] :
+            raise RuntimeError( f"The function was serialized by python {header[ 'python' ]}, "
+                                f"it cannot be loaded by python {sys.version_info[ :2 ]}." )
+        memo = {}
+        func = _function_from_state( func, memo )
+        args = tuple( _decode_value( *v, memo ) for v in args )
+        kwargs = { k: _decode_value( *v, memo ) for k, v in kwargs.items() }
+
+    return func, args, kwargs
+
+# -----------------------------------------------------------------------------
+def run_parmap_task( path, imin, imax, itask ) :
+    """
+    Run a task of a parmap job (see 'parmap'): call the function on the batches 
+    of the items [ imin, imax ) and write the results of the task to its shard.
+
+    Args:
+        - path (str): The job directory.
+        - imin (int): The first item of the task.
+        - imax (int): The end of the items of the task ( excluded ).
+        - itask (int): The task ID.
+    """
+
+    with open( path +s+ "parmap.json", "r" ) as fj :
+        spec = json.load( fj )
+    for folder in spec[ "sys_path" ] :
+        if folder not in sys.path :
+            sys.path.append( folder )
+    func, args, kwargs = load_function( path +s+ "function.pkl" )
+    items = load_manifest( path +s+ "manifest" )
+    imax = min( imax, len( items ) )
+
+    writer = None
+    batch_size = spec[ "batch_size" ]
+    for a in range( imin, imax, batch_size ) :
+        b = min( a + batch_size, imax )
+        batch = np.array( items[ a:b ] ) if isinstance( items, np.ndarray ) else list( items[ a:b ] )
+        if spec[ "vectorized" ] :
+            values = func( batch, *args, **kwargs )
+        else :
+            values = [ func( item, *args, **kwargs ) for item in batch ]
+        # A function returning nothing has no results
+        if values is None or ( not spec[ "vectorized" ] and all( v is None for v in values ) ) :
+            continue
+        if len( values ) != b - a :
+            raise ValueError( f"The function returned {len( values )} results for a batch of {b - a} items." )
+        if writer is None :
+            writer = ShardWriter( path +s+ "results", itask )
+        for i, value in zip( range( a, b ), values ) :
+            writer.write( i, value )
+
+    if writer is not None :
+        writer.close()
+
+# -----------------------------------------------------------------------------
+def parmap( func, 
+            iterable, 
+            path, 
+            batch_size=1000, 
+            vectorized=True, 
+            args=(), 
+            kwargs={}, 
+            chunks=None, 
+            chunk_size=None, 
+            run=False, 
+            printf=False, 
+            filename="run_parmap.bat", 
+            nodes=1, 
+            ntasks=1, 
+            ncpus=1, 
+            mem=50000, 
+            time="1:00:00", 
+            out="logs/job.%a.out", 
+            err="logs/job.%a.err", 
+            account="OGS23_PRACE_IT", 
+            partition="g100_usr_prod", 
+            mail_type="ALL", 
+            mail_user="lzampa@ogs.it", 
+            other_lines='', 
+            return_job=False, 
+            fast_env=False ) :
+    """
+    Map a function over the items of an iterable with a SLURM job array, without rewriting any source code.
+
+    The function and its arguments are serialized (see 'dump_function'), the items are stored 
+    in a manifest (see 'write_manifest'), and every task runs the same fixed runner script, 
+    which calls the function on batches of 'batch_size' consecutive items of its chunk 
+    (see 'run_parmap_task'). With 'vectorized', the function receives the whole batch 
+    ( a numpy array, if the items are numeric, otherwise a list ) and returns one result per item, 
+    so that vectorized kernels process many items per call; otherwise it is called on each item. 
+    The results are collected with 'gather( path )' ( nothing is written if the function returns None ).
+
+    Args:
+        - func (callable): The function, called as 'func( batch, *args, **kwargs )' 
+          ( 'func( item, *args, **kwargs )' if not 'vectorized' ).
+        - iterable (iterable or int): The items. An integer n maps the function over the indices 0, ..., n-1.
+        - path (str): The directory where the generated files will be saved.
+        - batch_size (int, optional): The number of items of each call. Defaults to 1000.
+        - vectorized (bool, optional): Whether the function is called on whole batches. Defaults to True.
+        - args (tuple, optional): The other positional arguments of the function. Defaults to ().
+        - kwargs (dict, optional): The keyword arguments of the function. Defaults to {}.
+        - chunks (int, optional): The number of tasks. Defaults to None.
+        - chunk_size (int, optional): The number of items of each task ( it overrides 'chunks' ). 
+          Defaults to None.
+        - run (bool, optional): Whether to submit the job (or to run it with 'run_local' outside Cineca). Defaults to False.
+        - printf (bool, optional): Whether to print the sbatch file. Defaults to False.
+        - filename (str, optional): The name of the sbatch file. Defaults to "run_parmap.bat".
+        - nodes, ntasks, ncpus, mem, time, out, err, account, partition, mail_type, mail_user, other_lines : 
+          See 'create_sbatch_file'.
+        - return_job (bool, optional): Whether to also return the handle of the submitted job. Defaults to False.
+        - fast_env (bool, optional): Whether to export the environment captured at generation time
+          (see 'capture_environment'). Defaults to False.
+
+    Returns:
+        - A tuple containing the path of the sbatch file, the path of the runner script 
+          and the SLURM command to run the job.
+          If 'return_job' is True, the handle of the submitted job is appended.
+    """
+
+    os.makedirs( path, exist_ok=True )
+
+    # The items, and the function with its arguments
+    if isinstance( iterable, ( int, np.integer ) ) :
+        iterable = np.arange( iterable )
+    n = write_manifest( path +s+ "manifest", iterable )
+    kind = dump_function( path +s+ "function.pkl", func, args, kwargs )
+
+    if chunk_size is None :
+        if chunks is None or chunks < 1 :
+            raise ValueError( "Either 'chunks' or 'chunk_size' must be given." )
+        chunk_size = int( np.ceil( n / chunks ) )
+    chunks = int( np.ceil( n / chunk_size ) )
+
+    # The directory of the function, for the modules next to it
+    source_file = getattr( getattr( func, "__code__", None ), "co_filename", "" )
+    sys_path = [ os.path.dirname( os.path.abspath( source_file ) ) ] if os.path.isfile( source_file ) else []
+    with open( path +s+ "parmap.json", "w" ) as fj :
+        json.dump( { "n": int( n ), "chunks": chunks, "chunk_size": int( chunk_size ), 
+                     "batch_size": int( batch_size ), "vectorized": vectorized == True, 
+                     "serializer": kind, "sys_path": sys_path }, fj, indent=1 )
+    # The results of a previous generation are not mixed with the new ones
+    _clear_results( path )
+    os.makedirs( path +s+ "results", exist_ok=True )
+    with open( path +s+ "results" +s+ "results.json", "w" ) as fj :
+        json.dump( { "n": int( n ) }, fj )
+
+    # The runner, the same for every job
+    runner = "parmap_runner.py"
+    lines = [ "import argparse", "import os", "import sys" ] + _runtime_import_lines() + [ 
+              "", 
+              "if __name__ == '__main__' :", 
+              "    p = argparse.ArgumentParser()", 
+              "    p.add_argument('-imin', '--imin', type=int)", 
+              "    p.add_argument('-imax', '--imax', type=int)", 
+              "    p.add_argument('-itask', '--itask', type=int)", 
+              "    arg = p.parse_args()", 
+              "    _cp.run_parmap_task( os.path.dirname( os.path.abspath( __file__ ) ), arg.imin, arg.imax, arg.itask )" ]
+    _write_if_changed( path +s+ runner, "\n".join( lines ) + "\n" )
+
+    env_lines, python = _environment_lines( fast_env, printf=printf )
+    job = "\n".join( [ "n=$SLURM_ARRAY_TASK_ID", 
+                       f"((imin=(n-1)*{chunk_size}))", 
+                       f"((imax=n*{chunk_size}))" ] + env_lines + 
+                     [ f"{python} {runner} -imin $imin -imax $imax -itask $n" ] ) + "\n"
+    _ = create_sbatch_file( path=path, 
+                            filename=filename, 
+                            job=job, 
+                            printf=printf, 
+                            nodes=nodes, 
+                            ntasks=ntasks, 
+                            ncpus=ncpus, 
+                            mem=mem, 
+                            time=time, 
+                            out=out, 
+                            err=err, 
+                            account=account, 
+                            partition=partition, 
+                            mail_type=mail_type, 
+                            mail_user=mail_user, 
+                            other_lines=other_lines )
+
+    cmd = f"sbatch --array=1-{chunks} {path+os.sep+filename} &> log &"
+
+    handle = None
+    if run == True :
+        if is_cineca_system() :
+            handle = submit( path +s+ filename, array=f"1-{chunks}" )
+        else :
+            # Outside SLURM, run the job array with the local executor
+            handle = run_local( path +s+ filename, array=f"1-{chunks}" )
+
+    if return_job == True :
+        return path+s+filename, path+s+runner, cmd, handle
+
+    return path+s+filename, path+s+runner, cmd
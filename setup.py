@@ -26,5 +26,5 @@ setup(
   ],
   keywords='SLURM, HPC, Cineca, job scheduling, sbatch, parallel computing',
   packages=find_packages(),
-  python_requires='>=3.6',
+  python_requires='>=3.8',
 )
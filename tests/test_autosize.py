@@ -0,0 +1,30 @@
+import json
+import os
+
+import numpy as np
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_autosize_plans_the_tasks_from_a_sample( tmp_path ) :
+
+    after = str( tmp_path / "after_loop" )
+    code = ( "import time\n"
+             "for i in range( 100 ) :\n"
+             "    time.sleep( 0.05 )\n"
+             f"open( {after!r}, 'w' ).close()\n" )
+    path = str( tmp_path / "job" )
+    sbatch = cp.parfor( code, path, autosize=True, target_time=3.0, autosize_sample=4, autosize_margin=1.5 )[0]
+
+    with open( path + os.sep + "autosize" + os.sep + "plan.json" ) as fj :
+        plan = json.load( fj )
+    assert len( np.load( path + os.sep + "autosize" + os.sep + "indices.npy" ) ) == 4
+    assert 0.04 < plan[ "seconds_per_iteration" ] < 0.5
+    # The tasks fill the target time
+    assert plan[ "chunk_size" ] * plan[ "seconds_per_iteration" ] <= 3.0
+    assert plan[ "chunks" ] == -( -100 // plan[ "chunk_size" ] )
+    assert plan[ "mem" ] >= plan[ "peak_rss_mb" ]
+    script = open( sbatch ).read()
+    assert f"--time {plan[ 'time' ]}" in script and f"--mem={plan[ 'mem' ]}" in script
+    # The code following the loop is not profiled
+    assert not os.path.exists( after )
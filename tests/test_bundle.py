@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+import tarfile
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def make_module( tmp_path, monkeypatch ) :
+
+    source = tmp_path / "src"
+    source.mkdir()
+    ( source / "cp_test_module.py" ).write_text( "VALUE = 5\n" )
+    monkeypatch.syspath_prepend( str( source ) )
+
+    return source
+
+# -----------------------------------------------------------------------------
+def test_bundle_content_and_reuse( tmp_path, monkeypatch ) :
+
+    make_module( tmp_path, monkeypatch )
+    bundle, digest = cp.build_bundle( str( tmp_path / "a" ), modules=[ "cp_test_module" ] )
+
+    with tarfile.open( bundle ) as tar :
+        names = tar.getnames()
+        assert all( member.mtime == 0 and member.uid == 0 for member in tar.getmembers() )
+    assert "cp_test_module.py" in names and "CinecaPy/cineca.py" in names
+    assert any( name.startswith( "__pycache__/cp_test_module." ) for name in names )
+
+    # The unchanged sources reuse the bundle, and the same content gives the same hash
+    mtime = os.stat( bundle ).st_mtime_ns
+    assert cp.build_bundle( str( tmp_path / "a" ), modules=[ "cp_test_module" ] ) == ( bundle, digest )
+    assert os.stat( bundle ).st_mtime_ns == mtime
+    assert cp.build_bundle( str( tmp_path / "b" ), modules=[ "cp_test_module" ] )[1] == digest
+
+# -----------------------------------------------------------------------------
+def test_changed_sources_rebuild_the_bundle( tmp_path, monkeypatch ) :
+
+    source = make_module( tmp_path, monkeypatch )
+    _, digest = cp.build_bundle( str( tmp_path / "a" ), modules=[ "cp_test_module" ] )
+    ( source / "cp_test_module.py" ).write_text( "VALUE = 6\n" )
+
+    assert cp.build_bundle( str( tmp_path / "a" ), modules=[ "cp_test_module" ] )[1] != digest
+
+# -----------------------------------------------------------------------------
+def test_bundle_is_extracted_once_and_imported_first( tmp_path, monkeypatch ) :
+
+    make_module( tmp_path, monkeypatch )
+    # Paths with spaces, both for the bundle and the node-local storage
+    bundle, digest = cp.build_bundle( str( tmp_path / "job dir" ), modules=[ "cp_test_module" ] )
+    local = tmp_path / "local tmp"
+    script = "\n".join( cp._bundle_lines( bundle, digest ) + 
+                        [ f"{sys.executable} -c 'import cp_test_module ; print( cp_test_module.__file__ )'" ] )
+
+    for _ in range( 2 ) :
+        proc = subprocess.run( [ "bash", "-c", script ], env={ "TMPDIR": str( local ), "PATH": os.environ[ "PATH" ] },
+                               capture_output=True, text=True )
+        assert proc.returncode == 0, proc.stderr
+        assert proc.stdout.strip() == str( local / f"cp_bundle_{digest}" / "cp_test_module.py" )
+    assert ( local / f"cp_bundle_{digest}" / ".ready" ).exists()
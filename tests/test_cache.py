@@ -0,0 +1,84 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_result_cache_put_get_and_evict( tmp_path ) :
+
+    cache = cp.ResultCache( str( tmp_path ) )
+    for k in range( 3 ) :
+        cache.put( f"{k:040x}", np.zeros( 100000 ) + k )
+        time.sleep( 0.01 )
+    # Reading a result makes it the most recently used
+    assert cache.get( f"{0:040x}" )[0] == 0
+
+    assert cache.evict( 1.6 ) == 1
+    assert f"{0:040x}" in cache and f"{1:040x}" not in cache and f"{2:040x}" in cache
+
+# -----------------------------------------------------------------------------
+def keys( source, items, result="r" ) :
+
+    tree, for_node, _ = cp._find_loop( source )
+    return cp._cache_keys( source, tree, for_node, items, result=result )
+
+# -----------------------------------------------------------------------------
+def test_keys_depend_on_the_body_the_values_read_and_the_items() :
+
+    base = keys( "import numpy as np\nscale = 2\nfor i in I :\n    r = np.sin( i ) * scale\n", [ 1, 2 ] )
+
+    assert base[0] != base[1]
+    # Unread variables and comments of the prelude do not matter
+    assert keys( "import numpy as np\nscale = 2\nother = 5\nfor i in I :\n    r = np.sin( i ) * scale\n", [ 1, 2 ] ) == base
+    # The values read, the body, the items and the result expression do
+    assert keys( "import numpy as np\nscale = 3\nfor i in I :\n    r = np.sin( i ) * scale\n", [ 1, 2 ] ) != base
+    assert keys( "import numpy as np\nscale = 2\nfor i in I :\n    r = np.cos( i ) * scale\n", [ 1, 2 ] ) != base
+    assert keys( "import numpy as np\nscale = 2\nfor i in I :\n    r = np.sin( i ) * scale\n", [ 1.0, 2 ] )[0] != base[0]
+    assert keys( "import numpy as np\nscale = 2\nfor i in I :\n    r = np.sin( i ) * scale\n", [ 1, 2 ], 
+                 result="r + 1" ) != base
+
+# -----------------------------------------------------------------------------
+def test_keys_follow_the_functions_called() :
+
+    body = "for i in I :\n    r = f( i )\n"
+    first = keys( "k = 1\ndef f( x ) :\n    return x + k\n" + body, [ 1 ] )
+
+    assert keys( "k = 2\ndef f( x ) :\n    return x + k\n" + body, [ 1 ] ) != first
+    assert keys( "k = 1\ndef f( x ) :\n    return x - k\n" + body, [ 1 ] ) != first
+
+# -----------------------------------------------------------------------------
+def test_unhashable_values_are_rejected() :
+
+    with pytest.raises( ValueError, match="cannot be cached" ) :
+        keys( "import threading\nlock = threading.Lock()\nfor i in I :\n    r = ( i, lock )\n", [ 1 ] )
+
+# -----------------------------------------------------------------------------
+def test_parfor_runs_only_the_uncached_iterations( tmp_path ) :
+
+    runs = str( tmp_path / "runs" )
+    cache = str( tmp_path / "cache" )
+
+    def job( n, name ) :
+        code = f"for i in range( {n} ) :\n    open( {runs!r}, 'a' ).write( 'x' )\n    r = i * 10\n"
+        path = str( tmp_path / name )
+        generated = cp.parfor( code, path, chunk_size=3, result="r", cache=cache, run=True, return_job=True )
+        for task in generated[-1] or [] :
+            task.wait()
+        return path, generated
+
+    path, _ = job( 6, "first" )
+    np.testing.assert_array_equal( cp.gather( path ), np.arange( 6 ) * 10 )
+    assert len( open( runs ).read() ) == 6
+
+    path, _ = job( 8, "second" )
+    np.testing.assert_array_equal( cp.gather( path ), np.arange( 8 ) * 10 )
+    assert len( open( runs ).read() ) == 8
+
+    # All the iterations are cached: nothing is run
+    path, generated = job( 8, "third" )
+    assert generated[2] is None
+    np.testing.assert_array_equal( cp.gather( path ), np.arange( 8 ) * 10 )
+    assert len( open( runs ).read() ) == 8
@@ -0,0 +1,86 @@
+import multiprocessing
+import os
+
+import numpy as np
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_bitmap_round_trip( tmp_path ) :
+
+    path = str( tmp_path )
+    cp.create_checkpoint( path, 13 )
+    assert os.path.getsize( path + os.sep + "done.bitmap" ) == 2
+
+    checkpoint = cp.Checkpoint( path, interval=1e9 )
+    checkpoint.mark_many( [ 0, 7, 8 ] )
+    checkpoint.mark( 12 )
+    # Nothing is written before the interval or the flush
+    assert not cp.read_checkpoint( path, 13 ).any()
+    checkpoint.close()
+
+    assert np.flatnonzero( cp.read_checkpoint( path, 13 ) ).tolist() == [ 0, 7, 8, 12 ]
+    assert checkpoint.is_done( 7 ) and not checkpoint.is_done( 1 )
+
+# -----------------------------------------------------------------------------
+def test_track_skips_and_marks_iterations( tmp_path ) :
+
+    path = str( tmp_path )
+    cp.create_checkpoint( path, 6 )
+    first = cp.Checkpoint( path )
+    first.mark_many( [ 1, 4 ] )
+    first.flush()
+
+    checkpoint = cp.Checkpoint( path )
+    assert list( checkpoint.track( enumerate( "abcdef" ) ) ) == [ "a", "c", "d", "f" ]
+    assert cp.read_checkpoint( path, 6 ).all()
+    assert list( cp.Checkpoint( path ).todo( enumerate( "abcdef" ) ) ) == []
+
+# -----------------------------------------------------------------------------
+def _mark_every( path, start, step, n ) :
+
+    checkpoint = cp.Checkpoint( path, interval=0.0 )
+    for i in range( start, n, step ) :
+        checkpoint.mark( i )
+    checkpoint.flush()
+
+# -----------------------------------------------------------------------------
+def test_concurrent_tasks_sharing_bytes_keep_each_other_bits( tmp_path ) :
+
+    path = str( tmp_path )
+    cp.create_checkpoint( path, 400 )
+    context = multiprocessing.get_context( "fork" )
+    processes = [ context.Process( target=_mark_every, args=( path, start, 4, 400 ) ) for start in range( 4 ) ]
+    for p in processes :
+        p.start()
+    for p in processes :
+        p.join()
+
+    assert cp.read_checkpoint( path, 400 ).all()
+
+# -----------------------------------------------------------------------------
+def test_resume_runs_only_the_missing_iterations( tmp_path ) :
+
+    path = str( tmp_path / "job" )
+    flag = str( tmp_path / "fixed" )
+    code = ( "import os\n"
+             "for i in range( 12 ) :\n"
+             f"    if i == 7 and not os.path.exists( {flag!r} ) :\n"
+             "        raise RuntimeError( 'failure' )\n"
+             "    r = i * i\n" )
+    *_, tasks = cp.parfor( code, path, chunks=3, result="r", checkpoint=True, run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    assert [ task.state for task in tasks ] == [ "COMPLETED", "FAILED", "COMPLETED" ]
+    # The results of the failed task never reached the disk, so none of its iterations is completed
+    assert np.flatnonzero( ~cp.read_checkpoint( path + os.sep + "checkpoint", 12 ) ).tolist() == [ 4, 5, 6, 7 ]
+
+    open( flag, "w" ).close()
+    command, tasks = cp.resume( path, run=True, printf=False, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    assert [ task.array_id for task in tasks ] == [ 2 ]
+    assert cp.read_checkpoint( path + os.sep + "checkpoint", 12 ).all()
+    np.testing.assert_array_equal( cp.gather( path ), np.arange( 12 ) ** 2 )
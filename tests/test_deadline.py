@@ -0,0 +1,77 @@
+import os
+import signal
+import time
+
+import numpy as np
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_expired_deadline_saves_the_unfinished_iterations( tmp_path, monkeypatch ) :
+
+    path = str( tmp_path )
+    monkeypatch.setenv( "CP_END_TIME", str( time.time() + 0.3 ) )
+    monkeypatch.setenv( "CP_GRACE", "0.1" )
+
+    deadline = cp.Deadline( path, 1, indices=range( 10 ) )
+    done = []
+    for i, item in deadline.track( ( i, i ) for i in range( 10 ) ) :
+        time.sleep( 0.05 )
+        done.append( i )
+    deadline.close()
+
+    assert deadline.stopped and 0 < len( done ) < 10
+    np.testing.assert_array_equal( np.load( tmp_path / "task_1.npy" ), range( len( done ), 10 ) )
+
+    # The next run processes only the unfinished iterations, then removes their list
+    monkeypatch.delenv( "CP_END_TIME" )
+    deadline = cp.Deadline( path, 1, indices=range( 10 ) )
+    assert [ i for i, _ in deadline.track( ( i, i ) for i in range( 10 ) ) ] == list( range( len( done ), 10 ) )
+    deadline.close()
+    assert not os.path.exists( tmp_path / "task_1.npy" )
+
+# -----------------------------------------------------------------------------
+def test_the_signal_stops_the_loop( tmp_path ) :
+
+    previous = signal.getsignal( signal.SIGUSR1 )
+    try :
+        deadline = cp.Deadline( str( tmp_path ), 2, indices=range( 5 ) )
+        done = []
+        for i, _ in deadline.track( ( i, i ) for i in range( 5 ) ) :
+            done.append( i )
+            if i == 1 :
+                os.kill( os.getpid(), signal.SIGUSR1 )
+        deadline.close()
+    finally :
+        signal.signal( signal.SIGUSR1, previous )
+
+    assert done == [ 0, 1 ]
+    np.testing.assert_array_equal( np.load( tmp_path / "task_2.npy" ), [ 2, 3, 4 ] )
+
+# -----------------------------------------------------------------------------
+def test_tasks_stopped_before_the_time_limit_are_resumed( tmp_path ) :
+
+    fast = str( tmp_path / "fast" )
+    code = ( "import os, time\n"
+             "for i in range( 20 ) :\n"
+             f"    if not os.path.exists( {fast!r} ) and i >= 2 :\n"
+             "        time.sleep( 1 )\n"
+             "    r = i * 2.0\n" )
+    path = str( tmp_path / "job" )
+    *_, tasks = cp.parfor( code, path, chunks=2, result="r", time="0:00:06", grace=2, fast_env=True,
+                           run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    # The first task was stopped in time, and its results were written
+    assert tasks[0].state == "FAILED" and tasks[0].returncode == 75
+    partial = cp.gather( path )
+    assert 2 <= np.sum( ~np.isnan( partial[ :10 ] ) ) < 10
+
+    open( fast, "w" ).close()
+    command, tasks = cp.resume( path, run=True, printf=False, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    assert [ task.state for task in tasks ] == [ "COMPLETED" ] * 2
+    np.testing.assert_array_equal( cp.gather( path ), np.arange( 20 ) * 2 )
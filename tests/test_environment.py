@@ -0,0 +1,48 @@
+import os
+import sys
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_environment_without_conda( tmp_path, monkeypatch ) :
+
+    # A prefix that conda cannot activate
+    prefix = str( tmp_path / "env" )
+    monkeypatch.setenv( "HOME", str( tmp_path ) )
+    monkeypatch.setattr( cp, "_environments", {} )
+    captured = cp.capture_environment( prefix )
+
+    assert captured[ "env" ][ "PATH" ].startswith( prefix + os.sep + "bin" + os.pathsep )
+    assert captured[ "python" ] == sys.executable
+    # The environment is captured once per prefix
+    assert cp.capture_environment( prefix ) is captured
+
+# -----------------------------------------------------------------------------
+def test_environment_lines_export_the_captured_variables( monkeypatch ) :
+
+    captured = { "env": { "PATH": "/opt/env/bin:/usr/bin", "ODD": "it's $HOME", "BASH_FUNC_x%%": "() { :; }" }, 
+                 "python": "/opt/env/bin/python", "activate": 2.0, "fast": 0.1 }
+    monkeypatch.setitem( cp._environments, sys.prefix, captured )
+
+    lines, python = cp._environment_lines( fast_env=True )
+
+    assert python == "/opt/env/bin/python"
+    assert "export PATH=/opt/env/bin:/usr/bin" in lines
+    assert "export ODD='it'\"'\"'s $HOME'" in lines
+    assert not any( "BASH_FUNC" in line for line in lines )
+    assert cp._environment_lines( fast_env=False ) == ( [ "source $HOME/.bashrc", f"conda activate {sys.prefix}" ], 
+                                                        "python" )
+
+# -----------------------------------------------------------------------------
+def test_parfor_tasks_run_with_the_captured_environment( tmp_path ) :
+
+    path = str( tmp_path / "job" )
+    *_, tasks = cp.parfor( "import os\nfor i in range( 4 ) :\n    r = len( os.environ[ 'PATH' ] ) > 0\n", 
+                           path, chunks=2, result="r", fast_env=True, run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    script = open( path + os.sep + "run_slurm.bat" ).read()
+    assert "\nconda activate" not in script and "export PATH=" in script
+    assert [ task.state for task in tasks ] == [ "COMPLETED" ] * 2
+    assert list( cp.gather( path ) ) == [ True ] * 4
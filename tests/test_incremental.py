@@ -0,0 +1,58 @@
+import os
+
+from CinecaPy import cineca as cp
+
+LOOP = "for i in range( {n} ) :\n    print( i )\n"
+
+# -----------------------------------------------------------------------------
+def mtimes( path ) :
+
+    return { name: os.stat( os.path.join( path, name ) ).st_mtime_ns 
+             for name in os.listdir( path ) if os.path.isfile( os.path.join( path, name ) ) }
+
+# -----------------------------------------------------------------------------
+def test_unchanged_jobs_are_left_untouched( tmp_path ) :
+
+    path = str( tmp_path / "job" )
+    first = cp.parfor( LOOP.format( n=10 ), path, chunks=2, incremental=True )
+    before = mtimes( path )
+
+    assert cp.parfor( LOOP.format( n=10 ), path, chunks=2, incremental=True ) == first
+    assert mtimes( path ) == before
+
+    # A changed argument regenerates the job
+    cp.parfor( LOOP.format( n=10 ), path, chunks=3, incremental=True )
+    assert mtimes( path ) != before
+
+# -----------------------------------------------------------------------------
+def test_edited_files_are_regenerated( tmp_path ) :
+
+    path = str( tmp_path / "job" )
+    sbatch = cp.parfor( LOOP.format( n=10 ), path, chunks=2, incremental=True )[0]
+    content = open( sbatch ).read()
+    with open( sbatch, "a" ) as f :
+        f.write( "# edited\n" )
+
+    cp.parfor( LOOP.format( n=10 ), path, chunks=2, incremental=True )
+    assert open( sbatch ).read() == content
+
+# -----------------------------------------------------------------------------
+def test_write_if_changed( tmp_path ) :
+
+    file_name = str( tmp_path / "a.txt" )
+
+    assert cp._write_if_changed( file_name, "x" ) == True
+    assert cp._write_if_changed( file_name, "x" ) == False
+    assert cp._write_if_changed( file_name, b"y" ) == True
+    assert open( file_name ).read() == "y"
+
+# -----------------------------------------------------------------------------
+def test_generate_many( tmp_path ) :
+
+    jobs = [ { "loop": LOOP.format( n=n ), "path": str( tmp_path / f"job{n}" ), "chunks": 2 } for n in range( 4, 8 ) ]
+    results = cp.generate_many( jobs, workers=4, printf=False )
+
+    assert [ os.path.dirname( sbatch ) for sbatch, *_ in results ] == [ job[ "path" ] for job in jobs ]
+    before = { job[ "path" ]: mtimes( job[ "path" ] ) for job in jobs }
+    assert cp.generate_many( jobs, workers=4, printf=False ) == results
+    assert { job[ "path" ]: mtimes( job[ "path" ] ) for job in jobs } == before
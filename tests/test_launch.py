@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize( "launch", [ "multi-prog", "farm" ] )
+def test_chunks_run_inside_a_single_job( tmp_path, launch ) :
+
+    path = str( tmp_path / "job" )
+    *_, tasks = cp.parfor( "for i in range( 20 ) :\n    r = i + 1\n", path, chunks=5, ntasks=2, result="r", 
+                           launch=launch, run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    assert len( tasks ) == 1 and tasks[0].state == "COMPLETED"
+    assert "--array" not in open( path + os.sep + "run_slurm.bat" ).read()
+    np.testing.assert_array_equal( cp.gather( path ), np.arange( 1, 21 ) )
+
+# -----------------------------------------------------------------------------
+def test_failed_chunks_make_the_job_fail( tmp_path ) :
+
+    path = str( tmp_path / "job" )
+    code = "for i in range( 8 ) :\n    if i == 5 :\n        raise ValueError( i )\n"
+    *_, tasks = cp.parfor( code, path, chunks=4, ntasks=2, launch="farm", run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    assert tasks[0].state == "FAILED"
+    assert open( path + os.sep + "farm.failed" ).read().split() == [ "3" ]
+
+# -----------------------------------------------------------------------------
+def test_unknown_launch_is_rejected( tmp_path ) :
+
+    with pytest.raises( ValueError, match="Unknown launch" ) :
+        cp.parfor( "for i in range( 4 ) :\n    pass\n", str( tmp_path ), launch="mpi" )
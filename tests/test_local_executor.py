@@ -0,0 +1,85 @@
+import sys
+
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def executor() :
+
+    executor = cp.LocalExecutor( cpus=2, mem=1000, poll=0.1 )
+    yield executor
+    executor.shutdown( cancel=True )
+
+# -----------------------------------------------------------------------------
+def sbatch( tmp_path, body, name="job.bat", **options ) :
+
+    lines = [ "#!/bin/bash" ] + [ f"#SBATCH --{key.replace( '_', '-' )}={value}" for key, value in options.items() ]
+    file_name = str( tmp_path / name )
+    with open( file_name, "w" ) as f :
+        f.write( "\n".join( lines + [ body ] ) + "\n" )
+
+    return file_name
+
+# -----------------------------------------------------------------------------
+def test_array_tasks_get_the_slurm_environment( tmp_path, executor ) :
+
+    file_name = sbatch( tmp_path, 'echo "$SLURM_ARRAY_TASK_ID $SLURM_ARRAY_TASK_COUNT $SLURM_CPUS_PER_TASK $FOO"',
+                        array="1-3", out="logs/task.%a.out" )
+    tasks = executor.submit( file_name, env={ "FOO": "bar" } )
+    executor.wait( tasks )
+
+    assert [ task.array_id for task in tasks ] == [ 1, 2, 3 ]
+    assert [ task.state for task in tasks ] == [ "COMPLETED" ] * 3
+    for i in ( 1, 2, 3 ) :
+        assert ( tmp_path / "logs" / f"task.{i}.out" ).read_text() == f"{i} 3 1 bar\n"
+
+# -----------------------------------------------------------------------------
+def test_tasks_never_exceed_the_cores( tmp_path, executor ) :
+
+    file_name = sbatch( tmp_path, "sleep 0.3", array="1-4", cpus_per_task=2 )
+    tasks = executor.submit( file_name )
+    executor.wait( tasks )
+
+    # Each task takes both cores, so the tasks run one after the other
+    spans = sorted( ( task.start_time, task.end_time ) for task in tasks )
+    assert all( b[0] >= a[1] for a, b in zip( spans, spans[ 1: ] ) )
+
+# -----------------------------------------------------------------------------
+def test_array_throttle( tmp_path, executor ) :
+
+    file_name = sbatch( tmp_path, "sleep 0.3" )
+    tasks = executor.submit( file_name, array="1-3%1" )
+    executor.wait( tasks )
+
+    spans = sorted( ( task.start_time, task.end_time ) for task in tasks )
+    assert all( b[0] >= a[1] for a, b in zip( spans, spans[ 1: ] ) )
+
+# -----------------------------------------------------------------------------
+def test_failures_and_limits( tmp_path, executor ) :
+
+    failed = executor.submit( sbatch( tmp_path, "exit 3", name="fail.bat" ) )
+    timeout = executor.submit( sbatch( tmp_path, "sleep 30", name="time.bat", time="00:01" ) )
+    memory = executor.submit( sbatch( tmp_path, f"{sys.executable} -c 'x = bytearray( 300 << 20 ); import time; time.sleep( 5 )'",
+                                      name="mem.bat", mem="100M" ) )
+    executor.wait()
+
+    assert failed[0].state == "FAILED" and failed[0].returncode == 3
+    assert timeout[0].state == "TIMEOUT" and timeout[0].elapsed < 10
+    assert memory[0].state == "OUT_OF_MEMORY"
+
+# -----------------------------------------------------------------------------
+def test_dependencies( tmp_path, executor ) :
+
+    upstream = executor.submit( sbatch( tmp_path, '[ "$SLURM_ARRAY_TASK_ID" != 2 ] && touch up.$SLURM_ARRAY_TASK_ID', 
+                                        name="up.bat", array="1-3" ) )
+    downstream = executor.submit( sbatch( tmp_path, "test -f up.$SLURM_ARRAY_TASK_ID", name="down.bat", array="1-3" ),
+                                  after=[ ( upstream, True ) ] )
+    after_all = executor.submit( sbatch( tmp_path, "true", name="all.bat" ), after=[ ( upstream, False ) ] )
+    executor.wait()
+
+    assert [ task.state for task in upstream ] == [ "COMPLETED", "FAILED", "COMPLETED" ]
+    assert [ task.state for task in downstream ] == [ "COMPLETED", "CANCELLED", "COMPLETED" ]
+    assert after_all[0].state == "CANCELLED"
+    assert all( task.start_time >= upstream[0].end_time for task in downstream if task.start_time )
@@ -0,0 +1,58 @@
+import os
+import time
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_previous_logs_are_moved_aside( tmp_path ) :
+
+    ( tmp_path / "logs" ).mkdir()
+    ( tmp_path / "logs" / "job.1.out" ).write_text( "old" )
+
+    assert cp._prepare_log_dir( str( tmp_path ), "logs" ) == "logs"
+    assert os.listdir( tmp_path / "logs" ) == []
+
+# -----------------------------------------------------------------------------
+def test_only_the_most_recent_runs_are_kept( tmp_path ) :
+
+    for _ in range( 4 ) :
+        log_dir = cp._prepare_log_dir( str( tmp_path ), "logs", keep_logs=2 )
+        time.sleep( 0.01 )
+
+    assert log_dir == os.path.join( "logs", "latest" )
+    runs = sorted( d for d in os.listdir( tmp_path / "logs" ) if d.startswith( "run_" ) )
+    assert len( runs ) == 3
+    assert os.readlink( tmp_path / "logs" / "latest" ) == runs[-1]
+
+# -----------------------------------------------------------------------------
+def test_sbatch_files_do_not_change_between_runs( tmp_path ) :
+
+    contents = []
+    for _ in range( 2 ) :
+        cp.create_sbatch_file( str( tmp_path ), job="true", keep_logs=3, log_mode="run" )
+        contents.append( ( tmp_path / "run_slurm.bat" ).read_text() )
+        time.sleep( 1.1 )
+
+    assert contents[0] == contents[1]
+    assert "logs/latest/" in contents[0] and "run_" not in contents[0]
+    # The tasks share the SLURM log, which must not be truncated
+    assert "#SBATCH --open-mode=append" in contents[0]
+
+# -----------------------------------------------------------------------------
+def test_aggregated_task_logs( tmp_path ) :
+
+    code = "import sys\nfor i in range( 6 ) :\n    print( 'item', i )\n    print( 'warning', i, file=sys.stderr )\n"
+    path = str( tmp_path / "job" )
+    *_, tasks = cp.parfor( code, path, chunks=3, log_mode="run", run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    log_dir = path + os.sep + "logs"
+    index = cp.task_log_index( log_dir )
+    assert sorted( index ) == [ 1, 2, 3 ]
+    assert all( entry[-1] == 0 for entries in index.values() for entry in entries )
+    for itask in ( 1, 2, 3 ) :
+        first = 2 * ( itask - 1 )
+        assert cp.read_task_log( log_dir, itask ) == f"item {first}\nitem {first + 1}\n"
+        # ( after anything the environment setup writes )
+        assert cp.read_task_log( log_dir, itask, stream="err" ).endswith( f"warning {first}\nwarning {first + 1}\n" )
@@ -0,0 +1,75 @@
+import ast
+import os
+
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def sliced( source, names ) :
+
+    tree = ast.parse( source )
+    statements, unresolved = cp._program_slice( tree.body, set( names ) )
+    return [ ast.unparse( stmt ) for stmt in statements ], unresolved
+
+# -----------------------------------------------------------------------------
+def test_slice_keeps_only_the_dependencies() :
+
+    source = ( "import numpy as np\n"
+               "import time\n"
+               "n = 10\n"
+               "data = np.load( 'huge.npy' )\n"
+               "m = n * 2\n"
+               "print( data.shape )\n"
+               "time.sleep( 100 )\n" )
+    statements, unresolved = sliced( source, [ "m" ] )
+
+    assert statements == [ "n = 10", "m = n * 2" ]
+    assert unresolved == set()
+
+# -----------------------------------------------------------------------------
+def test_slice_keeps_the_environment_changes() :
+
+    source = ( "import os, sys\n"
+               "os.chdir( 'data' )\n"
+               "sys.path.insert( 0, 'lib' )\n"
+               "os.environ[ 'N' ] = '4'\n"
+               "print( 'setup' )\n"
+               "files = sorted( os.listdir( '.' ) )\n" )
+    statements, _ = sliced( source, [ "files" ] )
+
+    assert statements == [ "import os, sys", "os.chdir('data')", "sys.path.insert(0, 'lib')", 
+                           "os.environ['N'] = '4'", "files = sorted(os.listdir('.'))" ]
+
+# -----------------------------------------------------------------------------
+def test_slice_follows_functions_assigning_globals() :
+
+    source = ( "def setup() :\n"
+               "    global items\n"
+               "    items = list( range( 7 ) )\n"
+               "def unused() :\n"
+               "    pass\n"
+               "setup()\n"
+               "unused()\n" )
+    statements, _ = sliced( source, [ "items" ] )
+
+    assert len( statements ) == 2 and statements[0].startswith( "def setup()" ) and statements[1] == "setup()"
+
+# -----------------------------------------------------------------------------
+def test_loop_length_runs_only_the_slice( tmp_path ) :
+
+    marker = str( tmp_path / "ran" )
+    source = ( f"open( {marker!r}, 'w' ).close()\n"
+               "words = 'a b c d e'.split()\n"
+               "for w in words :\n"
+               "    print( w )\n" )
+    n, for_node, _ = cp._loop_length( source )
+
+    assert n == 5 and isinstance( for_node, ast.For )
+    assert not os.path.exists( marker )
+
+# -----------------------------------------------------------------------------
+def test_loop_index_out_of_range() :
+
+    with pytest.raises( ValueError, match="ifor=1" ) :
+        cp._find_loop( "for i in range( 3 ) :\n    pass\n", ifor=1 )
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize( "iterable", [
+    list( range( 10 ) ),
+    [ 0.5, 1.5, 2.5 ],
+    [ True, False, True ],
+    [ 1, 2.5, 3 ],
+    [ "a", "bb", "" ],
+    [ b"x", b"", b"yz" ],
+    [ ( 1, "a" ), { "k": [ 1, 2 ] }, None ],
+    [ 2**70, 1 ], ] )
+def test_round_trip_keeps_items_and_types( tmp_path, iterable ) :
+
+    n = cp.write_manifest( str( tmp_path ), iterable )
+    manifest = cp.load_manifest( str( tmp_path ) )
+
+    assert n == len( iterable ) == len( manifest )
+    items = list( manifest )
+    assert items == iterable
+    assert [ type( v ) for v in items ] == [ type( v ) for v in iterable ]
+    assert [ type( manifest[ i ] ) for i in range( n ) ] == [ type( v ) for v in iterable ]
+
+# -----------------------------------------------------------------------------
+def test_range_is_stored_as_python_ints( tmp_path ) :
+
+    cp.write_manifest( str( tmp_path ), range( 3, 20, 4 ) )
+    manifest = cp.load_manifest( str( tmp_path ) )
+
+    assert isinstance( manifest, cp.Manifest )
+    assert list( manifest ) == list( range( 3, 20, 4 ) )
+    assert all( type( v ) is int for v in manifest )
+
+# -----------------------------------------------------------------------------
+def test_numeric_array_is_memory_mapped( tmp_path ) :
+
+    array = np.arange( 12, dtype=np.float32 ).reshape( 4, 3 )
+    cp.write_manifest( str( tmp_path ), array )
+    manifest = cp.load_manifest( str( tmp_path ) )
+
+    assert isinstance( manifest, np.memmap )
+    assert manifest.dtype == array.dtype
+    np.testing.assert_array_equal( manifest, array )
+
+# -----------------------------------------------------------------------------
+def test_slices_are_lazy_views( tmp_path ) :
+
+    items = [ f"item{i}" for i in range( 100 ) ]
+    cp.write_manifest( str( tmp_path ), iter( items ), name="words" )
+    manifest = cp.load_manifest( str( tmp_path ), name="words" )
+
+    view = manifest[ 10:20 ]
+    assert isinstance( view, cp.Manifest )
+    assert list( view ) == items[ 10:20 ]
+    assert view[ -1 ] == items[ 19 ]
+    assert list( view[ 2:4 ] ) == items[ 12:14 ]
+    assert manifest[ 0:10:3 ] == items[ 0:10:3 ]
+    assert manifest[ [ 5, 1 ] ] == [ items[5], items[1] ]
+    with pytest.raises( IndexError ) :
+        view[ 10 ]
+
+# -----------------------------------------------------------------------------
+def test_empty_iterable( tmp_path ) :
+
+    assert cp.write_manifest( str( tmp_path ), [] ) == 0
+    assert list( cp.load_manifest( str( tmp_path ) ) ) == []
@@ -0,0 +1,48 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_product_matches_nested_loops() :
+
+    a, b, c = [ 1, 2 ], "xyz", range( 10, 14 )
+    product = cp.Product( a, b, c )
+    expected = list( itertools.product( a, b, c ) )
+
+    assert len( product ) == 24 and product.shape == ( 2, 3, 4 )
+    assert list( product ) == expected
+    assert product[ -1 ] == expected[ -1 ]
+    assert product.unravel( 17 ) == ( 1, 1, 1 )
+    # The slices of the tasks are products too
+    assert isinstance( product[ 5:11 ], cp.Product ) and list( product[ 5:11 ] ) == expected[ 5:11 ]
+    assert list( product[ 5:11 ][ 2:4 ] ) == expected[ 7:9 ]
+
+# -----------------------------------------------------------------------------
+def test_product_of_iterators() :
+
+    assert list( cp.Product( iter( [ 1, 2 ] ), ( i for i in "ab" ) ) ) == [ ( 1, "a" ), ( 1, "b" ), ( 2, "a" ), ( 2, "b" ) ]
+
+# -----------------------------------------------------------------------------
+def test_parfor_over_nested_loops( tmp_path ) :
+
+    code = ( "A = [ 1, 2, 3 ]\n"
+             "for a in A :\n"
+             "    for b in range( 5 ) :\n"
+             "        r = 10 * a + b\n" )
+    path = str( tmp_path / "job" )
+    *_, tasks = cp.parfor( code, path, ifor=[ 0, 1 ], chunks=4, result="r", run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    assert [ task.state for task in tasks ] == [ "COMPLETED" ] * 4
+    np.testing.assert_array_equal( cp.gather( path ), [ 10 * a + b for a in [ 1, 2, 3 ] for b in range( 5 ) ] )
+
+# -----------------------------------------------------------------------------
+def test_only_perfectly_nested_loops( tmp_path ) :
+
+    code = "for a in range( 3 ) :\n    x = a\n    for b in range( 5 ) :\n        pass\n"
+    with pytest.raises( ValueError ) :
+        cp.parfor( code, str( tmp_path ), ifor=[ 0, 1 ] )
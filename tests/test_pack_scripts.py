@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_first_fit_decreasing_packing() :
+
+    nodes = cp._pack_nodes( [ ( 30, 1000 ), ( 20, 1000 ), ( 10, 1000 ), ( 1, 300000 ), ( 18, 1000 ) ], 48, 375000 )
+
+    # The largest demands first: 3 ( 80% of the memory ), 0, 1 ( on a new node ), 4 ( too many CPUs for the first ), 2
+    assert sorted( sorted( node ) for node in nodes ) == [ [ 0, 2, 3 ], [ 1, 4 ] ]
+    with pytest.raises( ValueError ) :
+        cp._pack_nodes( [ ( 64, 1000 ) ], 48, 375000 )
+
+# -----------------------------------------------------------------------------
+def test_scripts_run_in_one_allocation( tmp_path ) :
+
+    script_file = tmp_path / "from_file.py"
+    script_file.write_text( "print( 'file' )\n" )
+    scripts = [ "print( 'inline' )\n", 
+                str( script_file ), 
+                { "pycode": "import sys\nsys.exit( 3 )\n", "name": "failing", "ncpus": 1, "mem": "1G" } ]
+    path = str( tmp_path / "pack" )
+    sbatch, pyfiles, _, tasks = cp.pack_scripts( scripts, path, node_cpus=4, node_mem=8000, 
+                                                 run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    assert len( tasks ) == 1 and tasks[0].state == "FAILED"
+    assert { "failing", "from_file", "script_0" } <= set( os.listdir( path ) )
+    assert open( pyfiles[1] ).read().count( "print( 'file' )" ) == 1
+    assert cp.pack_status( path ) == { "script_0": 0, "from_file": 0, "failing": 3 }
+
+# -----------------------------------------------------------------------------
+def test_duplicate_names_are_rejected( tmp_path ) :
+
+    with pytest.raises( ValueError, match="named" ) :
+        cp.pack_scripts( [ { "pycode": "pass", "name": "a" }, { "pycode": "pass", "name": "a" } ], str( tmp_path ) )
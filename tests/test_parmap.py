@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+
+from CinecaPy import cineca as cp
+
+ROOT = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+# A script defining its function in '__main__', and serializing it without cloudpickle
+DUMP = textwrap.dedent( """
+    import sys
+    sys.path.insert( 0, {root!r} )
+    sys.modules[ "cloudpickle" ] = None
+    from CinecaPy import cineca as cp
+    import numpy as np
+
+    class Scale :
+        def __init__( self, factor ) :
+            self.factor = factor
+        def apply( self, x ) :
+            return x * self.factor
+
+    OFFSET = 100
+
+    def make( power ) :
+        def helper( x ) :
+            return x ** power
+        def kernel( item, scale, shift=0 ) :
+            return scale.apply( helper( item ) ) + OFFSET + shift + int( np.sign( item ) )
+        return kernel
+
+    print( cp.dump_function( sys.argv[1], make( 2 ), args=( Scale( 3 ), ), kwargs={{ "shift": 1 }} ) )
+""" )
+
+# -----------------------------------------------------------------------------
+def test_main_functions_are_serialized_by_value( tmp_path ) :
+
+    script = tmp_path / "dump.py"
+    script.write_text( DUMP.format( root=ROOT ) )
+    file_name = str( tmp_path / "function.pkl" )
+    proc = subprocess.run( [ sys.executable, str( script ), file_name ], capture_output=True, text=True )
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.strip() == "marshal"
+
+    # Loaded by another process, where '__main__' is not the script
+    load = f"import sys ; sys.path.insert( 0, {ROOT!r} ) ; from CinecaPy import cineca as cp ; " \
+           f"func, args, kwargs = cp.load_function( {file_name!r} ) ; print( [ func( i, *args, **kwargs ) for i in range( 4 ) ] )"
+    proc = subprocess.run( [ sys.executable, "-c", load ], capture_output=True, text=True )
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.strip() == str( [ 3 * i * i + 101 + ( i > 0 ) for i in range( 4 ) ] )
+
+# -----------------------------------------------------------------------------
+def test_module_functions_are_pickled_by_reference( tmp_path, monkeypatch ) :
+
+    monkeypatch.setitem( sys.modules, "cloudpickle", None )
+    file_name = str( tmp_path / "function.pkl" )
+
+    assert cp.dump_function( file_name, np.add, args=( 1, ) ) == "pickle"
+    func, args, kwargs = cp.load_function( file_name )
+    assert func is np.add and args == ( 1, ) and kwargs == {}
+
+# -----------------------------------------------------------------------------
+def test_parmap_runs_vectorized_batches( tmp_path ) :
+
+    offset = 0.5
+
+    def kernel( batch, power=1 ) :
+        return np.asarray( batch, dtype=float ) ** power + offset
+
+    path = str( tmp_path / "job" )
+    *_, tasks = cp.parmap( kernel, 1000, path, batch_size=64, chunks=3, kwargs={ "power": 2 }, 
+                           run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    assert [ task.state for task in tasks ] == [ "COMPLETED" ] * 3
+    np.testing.assert_allclose( cp.gather( path ), np.arange( 1000.0 ) ** 2 + 0.5 )
+
+# -----------------------------------------------------------------------------
+def test_parmap_item_by_item( tmp_path ) :
+
+    path = str( tmp_path / "job" )
+    *_, tasks = cp.parmap( len, [ "a", "bb", "ccc" ], path, vectorized=False, chunk_size=2, 
+                           run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    assert list( cp.gather( path ) ) == [ 1, 2, 3 ]
+    with pytest.raises( ValueError ) :
+        cp.parmap( len, [ "a" ], str( tmp_path / "other" ) )
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_lpt_balances_the_loads() :
+
+    weights = [ 7, 5, 4, 3, 3, 2 ]
+    bins, loads = cp.balanced_partition( weights, 2 )
+
+    # Every item is assigned exactly once, in its original order inside each bin
+    assigned = np.concatenate( bins )
+    assert sorted( assigned.tolist() ) == list( range( len( weights ) ) )
+    assert all( np.all( np.diff( b ) > 0 ) for b in bins )
+    # The loads match the items of each bin, and LPT is optimal here
+    np.testing.assert_allclose( loads, [ sum( weights[ i ] for i in b ) for b in bins ] )
+    assert sorted( loads.tolist() ) == [ 12, 12 ]
+
+# -----------------------------------------------------------------------------
+def test_lpt_bound_on_random_weights() :
+
+    rng = np.random.default_rng( 0 )
+    weights = rng.pareto( 1.5, 1000 )
+    bins, loads = cp.balanced_partition( weights, 16 )
+
+    # Graham's bound for LPT: makespan <= 4/3 of the optimum, itself >= max( mean, largest item )
+    lower = max( weights.sum() / 16, weights.max() )
+    assert loads.max() <= 4 / 3 * lower + 1e-9
+    assert sum( len( b ) for b in bins ) == 1000
+
+# -----------------------------------------------------------------------------
+def test_more_bins_than_items() :
+
+    bins, loads = cp.balanced_partition( [ 1.0, 2.0 ], 4 )
+
+    assert sum( len( b ) for b in bins ) == 2
+    assert sorted( loads.tolist() ) == [ 0, 0, 1, 2 ]
+
+# -----------------------------------------------------------------------------
+def test_negative_weights_are_rejected() :
+
+    with pytest.raises( ValueError ) :
+        cp.balanced_partition( [ 1, -1 ], 2 )
+
+# -----------------------------------------------------------------------------
+def test_partition_files_round_trip( tmp_path ) :
+
+    bins, _ = cp.balanced_partition( np.arange( 20 ), 3 )
+    cp.write_partition( str( tmp_path ), bins )
+
+    for itask, b in enumerate( bins, 1 ) :
+        np.testing.assert_array_equal( cp.load_partition( str( tmp_path ), itask ), b )
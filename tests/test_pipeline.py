@@ -0,0 +1,83 @@
+import os
+import stat
+
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def sbatch( tmp_path, name, body, array=None ) :
+
+    file_name = str( tmp_path / f"{name}.bat" )
+    with open( file_name, "w" ) as f :
+        f.write( "#!/bin/bash\n" + ( f"#SBATCH --array={array}\n" if array else "" ) + body + "\n" )
+
+    return file_name
+
+# -----------------------------------------------------------------------------
+def test_order_and_validation( tmp_path ) :
+
+    pipe = cp.Pipeline()
+    pipe.stage( "post", sbatch( tmp_path, "post", "true", array="1-2" ), after=[ "sweep" ], per_element=True )
+    pipe.stage( "prep", sbatch( tmp_path, "prep", "true" ) )
+    pipe.stage( "sweep", sbatch( tmp_path, "sweep", "true", array="1-2" ), after=[ "prep" ] )
+    assert pipe.order() == [ "prep", "sweep", "post" ]
+
+    with pytest.raises( ValueError, match="already exists" ) :
+        pipe.stage( "prep", sbatch( tmp_path, "prep", "true" ) )
+
+    pipe.stage( "loop", sbatch( tmp_path, "loop", "true" ), after=[ "loop" ] )
+    with pytest.raises( ValueError, match="circular" ) :
+        pipe.order()
+
+    bad = cp.Pipeline().stage( "a", sbatch( tmp_path, "a", "true", array="1-3" ) ) \
+                       .stage( "b", sbatch( tmp_path, "b", "true", array="1-2" ), after=[ "a" ], per_element=True )
+    with pytest.raises( ValueError, match="same task IDs" ) :
+        bad.order()
+
+# -----------------------------------------------------------------------------
+def test_local_pipeline_respects_the_dependencies( tmp_path ) :
+
+    pipe = cp.Pipeline()
+    pipe.stage( "prep", sbatch( tmp_path, "prep", "sleep 0.2 ; echo prep > prep.txt" ) )
+    pipe.stage( "sweep", sbatch( tmp_path, "sweep", "cat prep.txt > sweep.$SLURM_ARRAY_TASK_ID", array="1-3" ), 
+                after=[ "prep" ] )
+    pipe.stage( "post", sbatch( tmp_path, "post", "cat sweep.$SLURM_ARRAY_TASK_ID", array="1-3" ), 
+                after=[ "sweep" ], per_element=True )
+    pipe.stage( "fail", sbatch( tmp_path, "fail", "exit 1" ) )
+    pipe.stage( "never", sbatch( tmp_path, "never", "true" ), after=[ "fail", "prep" ] )
+    pipe.submit()
+
+    assert pipe.wait() == { "prep": "COMPLETED", "sweep": "COMPLETED", "post": "COMPLETED", 
+                            "fail": "FAILED", "never": "CANCELLED" }
+
+# -----------------------------------------------------------------------------
+def test_parfor_stages_are_arrays_of_their_chunks( tmp_path ) :
+
+    generated = cp.parfor( "for i in range( 10 ) :\n    print( i )\n", str( tmp_path / "sweep" ), chunks=4 )
+    pipe = cp.Pipeline().stage( "sweep", generated )
+
+    assert pipe.stages[ "sweep" ][ "sbatch" ] == generated[0]
+    assert pipe.stages[ "sweep" ][ "array" ] == "1-4"
+
+# -----------------------------------------------------------------------------
+def test_slurm_dependencies( tmp_path, monkeypatch ) :
+
+    # A stand-in of sbatch returning increasing job IDs
+    fake = str( tmp_path / "sbatch" )
+    with open( fake, "w" ) as f :
+        f.write( f'#!/bin/bash\necho "$@" >> "{tmp_path}/calls"\nwc -l < "{tmp_path}/calls"\n' )
+    os.chmod( fake, os.stat( fake ).st_mode | stat.S_IEXEC )
+    monkeypatch.setitem( cp.SLURM_COMMANDS, "sbatch", fake )
+    monkeypatch.setattr( cp, "is_cineca_system", lambda : True )
+
+    pipe = cp.Pipeline( monitor=cp.SlurmMonitor() )
+    pipe.stage( "prep", sbatch( tmp_path, "prep", "true" ) )
+    pipe.stage( "sweep", sbatch( tmp_path, "sweep", "true", array="1-2" ), after=[ "prep" ] )
+    pipe.stage( "post", sbatch( tmp_path, "post", "true", array="1-2" ), after=[ "sweep" ], per_element=True )
+    jobs = pipe.submit()
+
+    assert [ jobs[ name ].job_id for name in ( "prep", "sweep", "post" ) ] == [ 1, 2, 3 ]
+    calls = ( tmp_path / "calls" ).read_text().splitlines()
+    assert "--dependency=afterok:1 --kill-on-invalid-dep=yes --array=1-2" in calls[1]
+    assert "--dependency=aftercorr:2 --kill-on-invalid-dep=yes --array=1-2" in calls[2]
@@ -0,0 +1,51 @@
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize( "kind", [ "process", "thread" ] )
+def test_results_keep_the_order_of_the_items( kind ) :
+
+    offset = 10
+
+    # A closure: with "fork", the function itself is never pickled
+    def body( x ) :
+        return x * x + offset
+
+    results = list( cp.pool_map( body, range( 50 ), kind=kind, workers=3 ) )
+
+    assert results == [ x * x + offset for x in range( 50 ) ]
+
+# -----------------------------------------------------------------------------
+def test_single_worker_runs_serially() :
+
+    seen = []
+    results = list( cp.pool_map( seen.append, iter( "abc" ), workers=1 ) )
+
+    assert seen == [ "a", "b", "c" ]
+    assert results == [ None, None, None ]
+
+# -----------------------------------------------------------------------------
+def test_unknown_kind_is_rejected() :
+
+    with pytest.raises( ValueError ) :
+        list( cp.pool_map( abs, [ 1 ], kind="mpi", workers=2 ) )
+
+# -----------------------------------------------------------------------------
+def test_pool_cannot_be_combined_with_the_dynamic_schedule( tmp_path ) :
+
+    with pytest.raises( ValueError, match="dynamic" ) :
+        cp.parfor( "for i in range( 10 ) :\n    pass\n", str( tmp_path ), pool="process", schedule="dynamic" )
+
+# -----------------------------------------------------------------------------
+def test_parfor_tasks_run_their_chunks_over_a_pool( tmp_path ) :
+
+    code = "scale = 3\nfor i in range( 20 ) :\n    r = i * scale\n"
+    path = str( tmp_path / "job" )
+    *_, tasks = cp.parfor( code, path, chunks=2, ncpus=2, pool="process", result="r", 
+                           run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    assert [ task.state for task in tasks ] == [ "COMPLETED" ] * 2
+    assert list( cp.gather( path ) ) == [ i * 3 for i in range( 20 ) ]
@@ -0,0 +1,55 @@
+import os
+import threading
+
+import numpy as np
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_batches_cover_the_iterations( tmp_path ) :
+
+    path = str( tmp_path / "queue" )
+    assert cp.write_queue( path, 25, 10 ) == 3
+
+    items = list( cp.claim_items( range( 100, 125 ), path, indexed=True ) )
+
+    assert items == [ ( i, 100 + i ) for i in range( 25 ) ]
+    assert os.listdir( path + "/todo" ) == []
+    assert os.listdir( path + "/claimed" ) == []
+    assert len( os.listdir( path + "/done" ) ) == 3
+
+# -----------------------------------------------------------------------------
+def test_only_the_given_indices_are_queued( tmp_path ) :
+
+    path = str( tmp_path / "queue" )
+    cp.write_queue( path, 20, 3, indices=[ 0, 1, 2, 3, 7, 8, 15 ] )
+
+    assert sorted( cp.claim_items( list( range( 20 ) ), path ) ) == [ 0, 1, 2, 3, 7, 8, 15 ]
+
+# -----------------------------------------------------------------------------
+def test_weighted_queue_starts_from_the_most_expensive_batch( tmp_path ) :
+
+    path = str( tmp_path / "queue" )
+    weights = np.ones( 30 )
+    weights[ 20: ] = 10
+    cp.write_queue( path, 30, 10, weights=weights )
+
+    assert next( cp.claim_items( range( 30 ), path, itask=2, ntasks=3 ) ) == 20
+
+# -----------------------------------------------------------------------------
+def test_concurrent_tasks_claim_each_batch_once( tmp_path ) :
+
+    path = str( tmp_path / "queue" )
+    cp.write_queue( path, 1000, 7 )
+    claimed = [ [] for _ in range( 8 ) ]
+
+    def task( itask ) :
+        claimed[ itask - 1 ].extend( cp.claim_items( range( 1000 ), path, itask=itask, ntasks=8 ) )
+
+    threads = [ threading.Thread( target=task, args=( itask, ) ) for itask in range( 1, 9 ) ]
+    for t in threads :
+        t.start()
+    for t in threads :
+        t.join()
+
+    assert sorted( i for c in claimed for i in c ) == list( range( 1000 ) )
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def write_shard( path, itask, results, run=None, monkeypatch=None ) :
+
+    # Each run of a task writes its own shard
+    if run is not None :
+        monkeypatch.setenv( "SLURM_JOB_ID", str( run ) )
+    writer = cp.ShardWriter( path, itask )
+    for index, value in results :
+        writer.write( index, value )
+    writer.close()
+
+# -----------------------------------------------------------------------------
+def test_numeric_results_are_gathered_in_iteration_order( tmp_path ) :
+
+    path = str( tmp_path )
+    write_shard( path, 2, [ ( i, np.float32( i ) ) for i in range( 5, 10 ) ] )
+    write_shard( path, 1, [ ( i, np.float32( i ) ) for i in range( 5 ) ] )
+
+    assert sorted( f.split( "." )[-1] for f in os.listdir( path ) ) == [ "idx", "idx", "npy", "npy" ]
+    out = cp.gather( path )
+    assert out.dtype == np.float32
+    np.testing.assert_array_equal( out, np.arange( 10 ) )
+
+# -----------------------------------------------------------------------------
+def test_mixed_results_fall_back_to_pickles( tmp_path ) :
+
+    path = str( tmp_path )
+    write_shard( path, 1, [ ( 0, 1 ), ( 1, 2.5 ), ( 2, "three" ), ( 3, cp.SKIPPED ), ( 4, [ 4 ] ) ] )
+
+    assert [ f.endswith( ".pkl" ) for f in os.listdir( path ) ] == [ True ]
+    assert cp.gather( path ) == [ 1, 2.5, "three", None, [ 4 ] ]
+
+# -----------------------------------------------------------------------------
+def test_missing_iterations_are_nan( tmp_path, capsys ) :
+
+    path = str( tmp_path )
+    write_shard( path, 1, [ ( 0, 1.0 ), ( 2, 3.0 ) ] )
+
+    out = cp.gather( path )
+    assert out[0] == 1.0 and np.isnan( out[1] ) and out[2] == 3.0
+    assert "1 of 3 iterations" in capsys.readouterr().out
+
+# -----------------------------------------------------------------------------
+def test_unclosed_shards_are_not_read( tmp_path ) :
+
+    path = str( tmp_path )
+    writer = cp.ShardWriter( path, 1 )
+    writer.write( 0, 1.0 )
+
+    assert list( cp.iter_shards( path ) ) == []
+
+# -----------------------------------------------------------------------------
+def test_resubmitted_tasks_override_previous_results( tmp_path, monkeypatch ) :
+
+    path = str( tmp_path )
+    write_shard( path, 1, [ ( i, float( i ) ) for i in range( 4 ) ], run=100, monkeypatch=monkeypatch )
+    write_shard( path, 1, [ ( 2, 20.0 ), ( 3, 30.0 ) ], run=101, monkeypatch=monkeypatch )
+    # The same modification time: the run IDs decide
+    stat = os.stat( path + os.sep + "shard.000001.100.0000.npy" )
+    for name in os.listdir( path ) :
+        os.utime( path + os.sep + name, ns=( stat.st_atime_ns, stat.st_mtime_ns ) )
+
+    np.testing.assert_array_equal( cp.gather( path ), [ 0.0, 1.0, 20.0, 30.0 ] )
+    assert cp.reduce( path ) == 51.0
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize( "value", [ lambda i : np.full( 2, float( i ) ), lambda i : { "v": i } ] )
+def test_reduce( tmp_path, value ) :
+
+    path = str( tmp_path )
+    write_shard( path, 2, [ ( i, value( i ) ) for i in range( 3, 6 ) ] )
+    write_shard( path, 1, [ ( i, value( i ) ) for i in range( 3 ) ] )
+
+    concat = cp.reduce( path, op="concat" )
+    custom = cp.reduce( path, op=lambda acc, v : acc + [ v ], initial=[] )
+    if isinstance( value( 0 ), dict ) :
+        assert concat == [ { "v": i } for i in range( 6 ) ]
+        assert sorted( v[ "v" ] for v in custom ) == list( range( 6 ) )
+    else :
+        np.testing.assert_array_equal( cp.reduce( path ), [ 15.0, 15.0 ] )
+        np.testing.assert_array_equal( concat, np.repeat( np.arange( 6.0 ), 2 ) )
+        assert len( custom ) == 6
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import stat
+
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def slurm( tmp_path, monkeypatch ) :
+    """
+    Stand-ins of the SLURM commands: squeue and sacct print the files 'queue' and 'acct'
+    of the returned directory, and every call is appended to 'calls'.
+    """
+
+    scripts = { "sbatch": 'echo "42;g100"',
+                "squeue": f'cat "{tmp_path}/queue" 2>/dev/null',
+                "sacct": f'cat "{tmp_path}/acct" 2>/dev/null',
+                "scancel": "true" }
+    for name, body in scripts.items() :
+        file_name = str( tmp_path / name )
+        with open( file_name, "w" ) as f :
+            f.write( f'#!/bin/bash\necho "{name} $@" >> "{tmp_path}/calls"\n{body}\n' )
+        os.chmod( file_name, os.stat( file_name ).st_mode | stat.S_IEXEC )
+        monkeypatch.setitem( cp.SLURM_COMMANDS, name, file_name )
+
+    return tmp_path
+
+# -----------------------------------------------------------------------------
+def test_job_ids_of_squeue_and_sacct() :
+
+    assert cp._parse_job_id( "123" ) == ( 123, [ None ] )
+    assert cp._parse_job_id( "123_4" ) == ( 123, [ 4 ] )
+    assert cp._parse_job_id( "123_[5-7%2]" ) == ( 123, [ 5, 6, 7 ] )
+    assert cp._parse_job_id( "123_4.batch" ) == ( 123, [ 4 ] )
+
+# -----------------------------------------------------------------------------
+def test_submit_returns_a_job_handle( slurm ) :
+
+    file_name = str( slurm / "job.bat" )
+    with open( file_name, "w" ) as f :
+        f.write( "#!/bin/bash\n#SBATCH --array=1-3\ntrue\n" )
+
+    job = cp.submit( file_name, options=[ "--dependency=afterok:1" ], monitor=cp.SlurmMonitor() )
+
+    assert job.job_id == 42 and job.array_ids == [ 1, 2, 3 ]
+    assert job.state == "PENDING"
+    assert ( slurm / "calls" ).read_text() == f"sbatch --parsable --dependency=afterok:1 {file_name}\n"
+
+# -----------------------------------------------------------------------------
+def test_one_batched_poll_updates_all_the_jobs( slurm ) :
+
+    monitor = cp.SlurmMonitor( interval=0.0 )
+    array, single = cp.SlurmJob( 42, array_ids=[ 1, 2, 3 ] ), cp.SlurmJob( 43 )
+    for job in ( array, single ) :
+        monitor.add( job )
+    changes = []
+    array.add_callback( lambda job, i, old, new : changes.append( ( i, old, new ) ) )
+
+    ( slurm / "queue" ).write_text( "42_1 RUNNING\n42_[2-3] PENDING\n43 RUNNING\n" )
+    asyncio.run( monitor.poll() )
+    assert array.state == "RUNNING" and single.state == "RUNNING"
+    assert changes == [ ( 1, "PENDING", "RUNNING" ) ]
+
+    # The tasks that left the queue are looked up in the accounting
+    ( slurm / "queue" ).write_text( "42_3 RUNNING\n" )
+    ( slurm / "acct" ).write_text( "42_1|COMPLETED\n42_2|FAILED\n43|CANCELLED by 1000\n" )
+    asyncio.run( monitor.poll() )
+    assert array.states == { 1: "COMPLETED", 2: "FAILED", 3: "RUNNING" }
+    assert single.state == "CANCELLED" and single.done()
+
+    ( slurm / "queue" ).write_text( "" )
+    ( slurm / "acct" ).write_text( "42_3|COMPLETED\n" )
+    assert cp.wait_jobs( [ array, single ], monitor=monitor ) == [ "FAILED", "CANCELLED" ]
+
+    calls = ( slurm / "calls" ).read_text().splitlines()
+    assert calls[0] == "squeue -h -o %i %T -j 42,43"
+    assert sum( call.startswith( "squeue" ) for call in calls ) == 3
+
+# -----------------------------------------------------------------------------
+def test_jobs_leaving_the_queue_without_accounting_have_ended( slurm ) :
+
+    monitor = cp.SlurmMonitor( interval=0.0 )
+    job = cp.SlurmJob( 42 )
+    monitor.add( job )
+
+    ( slurm / "queue" ).write_text( "42 RUNNING\n" )
+    asyncio.run( monitor.poll() )
+    # sacct fails: the job was seen in the queue, and left it
+    os.remove( str( slurm / "queue" ) )
+    os.remove( cp.SLURM_COMMANDS[ "sacct" ] )
+    asyncio.run( monitor.poll() )
+
+    assert job.state == "ENDED"
+
+# -----------------------------------------------------------------------------
+def test_as_completed_yields_jobs_as_they_end( slurm ) :
+
+    monitor = cp.SlurmMonitor( interval=0.0 )
+    jobs = [ cp.SlurmJob( 42 ), cp.SlurmJob( 43 ) ]
+    ( slurm / "queue" ).write_text( "42 RUNNING\n" )
+    ( slurm / "acct" ).write_text( "43|COMPLETED\n" )
+
+    async def first() :
+        async for job in monitor.as_completed( jobs ) :
+            return job
+
+    assert asyncio.run( first() ).job_id == 43
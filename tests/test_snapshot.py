@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_snapshot_round_trip( tmp_path ) :
+
+    path = str( tmp_path / "snapshot" )
+    values = { "big": np.arange( 1000, dtype=np.float64 ), "small": np.arange( 3 ), "name": "x", "table": { 1: [ 2 ] } }
+    assert cp.write_snapshot( path, values, mmap_min=4000 ) == [ "big" ]
+
+    loaded = cp.load_snapshot( path )
+    assert isinstance( loaded[ "big" ], np.memmap ) and not isinstance( loaded[ "small" ], np.memmap )
+    np.testing.assert_array_equal( loaded[ "big" ], values[ "big" ] )
+    assert loaded[ "name" ] == "x" and loaded[ "table" ] == { 1: [ 2 ] }
+    # The tasks modify only their own copy
+    loaded[ "big" ][0] = -1
+    assert cp.load_snapshot( path )[ "big" ][0] == 0
+
+# -----------------------------------------------------------------------------
+def test_unpicklable_variables_are_rejected( tmp_path ) :
+
+    with pytest.raises( ValueError, match="gen" ) :
+        cp.write_snapshot( str( tmp_path ), { "gen": ( i for i in range( 3 ) ) } )
+
+# -----------------------------------------------------------------------------
+def test_prelude_snapshot( tmp_path ) :
+
+    code = ( "import numpy as np\n"
+             "def setup() :\n"
+             "    global table\n"
+             "    table = np.arange( 10 ) * 7\n"
+             "np.random.seed( 0 )\n"
+             "setup()\n"
+             "unused = 'not read'\n"
+             "scale = 2\n"
+             "for i in range( 4 ) :\n"
+             "    r = table[ i ] * scale\n" )
+    path = str( tmp_path / "snapshot" )
+    iter_value, _, _, removed = cp._snapshot_prelude( path, code )
+
+    assert list( iter_value ) == [ 0, 1, 2, 3 ]
+    # The seed is still set by the tasks, the rest of the prelude is replaced by the snapshot
+    assert len( removed ) == 3
+    values = cp.load_snapshot( path )
+    assert sorted( values ) == [ "scale", "table" ]
+
+# -----------------------------------------------------------------------------
+def test_parfor_tasks_load_the_snapshot( tmp_path ) :
+
+    marker = str( tmp_path / "prelude_runs" )
+    code = ( f"open( {marker!r}, 'a' ).write( 'x' )\n"
+             "def setup() :\n"
+             "    global table\n"
+             "    table = [ 7 * i for i in range( 10 ) ]\n"
+             "setup()\n"
+             "for i in range( 10 ) :\n"
+             "    r = table[ i ]\n" )
+    path = str( tmp_path / "job" )
+    *_, tasks = cp.parfor( code, path, chunks=3, result="r", snapshot=True, run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    assert [ task.state for task in tasks ] == [ "COMPLETED" ] * 3
+    assert list( cp.gather( path ) ) == [ 7 * i for i in range( 10 ) ]
+    # The prelude was run once, at generation time
+    assert open( marker ).read() == "x"
+    assert os.path.isdir( path + os.sep + "snapshot" )
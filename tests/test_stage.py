@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_stage_copies_in_chunks_and_skips_unchanged_files( tmp_path ) :
+
+    src = tmp_path / "src"
+    ( src / "sub" ).mkdir( parents=True )
+    ( src / "sub" / "a.bin" ).write_bytes( os.urandom( 1000 ) )
+    ( tmp_path / "b.txt" ).write_text( "b" )
+    dest = str( tmp_path / "dest" )
+
+    first = cp.stage( [ str( src ), str( tmp_path / "b.txt" ) ], dest, chunk_size=64, printf=False )
+    assert ( first[ "copied" ], first[ "skipped" ], first[ "bytes" ] ) == ( 2, 0, 1001 )
+    assert ( tmp_path / "dest" / "src" / "sub" / "a.bin" ).read_bytes() == ( src / "sub" / "a.bin" ).read_bytes()
+
+    ( tmp_path / "b.txt" ).write_text( "bb" )
+    second = cp.stage( { str( src ): "src", str( tmp_path / "b.txt" ): "b.txt" }, dest, printf=False )
+    assert ( second[ "copied" ], second[ "skipped" ] ) == ( 1, 1 )
+    assert ( tmp_path / "dest" / "b.txt" ).read_text() == "bb"
+
+# -----------------------------------------------------------------------------
+def test_staged_paths( tmp_path, monkeypatch ) :
+
+    ( tmp_path / "data.npy" ).write_text( "" )
+    monkeypatch.setenv( "CP_STAGE_DIR", str( tmp_path ) )
+
+    assert cp.staged( "/shared/data.npy" ) == str( tmp_path / "data.npy" )
+    assert cp.staged( "/shared/other.npy" ) == "/shared/other.npy"
+
+# -----------------------------------------------------------------------------
+def test_array_tasks_stage_in_once_and_stage_out_their_own_outputs( tmp_path ) :
+
+    ( tmp_path / "input.txt" ).write_text( "in" )
+    job = ( f"{sys.executable} -c \"import os, sys ; "
+            "data = open( os.path.join( os.environ[ 'CP_STAGE_DIR' ], 'input.txt' ) ).read() ; "
+            "open( os.path.join( os.environ[ 'CP_STAGE_OUT' ], 'out' + sys.argv[1] + '.txt' ), 'w' ).write( data ) ; "
+            "sys.exit( int( sys.argv[1] == '2' ) )\" $SLURM_ARRAY_TASK_ID" )
+    path = str( tmp_path / "job" )
+    cp.create_sbatch_file( path, job=job, stage_in=[ str( tmp_path / "input.txt" ) ], 
+                           stage_out=[ "out1.txt", "out2.txt", "missing.txt" ] )
+
+    local = tmp_path / "node tmp"
+    for itask in ( 1, 2 ) :
+        env = dict( os.environ, TMPDIR=str( local ), SLURM_JOB_ID="7", SLURM_ARRAY_JOB_ID="7", 
+                    SLURM_ARRAY_TASK_ID=str( itask ) )
+        proc = subprocess.run( [ "bash", path + os.sep + "run_slurm.bat" ], env=env, cwd=path, capture_output=True )
+        assert proc.returncode == ( itask == 2 )
+
+    # The inputs are staged once per node, and each task stages out only its outputs, also if it fails
+    assert sorted( os.listdir( local ) ) == [ "cp_stage_7", "cp_stage_7_1", "cp_stage_7_2" ]
+    assert "out2.txt" in os.listdir( local / "cp_stage_7_2" ) and "out1.txt" not in os.listdir( local / "cp_stage_7_2" )
+    assert ( tmp_path / "job" / "out1.txt" ).read_text() == "in"
+    assert ( tmp_path / "job" / "out2.txt" ).read_text() == "in"
+    assert not ( tmp_path / "job" / "missing.txt" ).exists()
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def test_stream_shards_round_trip( tmp_path ) :
+
+    path = str( tmp_path )
+    assert cp.write_stream_shards( path, ( f"item{i}" for i in range( 10 ) ), 4 ) == ( 10, 3 )
+    assert [ list( cp.read_stream_shard( path, k ) ) for k in ( 1, 2, 3 ) ] == \
+           [ [ f"item{i}" for i in range( a, min( a + 4, 10 ) ) ] for a in ( 0, 4, 8 ) ]
+
+    # A shorter stream removes the shards of the previous one
+    assert cp.write_stream_shards( path, iter( range( 3 ) ), 4 ) == ( 3, 1 )
+    assert sorted( f for f in os.listdir( path ) if f.startswith( "shard_" ) ) == [ "shard_1.pkl" ]
+
+# -----------------------------------------------------------------------------
+def test_parfor_streams_a_generator( tmp_path ) :
+
+    source = tmp_path / "lines.txt"
+    source.write_text( "".join( f"{i}\n" for i in range( 11 ) ) )
+    code = ( f"lines = ( int( line ) for line in open( {str( source )!r} ) )\n"
+             "for v in lines :\n"
+             "    r = v * v\n" )
+    path = str( tmp_path / "job" )
+    *_, tasks = cp.parfor( code, path, stream=True, chunk_size=3, result="r", run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    assert len( tasks ) == 4 and [ task.state for task in tasks ] == [ "COMPLETED" ] * 4
+    assert list( cp.gather( path ) ) == [ i * i for i in range( 11 ) ]
+
+# -----------------------------------------------------------------------------
+def test_stream_requires_a_chunk_size( tmp_path ) :
+
+    with pytest.raises( ValueError ) :
+        cp.parfor( "for v in iter( [ 1 ] ) :\n    pass\n", str( tmp_path ), stream=True )
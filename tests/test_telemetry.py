@@ -0,0 +1,73 @@
+import json
+import os
+import time
+
+import pytest
+
+from CinecaPy import cineca as cp
+
+# -----------------------------------------------------------------------------
+def read_records( file_name ) :
+
+    with open( file_name ) as ft :
+        return [ json.loads( line ) for line in ft ]
+
+# -----------------------------------------------------------------------------
+def test_iterations_and_task_are_recorded( tmp_path ) :
+
+    telemetry = cp.Telemetry( str( tmp_path ), itask=3, buffer=2 )
+    for _ in telemetry.track( enumerate( "abc", 10 ), indexed=True ) :
+        time.sleep( 0.01 )
+    # Two records are flushed as soon as the buffer is full
+    assert len( read_records( str( tmp_path / "task_3.jsonl" ) ) ) == 2
+    telemetry.close()
+    telemetry.close()
+
+    records = read_records( str( tmp_path / "task_3.jsonl" ) )
+    assert [ r[ "i" ] for r in records[ :-1 ] ] == [ 10, 11, 12 ]
+    assert all( r[ "dur" ] >= 0.01 and r[ "rss" ] > 0 for r in records[ :-1 ] )
+    assert records[-1][ "type" ] == "task" and records[-1][ "task" ] == 3 and records[-1][ "iterations" ] == 3
+
+# -----------------------------------------------------------------------------
+def write_task( path, itask, durations, host="n1", startup=0.0, end=True ) :
+
+    with open( os.path.join( path, f"task_{itask}.jsonl" ), "w" ) as ft :
+        for i, dur in enumerate( durations ) :
+            ft.write( json.dumps( { "i": i, "start": 0.0, "end": dur, "dur": dur, "rss": 1 } ) + "\n" )
+        if end :
+            ft.write( json.dumps( { "type": "task", "task": itask, "host": host, "startup": startup,
+                                    "dur": startup + sum( durations ) } ) + "\n" )
+
+# -----------------------------------------------------------------------------
+def test_report_finds_stragglers_and_the_balanced_makespan( tmp_path ) :
+
+    path = str( tmp_path )
+    write_task( path, 1, [ 1.0 ] * 2, host="n1" )
+    write_task( path, 2, [ 1.0 ] * 2, host="n1" )
+    write_task( path, 3, [ 4.0, 4.0 ], host="n2" )
+    write_task( path, 4, [ 1.0 ], end=False )
+
+    report = cp.profile_report( path, printf=False )
+
+    assert len( report[ "tasks" ] ) == 4 and report[ "tasks" ][-1][ "incomplete" ]
+    assert [ t[ "task" ] for t in report[ "stragglers" ] ] == [ 3 ]
+    assert report[ "nodes" ][ "n2" ][ "throughput" ] == pytest.approx( 0.25 )
+    assert report[ "makespan" ] == 8.0
+    assert report[ "balanced_makespan" ] == 4.0 and report[ "speedup" ] == 2.0
+    assert report[ "histogram" ][0].sum() == 7
+
+# -----------------------------------------------------------------------------
+def test_parfor_telemetry( tmp_path, capsys ) :
+
+    path = str( tmp_path / "job" )
+    *_, tasks = cp.parfor( "for i in range( 6 ) :\n    pass\n", path, chunks=2, telemetry=True, 
+                           run=True, return_job=True )
+    for task in tasks :
+        task.wait()
+
+    report = cp.profile_report( path )
+    assert sorted( t[ "task" ] for t in report[ "tasks" ] ) == [ 1, 2 ]
+    assert sum( t[ "iterations" ] for t in report[ "tasks" ] ) == 6
+    assert "2 tasks, 6 iterations" in capsys.readouterr().out
+    with pytest.raises( ValueError ) :
+        cp.profile_report( str( tmp_path ) )